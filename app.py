@@ -1,23 +1,418 @@
-from flask import Flask, send_file, render_template, request, jsonify, send_from_directory
+from flask import Flask, Response, send_file, render_template, request, jsonify, send_from_directory, g
 from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.triggers.cron import CronTrigger
 import os
 import random
 import json
 from threading import Lock
-from datetime import datetime, timedelta
+from datetime import datetime
 import hashlib
+import base64
+import re
 from werkzeug.http import http_date
+from werkzeug.wsgi import wrap_file
 import mimetypes
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 from PIL import Image
-from io import BytesIO
-import math
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
 import threading
+import sqlite3
+import bisect
+import time
+from collections import OrderedDict, deque, namedtuple
+import mmap
+import struct
+import atexit
+import queue
+import logging
+from logging.handlers import QueueHandler, QueueListener
+import sys
+from array import array
+try:
+    import fcntl
+except ImportError:  # Windows下没有fcntl，只支持单进程运行
+    fcntl = None
+import fileutil
+import thumbnailer
+import imagemeta
+import metrics
+
+# 日志级别（DEBUG/INFO/WARNING/ERROR），设为WARNING时请求处理中几乎没有日志开销
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+# 日志格式：text为普通文本，json为每行一个JSON对象，便于日志系统解析
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text').lower()
+# 热路径日志（每个请求、每个文件可能输出一条的消息）的限频间隔（秒），0表示不限频
+LOG_RATE_LIMIT = float(os.getenv('LOG_RATE_LIMIT', '10'))
+# 日志队列长度，输出跟不上时丢弃新的日志，不阻塞请求线程
+LOG_QUEUE_SIZE = 10000
+
+
+class StdoutHandler(logging.StreamHandler):
+    """输出到当前的sys.stdout，而不是创建时的sys.stdout（contextlib.redirect_stdout同样有效）"""
+
+    @property
+    def stream(self):
+        return sys.stdout
+
+    @stream.setter
+    def stream(self, value):
+        pass
+
+
+class JsonFormatter(logging.Formatter):
+    """每条日志输出为一行JSON"""
+
+    def format(self, record):
+        return json.dumps({
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "process": record.process,
+            "message": record.getMessage(),
+        }, ensure_ascii=False)
+
+
+class DroppingQueueHandler(QueueHandler):
+    """把日志放入有界队列，由QueueListener的线程输出；队列满时丢弃并计数，不阻塞调用方"""
+
+    def __init__(self, size):
+        super().__init__(queue.Queue(size))
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class RateLimitFilter(logging.Filter):
+    """同一位置（文件和行号）的日志在interval秒内只输出一次，下一次输出时附上期间省略的条数"""
+
+    def __init__(self, interval):
+        super().__init__()
+        self.interval = interval
+        self._lock = Lock()
+        self._state = {}  # (文件, 行号) -> [上次输出时间, 省略条数]
+
+    def filter(self, record):
+        if self.interval <= 0:
+            return True
+        key = (record.pathname, record.lineno)
+        now = time.monotonic()
+        with self._lock:
+            state = self._state.get(key)
+            if state and now - state[0] < self.interval:
+                state[1] += 1
+                return False
+            suppressed = state[1] if state else 0
+            self._state[key] = [now, 0]
+        if suppressed:
+            record.msg = f"{record.msg}（之前{self.interval:g}秒内省略了{suppressed}条）"
+        return True
+
+
+def setup_logging():
+    """配置应用日志，返回队列handler
+
+    日志记录在调用线程中放入队列，由QueueListener的后台线程格式化后写到标准输出，
+    请求线程不等待输出；低于LOG_LEVEL的日志在调用时直接返回，参数也不会被格式化。
+    """
+    if logger.handlers:
+        # 模块被重复导入时不重复添加handler
+        return logger.handlers[0]
+    output = StdoutHandler()
+    if LOG_FORMAT == 'json':
+        output.setFormatter(JsonFormatter())
+    else:
+        output.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(process)d] %(message)s'))
+    handler = DroppingQueueHandler(LOG_QUEUE_SIZE)
+    listener = QueueListener(handler.queue, output)
+    listener.start()
+    # 退出前输出队列中剩余的日志
+    atexit.register(listener.stop)
+    logger.addHandler(handler)
+    logger.setLevel(LOG_LEVEL)
+    if __name__ == '__mp_main__':
+        # python app.py运行时，缩略图进程池的spawn子进程会以__mp_main__的名义重新执行本文件（见get_thumbnail_executor），
+        # 子进程只运行thumbnailer中的任务，不再重复输出启动信息
+        logger.setLevel(max(logger.level, logging.WARNING))
+    logger.propagate = False
+    hot_logger.addFilter(RateLimitFilter(LOG_RATE_LIMIT))
+    return handler
+
+
+logger = logging.getLogger('random-img')
+# 热路径上的日志（请求处理中的错误、逐个文件的失败等）使用hot_logger，按位置限频，避免刷屏
+hot_logger = logger.getChild('hot')
+LOG_HANDLER = setup_logging()
+
+class ImageSet:
+    """不可变的图片路径集合（快照），按路径排序保存
+
+    同一文件夹（含子目录）下的图片在有序元组中是连续的一段，
+    用二分查找即可在O(log N)内得到任意子目录的范围、图片数量或随机选取一张。
+    快照创建后不再修改，更新时生成新快照并整体替换全局引用，读取方无需加锁。
+    """
+
+    def __init__(self, paths=()):
+        self._items = tuple(sorted(set(paths)))
+        self._folders = None
+
+    @classmethod
+    def _from_sorted(cls, items):
+        snapshot = cls.__new__(cls)
+        snapshot._items = tuple(items)
+        snapshot._folders = None
+        return snapshot
+
+    def updated(self, added=(), removed=()):
+        """返回应用了新增和删除之后的新快照，已经生成过的目录树也增量更新"""
+        removed = set(removed)
+        items = [path for path in self._items if path not in removed] if removed else list(self._items)
+        new_items = sorted(path for path in set(added) if path not in self and path not in removed)
+        if new_items:
+            # 两段有序数据拼接后排序，Timsort只需一次归并
+            items.extend(new_items)
+            items.sort()
+        snapshot = ImageSet._from_sorted(items)
+        if self._folders is not None:
+            snapshot._folders = self._folders.updated(new_items, [path for path in removed if path in self])
+        return snapshot
+
+    def folder_tree(self, root):
+        """快照对应的目录树（FolderTree），第一次使用时生成"""
+        if self._folders is None:
+            self._folders = FolderTree(root, self._items)
+        return self._folders
+
+    def folder_range(self, folder):
+        """返回文件夹（含子目录）内的图片在有序列表中的范围[lo, hi)"""
+        prefix = os.path.normpath(folder)
+        if not prefix.endswith(os.sep):
+            prefix += os.sep
+        # 以prefix开头的字符串都位于[prefix, prefix去掉分隔符后接下一个字符)之间
+        upper = prefix[:-1] + chr(ord(os.sep) + 1)
+        return bisect.bisect_left(self._items, prefix), bisect.bisect_left(self._items, upper)
+
+    def folder_view(self, folder):
+        """返回文件夹（含子目录）内图片的只读视图，不复制列表"""
+        lo, hi = self.folder_range(folder)
+        return ImageSetView(self._items, lo, hi)
+
+    def count_in(self, folder):
+        """统计文件夹（含子目录）内的图片数量"""
+        lo, hi = self.folder_range(folder)
+        return hi - lo
+
+    def __contains__(self, path):
+        index = bisect.bisect_left(self._items, path)
+        return index < len(self._items) and self._items[index] == path
+
+    def __len__(self):
+        return len(self._items)
+
+    def __getitem__(self, index):
+        return self._items[index]
+
+    def __iter__(self):
+        return iter(self._items)
+
+FolderNode = namedtuple('FolderNode', ('total', 'children', 'images'))
+
+class FolderTree:
+    """由图片列表快照得到的目录树
+
+    每个目录对应一个FolderNode：total为含子目录的图片数，children为有图片的子目录名，images为直接包含的图片文件名，
+    都已排序。键为相对root的路径（'/'分隔，根目录为''）。目录树与快照一样创建后不再修改，
+    快照更新时复制目录字典并只替换受影响的目录及其上级目录的节点，不需要重新遍历全部图片。
+    """
+
+    EMPTY = FolderNode(0, (), ())
+
+    def __init__(self, root, paths=()):
+        self.root = os.path.normpath(root)
+        self._nodes = {'': self.EMPTY}
+        added = {}
+        for path in paths:
+            folder, name = os.path.split(path)
+            added.setdefault(folder, []).append(name)
+        self._apply(added, {})
+
+    def _rel(self, folder):
+        """绝对路径转换为相对root的目录键，不在root内时返回None"""
+        rel = os.path.relpath(folder, self.root)
+        if rel == '.':
+            return ''
+        if rel == '..' or rel.startswith('..' + os.sep):
+            return None
+        return rel.replace(os.sep, '/')
+
+    def _apply(self, added, removed):
+        """在self._nodes上应用变化（只在生成新目录树时调用），added/removed为{绝对目录路径: 文件名列表}"""
+        nodes = self._nodes
+        for folder in set(added) | set(removed):
+            key = self._rel(folder)
+            if key is None:
+                continue
+            node = nodes.get(key)
+            if node is None:
+                node = self.EMPTY
+                self._link(key)
+            images = set(node.images)
+            images.difference_update(removed.get(folder, ()))
+            images.update(added.get(folder, ()))
+            delta = len(images) - len(node.images)
+            nodes[key] = node._replace(total=node.total + delta, images=tuple(sorted(images)))
+            parent = key
+            while parent and delta:
+                parent = parent.rpartition('/')[0]
+                nodes[parent] = nodes[parent]._replace(total=nodes[parent].total + delta)
+
+        # 删除已经没有图片的目录
+        for key in [key for key, node in nodes.items() if key and node.total == 0]:
+            del nodes[key]
+            parent, _, name = key.rpartition('/')
+            if parent in nodes:
+                nodes[parent] = nodes[parent]._replace(
+                    children=tuple(child for child in nodes[parent].children if child != name))
+
+    def _link(self, key):
+        """创建新目录的节点，并把它（以及缺少的上级目录）加入上级目录的子目录列表"""
+        self._nodes[key] = self.EMPTY
+        while key:
+            parent, _, name = key.rpartition('/')
+            parent_node = self._nodes.get(parent)
+            if parent_node is None:
+                self._nodes[parent] = self.EMPTY._replace(children=(name,))
+                key = parent
+                continue
+            if name not in parent_node.children:
+                children = list(parent_node.children)
+                bisect.insort(children, name)
+                self._nodes[parent] = parent_node._replace(children=tuple(children))
+            break
+
+    def updated(self, added=(), removed=()):
+        """返回应用了新增和删除之后的新目录树，added/removed为图片的绝对路径"""
+        changes = ({}, {})
+        for paths, change in zip((added, removed), changes):
+            for path in paths:
+                folder, name = os.path.split(path)
+                change.setdefault(folder, []).append(name)
+        tree = FolderTree.__new__(FolderTree)
+        tree.root = self.root
+        tree._nodes = dict(self._nodes)
+        tree._apply(*changes)
+        return tree
+
+    def get(self, folder):
+        """目录的节点，目录中（含子目录）没有图片时返回None"""
+        return self._nodes.get(folder)
+
+class ImageSetView:
+    """ImageSet中一段连续范围的只读视图，支持len、下标访问和random.choice"""
+
+    def __init__(self, items, lo, hi):
+        self._items = items
+        self._lo = lo
+        self._hi = hi
+
+    def __len__(self):
+        return self._hi - self._lo
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("ImageSetView index out of range")
+        return self._items[self._lo + index]
+
+    def __iter__(self):
+        for index in range(self._lo, self._hi):
+            yield self._items[index]
+
+class LRUCache:
+    """线程安全的有界LRU缓存，超过容量时淘汰最久未使用的条目"""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                self._data.move_to_end(key)
+                return self._data[key]
+            except KeyError:
+                return default
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._data.pop(key, default)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def keys(self):
+        with self._lock:
+            return list(self._data)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+class SingleFlight:
+    """合并同一个key的并发调用
+
+    同一时间每个key只有一个调用方真正执行函数，其他调用方等待它完成并共享结果（或异常）。
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._calls = {}
+
+    def do(self, key, func, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = {"done": threading.Event(), "result": None, "error": None}
+
+        if not leader:
+            call["done"].wait()
+            if call["error"] is not None:
+                raise call["error"]
+            return call["result"]
+
+        try:
+            call["result"] = func(*args, **kwargs)
+            return call["result"]
+        except Exception as e:
+            call["error"] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call["done"].set()
 
 # 在文件顶部添加缓存变量
-CACHED_IMAGES = []
+CACHED_IMAGES = ImageSet()
 LAST_SCAN_TIME = None
 CACHE_DURATION = 300  # 缓存有效期（秒）
 LAST_REFRESH_TIME = None
@@ -36,7 +431,24 @@ SCAN_STATUS = {
 
 # 在app.py中添加图片缓存和索引
 IMAGE_CACHE = {}  # 缓存图片元数据，避免重复读取
-SORT_CACHE = {}  # 缓存排序结果
+
+# 图片元数据（尺寸）读取状态，可通过 /metadata-status 查询
+METADATA_STATUS = {
+    "is_running": False,
+    "folder": "",
+    "total": 0,
+    "processed": 0,
+    "from_index": 0,  # 索引中已有尺寸
+    "from_header": 0,  # 只读取文件头获得尺寸
+    "from_pillow": 0,  # 文件头无法识别，用Pillow打开
+    "failed": 0,
+    "previews": 0,  # 新生成的内嵌预览（索引中没有）
+    "current_file": "",
+    "start_time": None
+}
+# 缓存各文件夹的图片列表和排序结果（FolderListing），按文件夹数量限制大小
+SORT_CACHE_SIZE = int(os.getenv('SORT_CACHE_SIZE', '32'))
+SORT_CACHE = LRUCache(SORT_CACHE_SIZE)
 
 # 在文件顶部添加新的全局变量，用于跟踪缩略图生成状态
 THUMBNAIL_STATUS = {
@@ -44,7 +456,12 @@ THUMBNAIL_STATUS = {
     "total": 0,
     "processed": 0,
     "start_time": None,
-    "current_file": ""
+    "current_file": "",
+    "generated": 0,  # 实际生成的缩略图数量（已存在的会跳过）
+    "failed": 0,
+    "workers": 0,
+    "timings": {"decode": 0.0, "resize": 0.0, "save": 0.0},  # 各阶段累计耗时（秒）
+    "gc": None  # 最近一次缩略图清理的结果
 }
 
 def parse_cron(exp: str) -> dict:
@@ -156,7 +573,7 @@ def translate_cron(exp: str) -> str:
         return desc if desc else exp
             
     except Exception as e:
-        print(f"解析cron表达式出错: {str(e)}")
+        logger.warning("解析cron表达式出错: %s", e)
         return exp
 
 app = Flask(__name__, static_url_path='', static_folder='.')
@@ -168,132 +585,1305 @@ PHOTOS_FOLDER = os.getenv('PHOTOS_FOLDER', os.path.join(BASE_DIR, 'photos'))
 # 缩略图单独放在thumbnails子目录
 THUMBNAIL_FOLDER = os.getenv('THUMBNAIL_FOLDER', os.path.join(BASE_DIR, 'thumbnails'))
 CONFIG_FILE = os.path.join(CONFIG_FOLDER, 'config.json')
+# 持久化图片索引数据库
+INDEX_DB_FILE = os.path.join(CONFIG_FOLDER, 'image_index.db')
+# 多进程共享状态文件（当前图片、图片列表版本号）
+SHARED_STATE_FILE = os.path.join(CONFIG_FOLDER, 'shared_state.bin')
+# 后台任务锁文件，持有该锁的进程负责定时任务、文件监控和目录扫描
+BACKGROUND_LOCK_FILE = os.path.join(CONFIG_FOLDER, 'background.lock')
+# 各进程的运行指标快照，/metrics合并所有进程的数据
+METRICS_FOLDER = os.path.join(CONFIG_FOLDER, 'metrics')
+# 已退出进程的计数器和直方图累计值，及汇总各进程快照时使用的锁文件
+METRICS_AGGREGATE_FILE = os.path.join(METRICS_FOLDER, 'aggregate.json')
+METRICS_LOCK_FILE = os.path.join(METRICS_FOLDER, '.lock')
+# 进程把运行指标写入快照文件的间隔（秒）
+METRICS_FLUSH_INTERVAL = 5
+
+# 支持的图片格式和大小限制
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.bmp')
+MAX_IMAGE_SIZE = 50 * 1024 * 1024  # 限制50MB
+
+# ETag计算方式：hash为文件内容MD5（结果会缓存并保存到索引），stat为大小-修改时间-inode
+ETAG_MODE = os.getenv('ETAG_MODE', 'hash').lower()
+ETAG_CACHE_SIZE = int(os.getenv('ETAG_CACHE_SIZE', '10000'))
+# /img/today预选图片池的大小，0表示不启用（每次请求都实时选图）
+TODAY_POOL_SIZE = int(os.getenv('TODAY_POOL_SIZE', '0'))
+# 缩略图宽度档位：后台预生成这些宽度，按需请求的宽度向上取到最近的档位，不会为任意宽度生成新文件
+THUMBNAIL_WIDTHS = tuple(sorted({int(w) for w in os.getenv('THUMBNAIL_WIDTHS', '200,400,800').split(',') if w.strip()}))
+# 缩略图的现代格式，按优先顺序排列，根据请求的Accept头选择浏览器支持的第一个，都不支持时使用JPEG；
+# Pillow不支持的格式会被忽略，后台预生成时每个宽度都会生成JPEG和这些格式
+THUMBNAIL_FORMATS = tuple(
+    fmt for fmt in dict.fromkeys(f.strip().lower() for f in os.getenv('THUMBNAIL_FORMATS', 'avif,webp').split(','))
+    if fmt in thumbnailer.available_formats() and fmt != 'jpeg'
+) + ('jpeg',)
+# 生成缩略图的进程数（默认CPU核数减一，留一个核处理请求）
+THUMBNAIL_WORKERS = int(os.getenv('THUMBNAIL_WORKERS', '0')) or max(1, (os.cpu_count() or 2) - 1)
+# 缩略图占用磁盘的上限（MB），超过时按最近访问时间淘汰，0表示不限制；清理任务的执行间隔（分钟）
+THUMBNAIL_DISK_BUDGET_MB = int(os.getenv('THUMBNAIL_DISK_BUDGET_MB', '0'))
+THUMBNAIL_GC_INTERVAL = int(os.getenv('THUMBNAIL_GC_INTERVAL', '60'))
+# /image和/img/today按参数缩放的图片变体：磁盘缓存上限（MB，0表示不限制）和同时处理的数量
+VARIANT_CACHE_MB = int(os.getenv('VARIANT_CACHE_MB', '512'))
+VARIANT_WORKERS = int(os.getenv('VARIANT_WORKERS', '2'))
+# 图片变体允许的最大宽高
+VARIANT_MAX_DIMENSION = 8192
+# /list-images中内嵌预览图的最长边（像素），0表示不生成预览
+PREVIEW_SIZE = int(os.getenv('PREVIEW_SIZE', str(thumbnailer.PREVIEW_SIZE)))
+# 读取图片元数据的线程数（以文件IO为主，可以多于CPU核数）
+METADATA_WORKERS = int(os.getenv('METADATA_WORKERS', '8'))
+# 扫描图片目录时并行读取目录的线程数，网络存储上可以适当调大
+SCAN_WORKERS = max(1, int(os.getenv('SCAN_WORKERS', '8')))
+# 其他worker转交的手动扫描请求：后台任务进程的检查间隔和请求方等待扫描完成的最长时间（秒）
+SCAN_REQUEST_POLL_INTERVAL = 1
+SCAN_REQUEST_TIMEOUT = 3600
 
 # 初始化随机种子
 random.seed(int(datetime.now().timestamp()))
 
-print(f"应用程序配置信息:")
-print(f"BASE_DIR: {BASE_DIR}")
-print(f"CONFIG_FOLDER: {CONFIG_FOLDER}")
-print(f"PHOTOS_FOLDER: {PHOTOS_FOLDER}")
-print(f"THUMBNAIL_FOLDER: {THUMBNAIL_FOLDER}")
-print(f"CONFIG_FILE: {CONFIG_FILE}")
+logger.info("应用程序配置信息:")
+logger.info("BASE_DIR: %s", BASE_DIR)
+logger.info("CONFIG_FOLDER: %s", CONFIG_FOLDER)
+logger.info("PHOTOS_FOLDER: %s", PHOTOS_FOLDER)
+logger.info("THUMBNAIL_FOLDER: %s", THUMBNAIL_FOLDER)
+logger.info("CONFIG_FILE: %s", CONFIG_FILE)
+logger.info("INDEX_DB_FILE: %s", INDEX_DB_FILE)
+logger.info("ETAG_MODE: %s", ETAG_MODE)
+logger.info("TODAY_POOL_SIZE: %s", TODAY_POOL_SIZE)
+logger.info("THUMBNAIL_WIDTHS: %s", THUMBNAIL_WIDTHS)
+logger.info("THUMBNAIL_FORMATS: %s", THUMBNAIL_FORMATS)
+logger.info("THUMBNAIL_WORKERS: %s", THUMBNAIL_WORKERS)
+logger.info("SCAN_WORKERS: %s", SCAN_WORKERS)
 
 # 确保必要的目录存在
 os.makedirs(CONFIG_FOLDER, exist_ok=True)
 os.makedirs(PHOTOS_FOLDER, exist_ok=True)
 os.makedirs(THUMBNAIL_FOLDER, exist_ok=True)
+os.makedirs(METRICS_FOLDER, exist_ok=True)
 
+# 运行指标，通过 /metrics 以Prometheus文本格式输出
+METRICS = metrics.Metrics('randomimg')
+METRICS.counter('http_requests_total', "HTTP请求数，按路由模板、方法和状态码统计（304为ETag/修改时间命中）")
+METRICS.histogram('http_request_duration_seconds', "请求处理耗时（不含响应体传输），按路由模板统计")
+METRICS.counter('http_response_bytes_total', "已知长度的响应体字节数，按路由模板统计")
+METRICS.counter('thumbnail_requests_total', "缩略图请求结果：hit已存在，miss按需生成，error生成失败返回原图")
+METRICS.histogram('thumbnail_generate_seconds', "为一张原图生成缩略图的耗时，source为request（按需）或background（后台批量）")
+METRICS.counter('thumbnail_stage_seconds_total', "后台生成缩略图各阶段（decode/resize/save）的累计耗时")
+METRICS.counter('content_hash_total', "获取原图内容哈希的次数，source为memory（内存缓存）、index（索引）或computed（计算MD5）")
+METRICS.histogram('content_hash_seconds', "计算一个文件MD5的耗时")
+METRICS.counter('content_hash_bytes_total', "计算MD5读取的字节数")
+METRICS.counter('scans_total', "目录扫描次数，mode为full或incremental")
+METRICS.gauge('scan_duration_seconds', "最近一次目录扫描的用时")
+METRICS.gauge('scan_last_timestamp_seconds', "最近一次目录扫描完成的时间（Unix时间戳）")
+METRICS.gauge('images', "图片列表中的图片数量")
+METRICS.gauge('index_db_bytes', "图片索引数据库（含WAL文件）的大小")
+METRICS.gauge('thumbnail_store_bytes', "缩略图存储中已登记的缩略图总大小")
+
+# 当前图片信息，更新时整体替换为新字典，读取方先取得引用再使用，无需加锁
 CURRENT_IMAGE = {"path": None}
+_CURRENT_IMAGE_SOURCE = None  # 当前图片对应的共享状态数据，用于判断其他进程是否更新过
+_CURRENT_IMAGE_PENDING = False  # 本进程的当前图片还没有写入共享状态（见set_current_image的defer参数）
+_current_image_publishing = False
+_current_image_lock = Lock()
+_current_image_write_lock = Lock()
+IMAGES_GENERATION = 0  # 本进程图片列表对应的共享版本号
+# 仅用于串行化图片列表（CACHED_IMAGES）的更新，读取快照无需加锁
 lock = Lock()
 
+class ConfigStore:
+    """config.json的内存副本
+
+    读取时最多每CHECK_INTERVAL秒检查一次文件的修改时间、大小和inode，没有变化就直接返回内存中的配置，
+    请求路径上不读取文件也不解析JSON；其他进程保存后文件发生变化，下次检查时重新加载。
+    保存时持有进程内锁和跨进程文件锁，先重新读取文件中的最新配置，合并修改后写入临时文件再重命名，
+    并发保存不会互相覆盖，其他进程也不会读到写了一半的文件。
+    """
+
+    CHECK_INTERVAL = 1.0
+    DEFAULT_CRON = '0 0 * * *'
+    DEFAULT_WATERFALL_SETTINGS = {
+        'columnCount': 3,
+        'columnGap': 15,
+        'imageGap': 15,
+        'borderRadius': 8
+    }
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self._lock_file = open(path + '.lock', 'a')
+        self._data = {}
+        self._stamp = None
+        self._checked = 0
+        if not os.path.exists(path):
+            # 创建默认配置文件
+            self.update(cron=self.DEFAULT_CRON)
+        self._reload()
+
+    def _file_stamp(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+    def _read_file(self):
+        with open(self.path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        if not isinstance(data, dict):
+            raise ValueError("配置文件内容不是JSON对象")
+        return data
+
+    def _reload(self):
+        """文件有变化时重新加载，文件损坏时保留上次成功加载的配置"""
+        self._checked = time.monotonic()
+        stamp = self._file_stamp()
+        if stamp == self._stamp:
+            return
+        try:
+            data = self._read_file()
+        except Exception as e:
+            logger.warning("配置加载失败: %s", e)
+            return
+        self._data = data
+        self._stamp = stamp
+
+    def data(self):
+        """当前配置（调用方不要修改返回的字典）"""
+        if time.monotonic() - self._checked >= self.CHECK_INTERVAL:
+            with self.lock:
+                self._reload()
+        return self._data
+
+    def get(self, key, default=None):
+        return self.data().get(key, default)
+
+    def update(self, **values):
+        """合并保存若干配置项，返回保存后的完整配置"""
+        with self.lock, fileutil.file_lock(self._lock_file):
+            try:
+                data = self._read_file()
+            except FileNotFoundError:
+                data = {}
+            except ValueError as e:
+                # 文件损坏时以上次成功加载的配置为基础保存
+                logger.warning("配置文件损坏，使用内存中的配置: %s", e)
+                data = dict(self._data)
+            data.update(values)
+            with fileutil.atomic_write(self.path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False, indent=2)
+            self._data = data
+            self._stamp = self._file_stamp()
+            self._checked = time.monotonic()
+        return data
+
+    def cron(self):
+        """定时刷新的cron表达式"""
+        value = self.get('cron')
+        return value.strip() if isinstance(value, str) and value.strip() else self.DEFAULT_CRON
+
+    def folder_path(self):
+        """随机图片使用的文件夹（相对路径），空字符串表示全部图片"""
+        value = self.get('folderPath')
+        return value if isinstance(value, str) else ''
+
+    def waterfall_settings(self):
+        """瀑布流布局设置，缺少或无效的项使用默认值"""
+        settings = dict(self.DEFAULT_WATERFALL_SETTINGS)
+        value = self.get('waterfallSettings')
+        if isinstance(value, dict):
+            for key, default in self.DEFAULT_WATERFALL_SETTINGS.items():
+                try:
+                    settings[key] = int(value.get(key, default))
+                except (TypeError, ValueError):
+                    pass
+        return settings
+
 # 初始化配置
-try:
-    if os.path.exists(CONFIG_FILE):
-        with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
-            cron_exp = json.load(f).get('cron', '0 0 * * *')
-    else:
-        cron_exp = '0 0 * * *'
-        # 创建默认配置文件
-        with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
-            json.dump({'cron': cron_exp}, f)
-except Exception as e:
-    print(f"配置加载失败: {str(e)}")
-    cron_exp = '0 0 * * *'
+CONFIG = ConfigStore(CONFIG_FILE)
+cron_exp = CONFIG.cron()
+
+# 缓存已计算的内容哈希，键为(路径, 大小, 修改时间, inode)，文件变化后自动失效
+ETAG_CACHE = LRUCache(ETAG_CACHE_SIZE)
 
 def get_file_hash(filepath):
     """计算文件的MD5哈希值"""
     hasher = hashlib.md5()
     with open(filepath, 'rb') as f:
-        for chunk in iter(lambda: f.read(4096), b''):
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
             hasher.update(chunk)
     return hasher.hexdigest()
 
+def get_content_hash(filepath, stat, compute=True):
+    """获取文件内容的MD5，同一版本的文件只计算一次
+
+    依次查找内存缓存和索引中保存的哈希（大小和修改时间一致才可用），
+    都没有时计算并保存到索引；compute为False时不计算，直接返回None。
+    """
+    key = (filepath, stat.st_size, stat.st_mtime_ns, stat.st_ino)
+    file_hash = ETAG_CACHE.get(key)
+    if file_hash:
+        METRICS.inc('content_hash_total', source='memory')
+        return file_hash
+
+    rel_path = None
+    if os.path.normpath(filepath).startswith(os.path.normpath(PHOTOS_FOLDER) + os.sep):
+        rel_path = IMAGE_INDEX.rel_path(filepath)
+        indexed = IMAGE_INDEX.get_image(rel_path)
+        if indexed and indexed['hash'] and indexed['size'] == stat.st_size and indexed['mtime'] == stat.st_mtime:
+            file_hash = indexed['hash']
+            METRICS.inc('content_hash_total', source='index')
+
+    if not file_hash:
+        if not compute:
+            return None
+        start = time.perf_counter()
+        file_hash = get_file_hash(filepath)
+        METRICS.observe('content_hash_seconds', time.perf_counter() - start)
+        METRICS.inc('content_hash_bytes_total', stat.st_size)
+        METRICS.inc('content_hash_total', source='computed')
+        if rel_path:
+            IMAGE_INDEX.set_hash(rel_path, file_hash, stat.st_size, stat.st_mtime)
+
+    ETAG_CACHE.set(key, file_hash)
+    return file_hash
+
+def get_file_etag(filepath, stat):
+    """获取文件的强ETag"""
+    if ETAG_MODE == 'stat':
+        return f'"{stat.st_size:x}-{stat.st_mtime_ns:x}-{stat.st_ino:x}"'
+    return f'"{get_content_hash(filepath, stat)}"'
+
 def get_file_info(filepath):
     """获取文件信息"""
     stat = os.stat(filepath)
     return {
         'size': stat.st_size,
         'mtime': stat.st_mtime,
-        'etag': f'"{get_file_hash(filepath)}"'
+        'etag': get_file_etag(filepath, stat)
     }
 
-def generate_thumbnails_for_images(image_paths, max_concurrent=5):
-    """为图片列表生成缩略图，限制并发数量"""
+def get_source_version(stat):
+    """原图的版本标记（修改时间-大小），用于缩略图URL和ETag，原图变化后标记随之变化"""
+    return f"{stat.st_mtime_ns:x}-{stat.st_size:x}"
+
+# 带有当前版本标记的缩略图URL内容不会再变化，浏览器和代理可以长期缓存
+THUMBNAIL_MAX_AGE = 365 * 24 * 3600
+
+class ImageIndex:
+    """持久化的图片索引，保存在SQLite中
+
+    记录每张图片的路径、大小、修改时间、尺寸、内容哈希和内嵌预览，以及每个目录的修改时间。
+    重新扫描时只读取修改时间发生变化的目录，未变化的目录直接沿用索引中的数据。
+    image_journal按图片列表的共享版本号记录每次更新新增和移除的图片，其他进程据此增量更新自己的图片列表。
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+        CREATE TABLE IF NOT EXISTS dirs (
+            path TEXT PRIMARY KEY,
+            parent TEXT,
+            mtime REAL
+        );
+        CREATE INDEX IF NOT EXISTS idx_dirs_parent ON dirs(parent);
+        CREATE TABLE IF NOT EXISTS images (
+            path TEXT PRIMARY KEY,
+            dir TEXT NOT NULL,
+            name TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            mtime REAL NOT NULL,
+            ctime REAL NOT NULL,
+            width INTEGER,
+            height INTEGER,
+            hash TEXT,
+            preview TEXT,
+            color TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_images_dir ON images(dir);
+        CREATE TABLE IF NOT EXISTS image_journal (
+            generation INTEGER PRIMARY KEY,
+            added TEXT,
+            removed TEXT
+        );
+    """
+
+    # 修改时间距当前不足该秒数的目录不记录mtime，避免低精度文件系统（如SMB）漏掉同一秒内的变化
+    MTIME_SETTLE_SECONDS = 2
+    # 扫描时每处理多少个有变化的目录提交一次事务
+    COMMIT_EVERY = 200
+    # 扫描进度输出间隔（秒）
+    PROGRESS_INTERVAL = 5
+    # 变化日志保留的版本数，落后更多版本的进程重新加载完整列表
+    JOURNAL_KEEP = 1000
+    # 一次更新变化的图片超过该数量时不记录明细（如首次扫描），其他进程重新加载完整列表更快
+    JOURNAL_MAX_CHANGES = 10000
+
+    def __init__(self, db_path, root):
+        self.db_path = db_path
+        self.root = os.path.normpath(root)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        with self.lock:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            self.conn.executescript(self.SCHEMA)
+            columns = {row[1] for row in self.conn.execute('PRAGMA table_info(images)')}
+            for column in ('preview', 'color'):
+                if column not in columns:
+                    self.conn.execute(f'ALTER TABLE images ADD COLUMN {column} TEXT')
+            row = self.conn.execute("SELECT value FROM meta WHERE key = 'root'").fetchone()
+            if row and row[0] != self.root:
+                logger.info("图片目录已变更，清空索引: %s -> %s", row[0], self.root)
+                self.conn.execute('DELETE FROM images')
+                self.conn.execute('DELETE FROM dirs')
+                self.conn.execute('DELETE FROM image_journal')
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('root', ?)", (self.root,))
+            self.conn.commit()
+
+    def rel_path(self, full_path):
+        """绝对路径转换为索引中使用的相对路径（使用/分隔）"""
+        rel = os.path.relpath(full_path, self.root).replace('\\', '/')
+        return '' if rel == '.' else rel
+
+    def full_path(self, rel_path):
+        """索引中的相对路径转换为绝对路径"""
+        if not rel_path:
+            return self.root
+        return os.path.join(self.root, rel_path.replace('/', os.sep))
+
+    def load_images(self):
+        """从索引中加载所有有效图片的绝对路径"""
+        with self.lock:
+            rows = self.conn.execute(
+                'SELECT path FROM images WHERE size <= ? ORDER BY path', (MAX_IMAGE_SIZE,)
+            ).fetchall()
+        return [self.full_path(row[0]) for row in rows]
+
+    def record_changes(self, generation, added=None, removed=None):
+        """在变化日志中记录版本generation相对上一版本新增和移除的图片（绝对路径）
+
+        added为None或变化过多时只记录版本号，读取到这个版本的进程会重新加载完整列表。
+        大于等于generation的旧记录（共享状态被重置前留下的）一并删除。
+        """
+        if added is not None and len(added) + len(removed) <= self.JOURNAL_MAX_CHANGES:
+            added = json.dumps(sorted(self.rel_path(path) for path in added), ensure_ascii=False)
+            removed = json.dumps(sorted(self.rel_path(path) for path in removed), ensure_ascii=False)
+        else:
+            added = removed = None
+        with self.lock:
+            self.conn.execute('DELETE FROM image_journal WHERE generation >= ? OR generation <= ?',
+                              (generation, generation - self.JOURNAL_KEEP))
+            self.conn.execute('INSERT INTO image_journal (generation, added, removed) VALUES (?, ?, ?)',
+                              (generation, added, removed))
+            self.conn.commit()
+
+    def load_changes(self, since, until):
+        """合并版本since之后到until（含）的变化，返回(新增, 移除)的绝对路径列表
+
+        日志不完整（已被清理、记录失败或变化过多）时返回None，调用方应重新加载完整列表。
+        """
+        if not since < until <= since + self.JOURNAL_KEEP:
+            return None
+        with self.lock:
+            rows = self.conn.execute(
+                'SELECT added, removed FROM image_journal WHERE generation > ? AND generation <= ? ORDER BY generation',
+                (since, until)
+            ).fetchall()
+        if len(rows) != until - since or any(added is None for added, _ in rows):
+            return None
+        # 按版本顺序应用，同一张图片以最后一次变化为准
+        present = {}
+        for added, removed in rows:
+            present.update((path, False) for path in json.loads(removed))
+            present.update((path, True) for path in json.loads(added))
+        return ([self.full_path(path) for path, exists in present.items() if exists],
+                [self.full_path(path) for path, exists in present.items() if not exists])
+
+    def get_image(self, rel_path):
+        """获取单张图片的索引记录"""
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT path, size, mtime, ctime, width, height, hash, preview, color FROM images WHERE path = ?',
+                (rel_path,)
+            ).fetchone()
+        if not row:
+            return None
+        return dict(zip(('path', 'size', 'mtime', 'ctime', 'width', 'height', 'hash', 'preview', 'color'), row))
+
+    def get_images_many(self, rel_paths, chunk_size=500):
+        """批量获取图片的索引记录，返回{相对路径: 记录}，不在索引中的图片不返回"""
+        keys = ('path', 'size', 'mtime', 'ctime', 'width', 'height', 'hash', 'preview', 'color')
+        result = {}
+        rel_paths = list(rel_paths)
+        for i in range(0, len(rel_paths), chunk_size):
+            chunk = rel_paths[i:i + chunk_size]
+            with self.lock:
+                rows = self.conn.execute(
+                    'SELECT path, size, mtime, ctime, width, height, hash, preview, color '
+                    'FROM images WHERE path IN (%s)'
+                    % ','.join('?' * len(chunk)), chunk
+                ).fetchall()
+            result.update((row[0], dict(zip(keys, row))) for row in rows)
+        return result
+
+    def update_dimensions(self, rel_path, width, height):
+        """保存图片尺寸"""
+        with self.lock:
+            self.conn.execute('UPDATE images SET width = ?, height = ? WHERE path = ?',
+                              (width, height, rel_path))
+            self.conn.commit()
+
+    def update_dimensions_many(self, rows):
+        """批量保存图片尺寸，rows为[(相对路径, 宽, 高), ...]"""
+        with self.lock:
+            self.conn.executemany('UPDATE images SET width = ?, height = ? WHERE path = ?',
+                                  [(width, height, rel_path) for rel_path, width, height in rows])
+            self.conn.commit()
+
+    def set_previews_many(self, rows):
+        """批量保存内嵌预览，rows为[(相对路径, 预览, 主色调, 修改时间), ...]，文件已修改的记录不写入"""
+        with self.lock:
+            self.conn.executemany('UPDATE images SET preview = ?, color = ? WHERE path = ? AND mtime = ?',
+                                  [(preview, color, rel_path, mtime) for rel_path, preview, color, mtime in rows])
+            self.conn.commit()
+
+    def live_hashes(self):
+        """索引中所有图片的内容哈希（未计算过哈希的图片不包含在内）"""
+        with self.lock:
+            rows = self.conn.execute('SELECT DISTINCT hash FROM images WHERE hash IS NOT NULL').fetchall()
+        return {row[0] for row in rows}
+
+    def unhashed_paths(self):
+        """还没有计算内容哈希的图片（超过大小限制的除外）的相对路径"""
+        with self.lock:
+            rows = self.conn.execute('SELECT path FROM images WHERE hash IS NULL AND size <= ?',
+                                     (MAX_IMAGE_SIZE,)).fetchall()
+        return [row[0] for row in rows]
+
+    def set_hash(self, rel_path, file_hash, size, mtime):
+        """保存图片内容哈希，只有索引记录与计算时的文件版本一致才写入"""
+        with self.lock:
+            self.conn.execute('UPDATE images SET hash = ? WHERE path = ? AND size = ? AND mtime = ?',
+                              (file_hash, rel_path, size, mtime))
+            self.conn.commit()
+
+    def refresh_file(self, full_path):
+        """根据文件当前状态更新单个文件的索引记录
+
+        文件存在且是有效图片时写入索引并返回True，否则从索引中删除并返回False。
+        """
+        rel = self.rel_path(full_path)
+        try:
+            stat = os.stat(full_path)
+            valid = (os.path.isfile(full_path)
+                     and full_path.lower().endswith(IMAGE_EXTENSIONS)
+                     and stat.st_size <= MAX_IMAGE_SIZE)
+        except OSError:
+            valid = False
+
+        with self.lock:
+            if valid:
+                self.conn.execute(
+                    '''INSERT INTO images (path, dir, name, size, mtime, ctime) VALUES (?, ?, ?, ?, ?, ?)
+                       ON CONFLICT(path) DO UPDATE SET
+                           size = excluded.size, mtime = excluded.mtime, ctime = excluded.ctime,
+                           width = NULL, height = NULL, hash = NULL, preview = NULL, color = NULL
+                       WHERE images.size != excluded.size OR images.mtime != excluded.mtime''',
+                    (rel, self.rel_path(os.path.dirname(full_path)), os.path.basename(full_path),
+                     stat.st_size, stat.st_mtime, stat.st_ctime)
+                )
+            else:
+                self.conn.execute('DELETE FROM images WHERE path = ?', (rel,))
+            self.conn.commit()
+        return valid
+
+    def remove_tree(self, full_path):
+        """删除目录及其子目录下的所有索引记录，返回被删除图片的绝对路径"""
+        rel = self.rel_path(full_path)
+        # '/'的下一个字符是'0'，用范围查询匹配前缀
+        low, high = (rel + '/', rel + '0') if rel else ('', '\uffff')
+        with self.lock:
+            rows = self.conn.execute(
+                'SELECT path FROM images WHERE path >= ? AND path < ?', (low, high)
+            ).fetchall()
+            self.conn.execute('DELETE FROM images WHERE path >= ? AND path < ?', (low, high))
+            self.conn.execute('DELETE FROM dirs WHERE path = ? OR (path >= ? AND path < ?)',
+                              (rel, low, high))
+            self.conn.commit()
+        return [self.full_path(row[0]) for row in rows]
+
+    def _read_dir(self, dir_path, known_mtime, full):
+        """在扫描线程中读取一个目录，返回(目录mtime, 子目录列表, 图片文件列表, 非图片文件数)
+
+        目录修改时间与索引中记录的相同（且不是完整扫描）时不列举目录，子目录和图片返回None。
+        图片文件为[(文件名, 路径, stat结果), ...]，只对图片文件调用DirEntry.stat()。
+        """
+        dir_mtime = os.stat(dir_path).st_mtime
+        if not full and known_mtime == dir_mtime:
+            return dir_mtime, None, None, 0
+
+        subdirs = []
+        files = []
+        others = 0
+        with os.scandir(dir_path) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                        continue
+                except OSError:
+                    continue
+                if not entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                    others += 1
+                    continue
+                try:
+                    files.append((entry.name, entry.path, entry.stat()))
+                except OSError as e:
+                    files.append((entry.name, entry.path, e))
+        return dir_mtime, subdirs, files, others
+
+    def scan(self, status, full=False, workers=None):
+        """增量扫描图片目录，返回新增图片的绝对路径列表和变化统计
+
+        status为扫描状态字典（SCAN_STATUS），扫描过程中实时更新其中的计数。
+        full为True时忽略目录修改时间，重新读取所有目录。
+        目录只遍历一次：workers个线程并行读取目录（stat、scandir和图片文件的stat），
+        网络存储（NFS/SMB）上每次读取的延迟可以重叠；索引的读写都在调用线程中进行，
+        每处理COMMIT_EVERY个目录提交一次。不逐个文件输出日志，进度见status和每隔几秒的进度输出。
+        """
+        workers = workers or SCAN_WORKERS
+        with self.lock:
+            known_dirs = dict(self.conn.execute('SELECT path, mtime FROM dirs').fetchall())
+
+        added = []
+        removed = 0
+        changed_dirs = 0
+        large_files = 0
+        seen_dirs = set()
+        pending = {}
+        uncommitted = 0
+        last_report = time.monotonic()
+
+        def submit(dir_path):
+            # 跳过缩略图目录
+            if THUMBNAIL_FOLDER in dir_path:
+                logger.debug("跳过缩略图目录: %s", dir_path)
+                return
+            rel_dir = self.rel_path(dir_path)
+            future = executor.submit(self._read_dir, dir_path, known_dirs.get(rel_dir), full)
+            pending[future] = (dir_path, rel_dir)
+
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='scan') as executor:
+            submit(self.root)
+            while pending:
+                done, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+                for future in done:
+                    dir_path, rel_dir = pending.pop(future)
+                    try:
+                        dir_mtime, subdirs, files, others = future.result()
+                    except OSError as e:
+                        hot_logger.warning("读取目录出错 %s: %s", dir_path, e)
+                        # 目录还在（只是无法列举）时保留其中图片的索引，并沿用索引中的子目录继续扫描，
+                        # 否则子目录都会被当作已删除，其中的图片从索引中移除
+                        if os.path.isdir(dir_path):
+                            seen_dirs.add(rel_dir)
+                            with self.lock:
+                                subdirs = [self.full_path(row[0]) for row in self.conn.execute(
+                                    'SELECT path FROM dirs WHERE parent = ?', (rel_dir,)
+                                )]
+                            for subdir in subdirs:
+                                submit(subdir)
+                        continue
+
+                    seen_dirs.add(rel_dir)
+                    status["current_file"] = rel_dir or '/'
+
+                    # 目录未变化：沿用索引中的子目录和图片，不再列举和stat文件
+                    if subdirs is None:
+                        with self.lock:
+                            subdirs = [self.full_path(row[0]) for row in self.conn.execute(
+                                'SELECT path FROM dirs WHERE parent = ?', (rel_dir,)
+                            )]
+                            count, valid = self.conn.execute(
+                                'SELECT COUNT(*), COALESCE(SUM(size <= ?), 0) FROM images WHERE dir = ?',
+                                (MAX_IMAGE_SIZE, rel_dir)
+                            ).fetchone()
+                        for subdir in subdirs:
+                            submit(subdir)
+                        status["total_files"] += count
+                        status["processed_files"] += count
+                        status["valid_images"] += valid
+                        status["skipped_files"] += count - valid
+                        continue
+
+                    for subdir in subdirs:
+                        submit(subdir)
+                    changed_dirs += 1
+                    status["total_files"] += len(files) + others
+                    status["processed_files"] += len(files) + others
+
+                    with self.lock:
+                        indexed = {
+                            name: (size, mtime) for name, size, mtime in self.conn.execute(
+                                'SELECT name, size, mtime FROM images WHERE dir = ?', (rel_dir,)
+                            )
+                        }
+
+                    upserts = []
+                    present = set()
+                    for name, path, stat in files:
+                        if isinstance(stat, OSError):
+                            hot_logger.warning("读取文件出错 %s: %s", path, stat)
+                            status["skipped_files"] += 1
+                            continue
+
+                        present.add(name)
+                        if stat.st_size <= MAX_IMAGE_SIZE:
+                            status["valid_images"] += 1
+                        else:
+                            status["skipped_files"] += 1
+                            large_files += 1
+
+                        old = indexed.get(name)
+                        if old is None or old != (stat.st_size, stat.st_mtime):
+                            rel = f"{rel_dir}/{name}" if rel_dir else name
+                            upserts.append((rel, rel_dir, name, stat.st_size, stat.st_mtime, stat.st_ctime))
+                            if old is None and stat.st_size <= MAX_IMAGE_SIZE:
+                                added.append(path)
+
+                    stale = [(f"{rel_dir}/{name}" if rel_dir else name,) for name in indexed if name not in present]
+                    removed += len(stale)
+                    parent = None if dir_path == self.root else self.rel_path(os.path.dirname(dir_path))
+                    record_mtime = dir_mtime if time.time() - dir_mtime >= self.MTIME_SETTLE_SECONDS else None
+
+                    # 目录记录与其中的图片在同一个事务中写入
+                    with self.lock:
+                        self.conn.executemany(
+                            '''INSERT INTO images (path, dir, name, size, mtime, ctime) VALUES (?, ?, ?, ?, ?, ?)
+                               ON CONFLICT(path) DO UPDATE SET
+                                   size = excluded.size, mtime = excluded.mtime, ctime = excluded.ctime,
+                                   width = NULL, height = NULL, hash = NULL, preview = NULL, color = NULL''',
+                            upserts
+                        )
+                        self.conn.executemany('DELETE FROM images WHERE path = ?', stale)
+                        self.conn.execute('INSERT OR REPLACE INTO dirs (path, parent, mtime) VALUES (?, ?, ?)',
+                                          (rel_dir, parent, record_mtime))
+                        uncommitted += 1
+                        if uncommitted >= self.COMMIT_EVERY:
+                            self.conn.commit()
+                            uncommitted = 0
+
+                if time.monotonic() - last_report >= self.PROGRESS_INTERVAL:
+                    last_report = time.monotonic()
+                    logger.info("扫描进度: 目录 %s, 文件 %s, 有效图片 %s, 新增 %s",
+                                len(seen_dirs), status['processed_files'], status['valid_images'], len(added))
+
+        with self.lock:
+            self.conn.commit()
+
+        if large_files:
+            logger.info("跳过超过%sMB的大文件: %s 个", MAX_IMAGE_SIZE // (1024 * 1024), large_files)
+        # 清理已经不存在的目录
+        gone_dirs = [(path,) for path in known_dirs if path not in seen_dirs]
+        if gone_dirs:
+            with self.lock:
+                for (path,) in gone_dirs:
+                    removed += self.conn.execute('DELETE FROM images WHERE dir = ?', (path,)).rowcount
+                self.conn.executemany('DELETE FROM dirs WHERE path = ?', gone_dirs)
+                self.conn.commit()
+
+        return {
+            "added": added,
+            "removed": removed,
+            "changed_dirs": changed_dirs,
+            "total_dirs": len(seen_dirs)
+        }
+
+IMAGE_INDEX = ImageIndex(INDEX_DB_FILE, PHOTOS_FOLDER)
+
+class SharedState:
+    """多进程共享的小型状态，保存在通过mmap映射的文件中
+
+    文件头部是8字节的序号和4字节的数据长度，后面是JSON数据。写入时加文件锁，
+    写入前后各把序号加一（写入过程中序号为奇数）；读取时先比较序号，
+    序号没变就直接返回上次解析的结果，所以热路径上的读取只是一次内存访问。
+    写入的进程在两次更新序号之间被杀死时序号会停在奇数：持有文件锁时看到奇数序号说明没有进程在写入，
+    直接修复（数据不完整时清空）；读取方等待超过SPIN_LIMIT次后也改为加锁读取，不会一直等待。
+    gunicorn等多worker部署时，各进程通过它看到一致的当前图片和图片列表版本。
+    """
+
+    HEADER = struct.Struct('<QI')
+    CAPACITY = 64 * 1024
+    # 读取时等待其他进程写完的最大次数，超过后加锁读取
+    SPIN_LIMIT = 1000
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = Lock()
+        self._file = open(path, 'a+b')
+        with fileutil.file_lock(self._file):
+            if os.fstat(self._file.fileno()).st_size < self.CAPACITY:
+                self._file.truncate(self.CAPACITY)
+            self._mmap = mmap.mmap(self._file.fileno(), self.CAPACITY)
+            self._load_locked()
+        self._seq = None
+        self._data = {}
+
+    def _load_locked(self):
+        """持有文件锁时读取序号和数据，写入中断留下的奇数序号改回偶数，返回(序号, 数据)"""
+        seq, length = self.HEADER.unpack_from(self._mmap, 0)
+        try:
+            data = json.loads(self._mmap[self.HEADER.size:self.HEADER.size + length]) if length else {}
+        except ValueError:
+            data = None
+        if seq % 2 or data is None:
+            if data is None:
+                logger.warning("共享状态数据不完整（上次写入被中断），已清空")
+                data, length = {}, 0
+            else:
+                logger.warning("共享状态的上次写入被中断，已恢复")
+            seq = (seq | 1) + 1
+            self.HEADER.pack_into(self._mmap, 0, seq, length)
+        return seq, data
+
+    def _read(self):
+        """读取最新数据，序号未变化时直接返回缓存的结果"""
+        for _ in range(self.SPIN_LIMIT):
+            seq, length = self.HEADER.unpack_from(self._mmap, 0)
+            if seq == self._seq:
+                return self._data
+            if seq % 2:
+                # 其他进程正在写入
+                time.sleep(0)
+                continue
+            payload = self._mmap[self.HEADER.size:self.HEADER.size + length]
+            if self.HEADER.unpack_from(self._mmap, 0)[0] != seq:
+                continue
+            with self._lock:
+                self._data = json.loads(payload) if length else {}
+                self._seq = seq
+            return self._data
+        # 长时间处于写入状态，可能是写入的进程被杀死，加锁读取（必要时修复）
+        with self._lock, fileutil.file_lock(self._file):
+            self._seq, self._data = self._load_locked()
+        return self._data
+
+    def _modify(self, func):
+        """在锁内读取当前数据，用func修改后写回"""
+        with self._lock, fileutil.file_lock(self._file):
+            seq = self.HEADER.unpack_from(self._mmap, 0)[0]
+            if seq == self._seq:
+                # 本进程缓存的已是最新数据，复制一份修改即可，不需要重新解析JSON
+                data = dict(self._data)
+            else:
+                seq, data = self._load_locked()
+            func(data)
+            payload = json.dumps(data, ensure_ascii=False).encode('utf-8')
+            if self.HEADER.size + len(payload) > self.CAPACITY:
+                raise ValueError("共享状态数据过大")
+            length = self.HEADER.unpack_from(self._mmap, 0)[1]
+            self.HEADER.pack_into(self._mmap, 0, seq + 1, length)
+            self._mmap[self.HEADER.size:self.HEADER.size + len(payload)] = payload
+            self.HEADER.pack_into(self._mmap, 0, seq + 2, len(payload))
+            self._data = data
+            self._seq = seq + 2
+        return data
+
+    def get(self, key, default=None):
+        return self._read().get(key, default)
+
+    def update(self, **values):
+        """合并写入若干键值，返回写入后的完整数据"""
+        return self._modify(lambda data: data.update(values))
+
+    def increment(self, key, on_increment=None):
+        """原子地把整数键加一，返回新值
+
+        on_increment(新值)在持有锁、其他进程看到新值之前调用，用于先写入与新值对应的数据。
+        """
+        def apply(data):
+            data[key] = data.get(key, 0) + 1
+            if on_increment:
+                on_increment(data[key])
+        return self._modify(apply)[key]
+
+SHARED_STATE = SharedState(SHARED_STATE_FILE)
+
+class ThumbnailStore:
+    """按内容寻址的缩略图存储
+
+    缩略图以原图内容MD5、宽度和格式命名，保存在objects/<哈希前两位>/<哈希>_w<宽度>.<jpg|webp|avif>，
+    重复的照片、移动或改名后的图片共用同一组缩略图；原图修改后内容哈希变化，自然使用新的缩略图。
+    清单（manifest.db）记录每个缩略图的大小和最近访问时间，用于清理孤立缩略图和按磁盘预算淘汰。
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS thumbnails (
+            key TEXT PRIMARY KEY,
+            hash TEXT NOT NULL,
+            width INTEGER NOT NULL,
+            format TEXT NOT NULL DEFAULT 'jpeg',
+            bytes INTEGER NOT NULL,
+            created REAL NOT NULL,
+            last_access REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_thumbnails_hash ON thumbnails(hash);
+        CREATE INDEX IF NOT EXISTS idx_thumbnails_access ON thumbnails(last_access);
+    """
+
+    # 同一个缩略图的最近访问时间最多每隔该秒数写入一次清单
+    TOUCH_INTERVAL = 3600
+    # 新生成的缩略图在该时间内不会被当作孤立文件清理（原图可能还没扫描进索引）
+    GRACE_SECONDS = 3600
+    # 旧版本按原图路径保存的缩略图文件名
+    LEGACY_NAME = re.compile(r'_w\d+\.[A-Za-z]+$')
+    # 清理旧版本缩略图时跳过的子目录：缩略图存储本身和图片变体缓存
+    RESERVED_DIRS = ('objects', 'variants')
+
+    def __init__(self, root):
+        self.root = root
+        self.objects_dir = os.path.join(root, 'objects')
+        os.makedirs(self.objects_dir, exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(os.path.join(root, 'manifest.db'), check_same_thread=False)
+        self._touched = LRUCache(10000)
+        with self.lock:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            self.conn.executescript(self.SCHEMA)
+            columns = {row[1] for row in self.conn.execute('PRAGMA table_info(thumbnails)')}
+            if 'format' not in columns:
+                # 旧版本的清单只有JPEG缩略图，键不带扩展名
+                self.conn.execute("ALTER TABLE thumbnails ADD COLUMN format TEXT NOT NULL DEFAULT 'jpeg'")
+                self.conn.execute("UPDATE thumbnails SET key = key || '.jpg'")
+            self.conn.commit()
+
+    def path_for(self, content_hash, width, fmt='jpeg'):
+        """缩略图的存储路径"""
+        return thumbnailer.store_path(self.objects_dir, content_hash, width, fmt)
+
+    def record(self, content_hash, files):
+        """登记新生成的缩略图，files为[(宽度, 路径, 字节数), ...]，以文件名作为键"""
+        if not files:
+            return
+        now = time.time()
+        with self.lock:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO thumbnails (key, hash, width, format, bytes, created, last_access) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                [(os.path.basename(path), content_hash, width, thumbnailer.format_of(path), size, now, now)
+                 for width, path, size in files]
+            )
+            self.conn.commit()
+
+    def touch(self, content_hash, width, fmt='jpeg'):
+        """记录缩略图被访问，用于按最近访问时间淘汰"""
+        key = os.path.basename(self.path_for(content_hash, width, fmt))
+        now = time.time()
+        last = self._touched.get(key)
+        if last and now - last < self.TOUCH_INTERVAL:
+            return
+        self._touched.set(key, now)
+        with self.lock:
+            self.conn.execute('UPDATE thumbnails SET last_access = ? WHERE key = ?', (now, key))
+            self.conn.commit()
+
+    def total_bytes(self):
+        with self.lock:
+            return self.conn.execute('SELECT COALESCE(SUM(bytes), 0) FROM thumbnails').fetchone()[0]
+
+    def _remove_file(self, path):
+        try:
+            os.remove(path)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def gc(self, live_hashes, widths, formats=('jpeg',), budget_bytes=0):
+        """清理缩略图存储，返回各类清理的数量
+
+        1. 原图已不存在（内容哈希不在live_hashes中），或宽度、格式不在当前配置widths、formats中的缩略图
+        2. 存储目录中清单没有记录的文件：原图还在的补登记，否则删除
+        3. 旧版本按原图路径保存的缩略图（objects目录以外的*_w<宽度>.*文件）
+        4. 总大小超过budget_bytes时按最近访问时间淘汰，直到降到预算的90%
+        """
+        stats = {"orphans": 0, "adopted": 0, "legacy": 0, "evicted": 0, "freed_bytes": 0}
+        cutoff = time.time() - self.GRACE_SECONDS
+
+        with self.lock:
+            rows = self.conn.execute('SELECT key, hash, width, format, bytes, created FROM thumbnails').fetchall()
+        known = {row[0] for row in rows}
+        orphans = [row for row in rows
+                   if row[2] not in widths or row[3] not in formats or (row[1] not in live_hashes and row[5] < cutoff)]
+        for key, content_hash, width, fmt, size, _ in orphans:
+            self._remove_file(self.path_for(content_hash, width, fmt))
+            stats["orphans"] += 1
+            stats["freed_bytes"] += size
+        if orphans:
+            with self.lock:
+                self.conn.executemany('DELETE FROM thumbnails WHERE key = ?', [(row[0],) for row in orphans])
+                self.conn.commit()
+
+        adopted = []
+        for root, _, names in os.walk(self.objects_dir):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                if name in known or stat.st_mtime >= cutoff:
+                    continue
+                content_hash, _, width = os.path.splitext(name)[0].rpartition('_w')
+                if (thumbnailer.format_of(name) in formats and content_hash in live_hashes
+                        and width.isdigit() and int(width) in widths):
+                    adopted.append((content_hash, [(int(width), path, stat.st_size)]))
+                elif self._remove_file(path):
+                    # 未登记的孤立文件或写入中断留下的临时文件
+                    stats["orphans"] += 1
+                    stats["freed_bytes"] += stat.st_size
+        for content_hash, files in adopted:
+            self.record(content_hash, files)
+            stats["adopted"] += 1
+
+        for root, dirs, names in os.walk(self.root, topdown=False):
+            rel_root = os.path.relpath(root, self.root)
+            if rel_root.split(os.sep)[0] in self.RESERVED_DIRS:
+                continue
+            for name in names:
+                if self.LEGACY_NAME.search(name):
+                    path = os.path.join(root, name)
+                    try:
+                        size = os.stat(path).st_size
+                    except OSError:
+                        continue
+                    if self._remove_file(path):
+                        stats["legacy"] += 1
+                        stats["freed_bytes"] += size
+            if root != self.root:
+                try:
+                    os.rmdir(root)  # 只删除已经清空的目录
+                except OSError:
+                    pass
+
+        if budget_bytes:
+            total = self.total_bytes()
+            if total > budget_bytes:
+                target = budget_bytes * 0.9
+                with self.lock:
+                    rows = self.conn.execute(
+                        'SELECT key, hash, width, format, bytes FROM thumbnails ORDER BY last_access'
+                    ).fetchall()
+                evicted = []
+                for key, content_hash, width, fmt, size in rows:
+                    if total <= target:
+                        break
+                    self._remove_file(self.path_for(content_hash, width, fmt))
+                    evicted.append((key,))
+                    total -= size
+                    stats["freed_bytes"] += size
+                with self.lock:
+                    self.conn.executemany('DELETE FROM thumbnails WHERE key = ?', evicted)
+                    self.conn.commit()
+                stats["evicted"] = len(evicted)
+
+        return stats
+
+THUMBNAIL_STORE = ThumbnailStore(THUMBNAIL_FOLDER)
+
+def collect_thumbnail_garbage():
+    """清理孤立和不再使用的宽度、格式的缩略图，并把缩略图总大小控制在THUMBNAIL_DISK_BUDGET_MB以内"""
+    start_time = time.time()
+    try:
+        # 扫描发现文件变化或重建索引后哈希被清空，先补算，否则这些图片的缩略图会被当作孤立文件删除
+        live_hashes = IMAGE_INDEX.live_hashes()
+        for rel_path in IMAGE_INDEX.unhashed_paths():
+            full_path = IMAGE_INDEX.full_path(rel_path)
+            try:
+                live_hashes.add(get_content_hash(full_path, os.stat(full_path)))
+            except OSError:
+                continue
+        stats = THUMBNAIL_STORE.gc(live_hashes, THUMBNAIL_WIDTHS, THUMBNAIL_FORMATS,
+                                   THUMBNAIL_DISK_BUDGET_MB * 1024 * 1024)
+    except Exception as e:
+        logger.error("清理缩略图失败: %s", e)
+        return None
+    stats["variants_evicted"], variants_freed = VARIANT_CACHE.prune()
+    stats["freed_bytes"] += variants_freed
+    stats["total_bytes"] = THUMBNAIL_STORE.total_bytes()
+    stats["time"] = datetime.now().isoformat()
+    THUMBNAIL_STATUS["gc"] = stats
+    logger.info("缩略图清理完成: 孤立 %s, 旧版本 %s, 补登记 %s, 淘汰 %s, 图片变体淘汰 %s, "
+                "释放 %.1fMB, 当前共 %.1fMB, 用时 %.2f秒",
+                stats['orphans'], stats['legacy'], stats['adopted'], stats['evicted'], stats['variants_evicted'],
+                stats['freed_bytes'] / 1024 / 1024, stats['total_bytes'] / 1024 / 1024, time.time() - start_time)
+    return stats
+
+class VariantCache:
+    """按需缩放的原图变体（/image和/img/today的w/h/fit/format/q参数）的磁盘缓存
+
+    文件保存在<root>/<键前两位>/<键>.<扩展名>，键由原图路径、版本和缩放参数决定，原图修改后自然不再命中。
+    文件的修改时间作为最近访问时间（命中时更新），总大小超过上限时删除最久未访问的文件；
+    多个进程共用同一个目录，不需要额外的清单。
+    """
+
+    # 同一个文件的访问时间最多每隔该秒数更新一次
+    TOUCH_INTERVAL = 3600
+
+    def __init__(self, root, budget_bytes=0):
+        self.root = root
+        self.budget_bytes = budget_bytes
+        self.lock = threading.Lock()
+        self._written = 0
+        self._touched = LRUCache(10000)
+
+    def key_for(self, rel_path, version, params):
+        """原图路径、版本和缩放参数对应的缓存键"""
+        raw = json.dumps([rel_path, version, params], sort_keys=True)
+        return hashlib.md5(raw.encode('utf-8')).hexdigest()
+
+    def path_for(self, key, fmt):
+        return os.path.join(self.root, key[:2], key + thumbnailer.FORMATS[fmt]['ext'])
+
+    def touch(self, path):
+        """记录变体被访问，用于按最近访问时间淘汰"""
+        now = time.time()
+        last = self._touched.get(path)
+        if last and now - last < self.TOUCH_INTERVAL:
+            return
+        self._touched.set(path, now)
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def added(self, size):
+        """记录新写入的变体，本进程写入的总量超过上限的10%时清理一次"""
+        if not self.budget_bytes:
+            return
+        with self.lock:
+            self._written += size
+            if self._written < self.budget_bytes * 0.1:
+                return
+            self._written = 0
+        self.prune()
+
+    def prune(self):
+        """总大小超过上限时按最近访问时间删除，直到降到上限的90%，返回(删除数量, 释放字节数)"""
+        if not self.budget_bytes:
+            return 0, 0
+        files = []
+        total = 0
+        for root, _, names in os.walk(self.root):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+
+        removed = freed = 0
+        if total > self.budget_bytes:
+            target = self.budget_bytes * 0.9
+            for _, size, path in sorted(files):
+                if total <= target:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+                removed += 1
+                freed += size
+        return removed, freed
+
+VARIANT_CACHE = VariantCache(os.path.join(THUMBNAIL_FOLDER, 'variants'), VARIANT_CACHE_MB * 1024 * 1024)
+# 图片变体在独立的线程池中处理（Pillow解码、缩放和编码时释放GIL），不占用缩略图进程池，
+# 也不会因为后台批量生成缩略图而排队；等待处理的数量超过VARIANT_SLOTS时直接返回503
+VARIANT_EXECUTOR = ThreadPoolExecutor(max_workers=VARIANT_WORKERS, thread_name_prefix='variant')
+VARIANT_SLOTS = threading.BoundedSemaphore(VARIANT_WORKERS * 4)
+VARIANT_FLIGHTS = SingleFlight()  # 按变体合并同时到达的相同请求
+VARIANT_FORMATS = tuple(thumbnailer.available_formats())
+
+class VariantBusyError(Exception):
+    """同时处理的图片变体已达上限"""
+
+THUMBNAIL_EXECUTOR = None
+THUMBNAIL_FLIGHTS = SingleFlight()  # 按缩略图合并按需生成请求
+THUMBNAIL_EXECUTOR_LOCK = threading.Lock()
+
+def get_thumbnail_executor():
+    """获取缩略图进程池，首次使用时创建，之后一直复用
+
+    使用spawn方式启动子进程：当前进程里有调度器、文件监控等线程，fork后子进程可能卡在它们持有的锁上。
+    任务函数在thumbnailer中，子进程按模块名导入thumbnailer即可运行；但spawn还会在子进程中重新执行主模块：
+    通过gunicorn/wsgi.py启动时主模块是启动脚本，不会导入app；直接运行python app.py时主模块就是本文件，
+    每个子进程都会以__mp_main__的名义完整执行一次模块级代码（打开索引和共享状态、启动日志线程等，
+    不会启动后台任务），只增加子进程的启动时间和少量资源占用，生产环境请使用wsgi.py。
+    """
+    global THUMBNAIL_EXECUTOR
+    with THUMBNAIL_EXECUTOR_LOCK:
+        if THUMBNAIL_EXECUTOR is None:
+            THUMBNAIL_EXECUTOR = ProcessPoolExecutor(
+                max_workers=THUMBNAIL_WORKERS,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+        return THUMBNAIL_EXECUTOR
+
+def reset_thumbnail_executor():
+    """子进程异常退出后进程池不可再用，丢弃它，下次使用时重新创建"""
+    global THUMBNAIL_EXECUTOR
+    with THUMBNAIL_EXECUTOR_LOCK:
+        if THUMBNAIL_EXECUTOR is not None:
+            THUMBNAIL_EXECUTOR.shutdown(wait=False)
+            THUMBNAIL_EXECUTOR = None
+
+def preview_from_store(content_hash):
+    """由缩略图存储中最小宽度的JPEG缩略图生成内嵌预览，返回(预览, 主色调)，缩略图不存在时返回(None, None)"""
+    if not PREVIEW_SIZE:
+        return None, None
+    thumb_path = THUMBNAIL_STORE.path_for(content_hash, THUMBNAIL_WIDTHS[0])
+    try:
+        return thumbnailer.preview_from_file(thumb_path, PREVIEW_SIZE)
+    except FileNotFoundError:
+        return None, None
+    except Exception as e:
+        hot_logger.warning("生成预览失败 %s: %s", thumb_path, e)
+        return None, None
+
+def generate_thumbnails_for_images(image_paths):
+    """在进程池中为图片列表生成缩略图
+
+    每张原图只解码一次，各个宽度从大到小逐级缩放；
+    同时提交的任务数量有上限，避免一次性为整个图库创建任务。
+    """
     global THUMBNAIL_STATUS
     
-    print(f"开始生成缩略图，共 {len(image_paths)} 张图片")
+    total = len(image_paths)
+    logger.info("开始生成缩略图，共 %s 张图片，使用 %s 个进程", total, THUMBNAIL_WORKERS)
     processed = 0
-    lock = threading.Lock()
+    generated = 0
+    failed = 0
+    timings = {"decode": 0.0, "resize": 0.0, "save": 0.0}
     
     # 更新状态
     THUMBNAIL_STATUS["is_generating"] = True
-    THUMBNAIL_STATUS["total"] = len(image_paths)
+    THUMBNAIL_STATUS["total"] = total
     THUMBNAIL_STATUS["processed"] = 0
+    THUMBNAIL_STATUS["generated"] = 0
+    THUMBNAIL_STATUS["failed"] = 0
+    THUMBNAIL_STATUS["workers"] = THUMBNAIL_WORKERS
+    THUMBNAIL_STATUS["timings"] = dict(timings)
     THUMBNAIL_STATUS["start_time"] = datetime.now()
     
-    def process_image(img_path):
-        nonlocal processed
+    def report(img_path):
+        THUMBNAIL_STATUS["processed"] = processed
+        THUMBNAIL_STATUS["generated"] = generated
+        THUMBNAIL_STATUS["failed"] = failed
+        THUMBNAIL_STATUS["current_file"] = os.path.basename(img_path)
+        THUMBNAIL_STATUS["timings"] = {stage: round(seconds, 3) for stage, seconds in timings.items()}
+        if processed % 10 == 0 or processed == total:
+            logger.info("缩略图生成进度: %s/%s", processed, total)
+    
+    def collect(future):
+        nonlocal processed, generated, failed
+        img_path = pending.pop(future)
+        processed += 1
         try:
-            # 更新当前处理的文件
-            with lock:
-                THUMBNAIL_STATUS["current_file"] = os.path.basename(img_path)
-            
-            # 获取相对路径
-            rel_path = os.path.relpath(img_path, PHOTOS_FOLDER).replace('\\', '/')
-            
-            # 计算缩略图路径
-            rel_dir = os.path.dirname(rel_path)
-            thumb_dir = os.path.join(THUMBNAIL_FOLDER, rel_dir)
-            os.makedirs(thumb_dir, exist_ok=True)
-            
-            # 使用多种尺寸
-            for width in [200, 400, 800]:
-                filename = os.path.basename(img_path)
-                name, ext = os.path.splitext(filename)
-                thumb_name = f"{name}_w{width}{ext}"
-                thumb_path = os.path.join(thumb_dir, thumb_name)
-                
-                # 如果缩略图不存在，则创建
-                if not os.path.exists(thumb_path):
-                    with Image.open(img_path) as img:
-                        # 保持原始比例
-                        wpercent = (width / float(img.size[0]))
-                        height = int((float(img.size[1]) * float(wpercent)))
-                        
-                        # 处理透明图片
-                        if img.mode == 'RGBA':
-                            background = Image.new('RGB', img.size, (255, 255, 255))
-                            background.paste(img, mask=img.split()[3])
-                            img = background
-                        
-                        # 调整大小
-                        img_resized = img.resize((width, height), Image.LANCZOS)
-                        
-                        # 保存缩略图
-                        img_resized.save(thumb_path, "JPEG", quality=85, optimize=True)
-            
-            with lock:
-                processed += 1
-                THUMBNAIL_STATUS["processed"] = processed
-                if processed % 10 == 0 or processed == len(image_paths):
-                    print(f"缩略图生成进度: {processed}/{len(image_paths)}")
-                    
+            stats = future.result()
+            # 登记缩略图，顺便把读取原图时计算的内容哈希保存到索引
+            THUMBNAIL_STORE.record(stats["hash"], stats["files"])
+            rel_path = IMAGE_INDEX.rel_path(img_path)
+            IMAGE_INDEX.set_hash(rel_path, stats["hash"], stats["size"], stats["mtime"])
+            if stats["preview"]:
+                # 解码原图时顺便生成的内嵌预览，列出图片时不需要再次解码
+                IMAGE_INDEX.set_previews_many([(rel_path, *stats["preview"], stats["mtime"])])
+            generated += stats["generated"]
+            for stage in timings:
+                timings[stage] += stats[stage]
+                METRICS.inc('thumbnail_stage_seconds_total', stats[stage], stage=stage)
+            if stats["generated"]:
+                METRICS.observe('thumbnail_generate_seconds', sum(stats[stage] for stage in timings),
+                                source='background')
+        except BrokenProcessPool:
+            failed += 1
+            reset_thumbnail_executor()
+            hot_logger.warning("生成缩略图失败 %s: 缩略图进程异常退出", img_path)
         except Exception as e:
-            print(f"生成缩略图失败 {img_path}: {str(e)}")
+            failed += 1
+            hot_logger.warning("生成缩略图失败 %s: %s", img_path, e)
+        report(img_path)
     
-    # 使用线程池限制并发
-    with ThreadPoolExecutor(max_workers=max_concurrent) as executor:
-        executor.map(process_image, image_paths)
+    def submit(img_path):
+        """提交生成任务，进程池因子进程异常退出而不可用时重新创建后再提交一次"""
+        task = (thumbnailer.generate_to_store, img_path, THUMBNAIL_STORE.objects_dir, THUMBNAIL_WIDTHS, 85,
+                THUMBNAIL_FORMATS, PREVIEW_SIZE)
+        try:
+            return get_thumbnail_executor().submit(*task)
+        except BrokenProcessPool:
+            reset_thumbnail_executor()
+            return get_thumbnail_executor().submit(*task)
+    
+    pending = {}
+    max_pending = THUMBNAIL_WORKERS * 4
+    indexed_images = IMAGE_INDEX.get_images_many(IMAGE_INDEX.rel_path(img_path) for img_path in image_paths)
+    preview_updates = []
+    for img_path in image_paths:
+        # 已知内容哈希且各个宽度、格式的缩略图都已存在时（如重复的照片）不需要提交任务
+        try:
+            content_hash = get_content_hash(img_path, os.stat(img_path), compute=False)
+        except OSError:
+            content_hash = None
+        if content_hash and all(os.path.exists(THUMBNAIL_STORE.path_for(content_hash, width, fmt))
+                                for width in THUMBNAIL_WIDTHS for fmt in THUMBNAIL_FORMATS):
+            # 缩略图已存在但索引中还没有内嵌预览（如升级前生成的缩略图），由最小的缩略图补上
+            rel_path = IMAGE_INDEX.rel_path(img_path)
+            indexed = indexed_images.get(rel_path)
+            if PREVIEW_SIZE and indexed and not indexed["preview"]:
+                preview, color = preview_from_store(content_hash)
+                if preview:
+                    preview_updates.append((rel_path, preview, color, indexed["mtime"]))
+                if len(preview_updates) >= 500:
+                    IMAGE_INDEX.set_previews_many(preview_updates)
+                    preview_updates = []
+            processed += 1
+            report(img_path)
+            continue
+        
+        try:
+            future = submit(img_path)
+        except RuntimeError:
+            # 解释器退出时进程池已关闭，不再提交新任务
+            logger.warning("缩略图进程池已关闭，停止生成缩略图")
+            break
+        pending[future] = img_path
+        
+        if len(pending) >= max_pending:
+            done, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+            for future in done:
+                collect(future)
+    
+    for future in as_completed(list(pending)):
+        collect(future)
+    if preview_updates:
+        IMAGE_INDEX.set_previews_many(preview_updates)
     
     # 更新状态为完成
     THUMBNAIL_STATUS["is_generating"] = False
     THUMBNAIL_STATUS["current_file"] = ""
     
-    print(f"缩略图生成完成，处理了 {processed} 张图片")
+    logger.info("缩略图生成完成，处理了 %s 张图片，生成 %s 个缩略图，失败 %s 张，"
+                "耗时 解码 %.2f秒 / 缩放 %.2f秒 / 保存 %.2f秒",
+                processed, generated, failed, timings['decode'], timings['resize'], timings['save'])
 
-def get_all_images(directory):
-    """递归获取目录下所有图片文件"""
+def get_all_images(directory, full=False):
+    """递归获取目录下所有图片文件
+
+    基于持久化索引增量扫描，只重新读取修改时间变化的目录；full为True时强制完整扫描。
+    """
     global SCAN_STATUS
     SCAN_STATUS["is_scanning"] = True
     SCAN_STATUS["start_time"] = datetime.now()
@@ -303,262 +1893,573 @@ def get_all_images(directory):
     SCAN_STATUS["skipped_files"] = 0
     
     start_time = SCAN_STATUS["start_time"]
-    images = []
-    print(f"\n[{start_time}] 开始扫描图片目录: {directory}")
-    
-    # 先统计总文件数，排除缩略图目录
-    for root, _, files in os.walk(directory):
-        # 跳过缩略图目录
-        if THUMBNAIL_FOLDER in root:
-            print(f"跳过缩略图目录: {root}")
-            continue
-            
-        SCAN_STATUS["total_files"] += len(files)
+    logger.info("开始扫描图片目录: %s (%s)", directory, '完整扫描' if full else '增量扫描')
     
-    # 然后处理文件，同样排除缩略图目录
-    for root, _, files in os.walk(directory):
-        # 跳过缩略图目录
-        if THUMBNAIL_FOLDER in root:
-            continue
-            
-        for f in files:
-            SCAN_STATUS["processed_files"] += 1
-            SCAN_STATUS["current_file"] = f
-            
-            if f.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.bmp')):
-                file_path = os.path.join(root, f)
-                try:
-                    file_size = os.path.getsize(file_path) / (1024 * 1024)  # MB
-                    if file_size <= 50:  # 限制50MB
-                        images.append(file_path)
-                        SCAN_STATUS["valid_images"] += 1
-                        print(f"添加文件: {f} ({file_size:.1f}MB)")
-                    else:
-                        SCAN_STATUS["skipped_files"] += 1
-                        print(f"跳过大文件: {f} ({file_size:.1f}MB)")
-                except Exception as e:
-                    print(f"读取文件出错 {f}: {str(e)}")
-                    SCAN_STATUS["skipped_files"] += 1
+    try:
+        result = IMAGE_INDEX.scan(SCAN_STATUS, full=full)
+        images = IMAGE_INDEX.load_images()
+    finally:
+        SCAN_STATUS["is_scanning"] = False
+        SCAN_STATUS["current_file"] = ""
     
     end_time = datetime.now()
     duration = (end_time - start_time).total_seconds()
-    print(f"\n扫描完成统计:")
-    print(f"- 总文件数: {SCAN_STATUS['total_files']}")
-    print(f"- 有效图片: {SCAN_STATUS['valid_images']}")
-    print(f"- 跳过文件: {SCAN_STATUS['skipped_files']}")
-    print(f"- 扫描用时: {duration:.2f}秒")
+    METRICS.inc('scans_total', mode='full' if full else 'incremental')
+    METRICS.set('scan_duration_seconds', duration)
+    METRICS.set('scan_last_timestamp_seconds', end_time.timestamp())
+    logger.info("扫描完成: 总文件数 %s, 有效图片 %s, 跳过文件 %s, 新增图片 %s, 移除图片 %s, "
+                "重新读取目录 %s/%s, 用时 %.2f秒",
+                SCAN_STATUS['total_files'], SCAN_STATUS['valid_images'], SCAN_STATUS['skipped_files'],
+                len(result['added']), result['removed'], result['changed_dirs'], result['total_dirs'], duration)
     
-    SCAN_STATUS["is_scanning"] = False
-    
-    # 在后台启动缩略图生成任务
-    if images:
-        print("启动后台缩略图生成任务...")
-        import threading
+    # 在后台为新增图片启动缩略图生成任务
+    if result['added']:
+        logger.info("启动后台缩略图生成任务...")
         thumbnail_thread = threading.Thread(
             target=generate_thumbnails_for_images,
-            args=(images,),
+            args=(result['added'],),
             daemon=True
         )
         thumbnail_thread.start()
     
     return images
 
+def get_images():
+    """获取当前图片列表快照
+
+    多进程部署时，如果其他进程更新了图片列表（共享版本号变化），按索引中的变化日志增量更新，
+    已经生成的目录树也随之增量更新；日志不完整或落后太多时才从索引重新加载完整列表。
+    """
+    global CACHED_IMAGES, IMAGES_GENERATION
+    generation = SHARED_STATE.get('images_generation', 0)
+    if generation != IMAGES_GENERATION and lock.acquire(blocking=False):
+        try:
+            generation = SHARED_STATE.get('images_generation', 0)
+            if generation != IMAGES_GENERATION:
+                changes = IMAGE_INDEX.load_changes(IMAGES_GENERATION, generation)
+                if changes is None:
+                    CACHED_IMAGES = ImageSet(IMAGE_INDEX.load_images())
+                else:
+                    CACHED_IMAGES = CACHED_IMAGES.updated(*changes)
+                IMAGES_GENERATION = generation
+        finally:
+            lock.release()
+    return CACHED_IMAGES
+
+def publish_images(images, added=None, removed=None):
+    """替换图片列表快照并通知其他进程更新（调用方需持有写锁）
+
+    added/removed为相对上一快照新增和移除的图片，先记录到索引的变化日志再增加共享版本号，
+    其他进程看到新版本号时日志已经写好；不提供时其他进程重新加载完整列表。
+    """
+    global CACHED_IMAGES, IMAGES_GENERATION
+
+    def record(generation):
+        try:
+            IMAGE_INDEX.record_changes(generation, added, removed)
+        except sqlite3.Error as e:
+            logger.warning("记录图片列表变化失败，其他进程将重新加载完整列表: %s", e)
+
+    CACHED_IMAGES = images
+    IMAGES_GENERATION = SHARED_STATE.increment('images_generation', on_increment=record)
+
+def get_current_image():
+    """获取当前图片信息，多进程部署时以共享状态中的为准（本进程有还没写入的更新时以本进程的为准）"""
+    global CURRENT_IMAGE, _CURRENT_IMAGE_SOURCE
+    if _CURRENT_IMAGE_PENDING:
+        return CURRENT_IMAGE
+    shared = SHARED_STATE.get('current_image')
+    if shared is not None and shared is not _CURRENT_IMAGE_SOURCE:
+        CURRENT_IMAGE = {
+            'path': shared['path'],
+            'update_time': datetime.fromtimestamp(shared['update_time']),
+            'info': shared.get('info')
+        }
+        _CURRENT_IMAGE_SOURCE = shared
+    return CURRENT_IMAGE
+
+def set_current_image(path, update_time, info=None, defer=False):
+    """设置当前图片并同步给其他进程
+
+    defer为True时只更新本进程的当前图片，由后台线程写入共享状态：写入需要加跨进程文件锁，
+    /img/today从预选图片池取图时不在请求线程中等待，连续多次设置时只写入最后一张。
+    """
+    global CURRENT_IMAGE, _CURRENT_IMAGE_PENDING, _current_image_publishing
+    current = {'path': path, 'update_time': update_time, 'info': info}
+    with _current_image_lock:
+        CURRENT_IMAGE = current
+        _CURRENT_IMAGE_PENDING = True
+        start_publisher = defer and not _current_image_publishing
+        if start_publisher:
+            _current_image_publishing = True
+    if not defer:
+        _publish_current_image()
+    elif start_publisher:
+        threading.Thread(target=_publish_pending_current_image, daemon=True).start()
+    return current
+
+def _publish_current_image():
+    """把本进程最新的当前图片写入共享状态，写入按顺序进行，共享状态中总是最后设置的图片"""
+    global _CURRENT_IMAGE_SOURCE, _CURRENT_IMAGE_PENDING
+    with _current_image_write_lock:
+        current = CURRENT_IMAGE
+        data = SHARED_STATE.update(current_image={
+            'path': current['path'],
+            'update_time': current['update_time'].timestamp(),
+            'info': current['info']
+        })
+        with _current_image_lock:
+            if CURRENT_IMAGE is current:
+                _CURRENT_IMAGE_SOURCE = data['current_image']
+                _CURRENT_IMAGE_PENDING = False
+
+def _publish_pending_current_image():
+    global _current_image_publishing
+    try:
+        while True:
+            # 在锁内判断是否结束，结束后设置的图片会启动新的写入线程
+            with _current_image_lock:
+                if not _CURRENT_IMAGE_PENDING:
+                    _current_image_publishing = False
+                    return
+            _publish_current_image()
+    except Exception as e:
+        logger.warning("同步当前图片失败: %s", e)
+        with _current_image_lock:
+            _current_image_publishing = False
+
+def rescan_images(full=False):
+    """扫描图片目录并更新缓存的图片列表"""
+    global LAST_SCAN_TIME
+    # 扫描期间持有写锁，文件监控的变化会在扫描完成后应用到新快照上
+    with lock:
+        images = get_all_images(PHOTOS_FOLDER, full=full)
+        snapshot = ImageSet(images)
+        previous = set(CACHED_IMAGES)
+        current = set(snapshot)
+        publish_images(snapshot, added=current - previous, removed=previous - current)
+    LAST_SCAN_TIME = datetime.now()
+    return images
+
+def discard_images(paths):
+    """从图片列表中移除失效的图片
+
+    如果正在扫描（写锁被占用）则跳过，扫描完成后会得到最新的列表，避免阻塞请求。
+    """
+    if not lock.acquire(blocking=False):
+        return False
+    try:
+        for path in paths:
+            IMAGE_INDEX.refresh_file(path)
+        removed = [path for path in paths if path in CACHED_IMAGES]
+        publish_images(CACHED_IMAGES.updated(removed=removed), added=(), removed=removed)
+    finally:
+        lock.release()
+    return True
+
+def select_random_image(verbose=True):
+    """按文件夹设置从图片列表中随机选择一张并校验
+
+    返回(图片路径, 文件信息)，没有可用图片或选中的文件失效时返回None。
+    """
+    # 取得当前图片列表快照，之后的操作都基于这个快照
+    images = get_images()
+
+    # 如果没有缓存，返回错误
+    if not images:
+        hot_logger.warning("没有缓存的图片列表，请先扫描目录")
+        return None
+    
+    # 读取文件夹设置（内存中的配置，不读取文件）
+    folder_path = CONFIG.folder_path()
+    
+    # 过滤图片列表
+    filtered_images = images
+    if folder_path:
+        folder_full_path = os.path.join(PHOTOS_FOLDER, folder_path)
+        filtered_images = images.folder_view(folder_full_path)
+        
+        if not filtered_images:
+            hot_logger.warning("所选文件夹 '%s' 中没有图片，使用全部图片列表", folder_path)
+            filtered_images = images
+        elif verbose:
+            logger.debug("已过滤图片列表，从 %s 张缩小到 %s 张", len(images), len(filtered_images))
+    elif verbose:
+        logger.debug("使用全部图片列表 (共 %s 个)", len(filtered_images))
+    
+    # 选择新图片
+    old_image = get_current_image().get('path')
+    max_attempts = 5
+    attempts = 0
+    
+    while attempts < max_attempts:
+        selected_image = random.choice(filtered_images)
+        if selected_image != old_image or len(filtered_images) == 1:
+            break
+        attempts += 1
+        if verbose:
+            logger.debug("尝试选择不同的图片 (尝试 %s/%s)", attempts, max_attempts)
+    
+    if verbose:
+        logger.debug("选中图片: %s", selected_image)
+    
+    # 验证文件
+    if not os.path.isfile(selected_image):
+        hot_logger.warning("文件不存在，从缓存中移除: %s", selected_image)
+        discard_images([selected_image])
+        return None
+        
+    try:
+        # 测试文件可读性
+        with open(selected_image, 'rb') as f:
+            f.read(1)
+        if verbose:
+            logger.debug("文件可以正常读取")
+    except Exception as e:
+        hot_logger.warning("文件无法读取: %s", e)
+        discard_images([selected_image])
+        return None
+    
+    return selected_image, get_file_info(selected_image)
+
 def scheduled_refresh():
     """定时刷新图片"""
-    global CACHED_IMAGES, LAST_SCAN_TIME
-    
-    with lock:
-        try:
-            start_time = datetime.now()
-            print(f"\n[{start_time}] 开始刷新图片...")
+    try:
+        start_time = datetime.now()
+        logger.debug("开始刷新图片...")
 
-            # 如果没有缓存，返回错误
-            if not CACHED_IMAGES:
-                print("没有缓存的图片列表，请先扫描目录")
-                return
-            
-            # 读取文件夹设置
-            folder_path = ""
-            try:
-                with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
-                    config = json.load(f)
-                folder_path = config.get('folderPath', '')
-            except Exception as e:
-                print(f"读取文件夹配置失败: {str(e)}")
-            
-            # 过滤图片列表
-            filtered_images = CACHED_IMAGES
-            if folder_path:
-                folder_full_path = os.path.join(PHOTOS_FOLDER, folder_path)
-                folder_full_path = os.path.normpath(folder_full_path)
-                filtered_images = [img for img in CACHED_IMAGES 
-                                 if os.path.normpath(img).startswith(folder_full_path)]
-                
-                if not filtered_images:
-                    print(f"所选文件夹 '{folder_path}' 中没有图片，使用全部图片列表")
-                    filtered_images = CACHED_IMAGES
-                else:
-                    print(f"已过滤图片列表，从 {len(CACHED_IMAGES)} 张缩小到 {len(filtered_images)} 张")
-            else:
-                print(f"使用全部图片列表 (共 {len(filtered_images)} 个)")
-            
-            # 选择新图片
-            old_image = CURRENT_IMAGE.get('path')
-            max_attempts = 5
-            attempts = 0
-            
-            while attempts < max_attempts:
-                selected_image = random.choice(filtered_images)
-                if selected_image != old_image or len(filtered_images) == 1:
-                    break
-                attempts += 1
-                print(f"尝试选择不同的图片 (尝试 {attempts}/{max_attempts})")
-            
-            print(f"选中图片: {selected_image}")
+        selected = select_random_image()
+        if not selected:
+            return
+        selected_image, file_info = selected
             
-            # 验证文件
-            if not os.path.isfile(selected_image):
-                print(f"文件不存在，从缓存中移除: {selected_image}")
-                CACHED_IMAGES.remove(selected_image)
-                return
-                
-            try:
-                # 测试文件可读性
-                with open(selected_image, 'rb') as f:
-                    f.read(1)
-                print("文件可以正常读取")
-            except Exception as e:
-                print(f"文件无法读取: {str(e)}")
-                CACHED_IMAGES.remove(selected_image)
+        set_current_image(selected_image, start_time, file_info)
+        
+        end_time = datetime.now()
+        duration = (end_time - start_time).total_seconds()
+        file_size = file_info['size'] / (1024 * 1024)
+        hot_logger.info("刷新完成: %s (%.1fMB), 用时 %.2f秒", os.path.basename(selected_image), file_size, duration)
+        
+    except Exception as e:
+        hot_logger.exception("刷新图片时发生错误: %s", e)
+
+class TodayImagePool:
+    """/img/today的预选图片池
+
+    后台线程预先选好若干张图片，完成文件校验并准备好响应头（类型、长度和内容ETag），
+    请求到来时直接取出下一张，不再在请求线程中读取配置、筛选列表、校验文件和计算ETag，
+    响应由send()直接打开文件生成，不再经过send_file的stat和条件请求处理。
+    池中剩余数量低于一半时自动在后台补充；size为0时不启用。
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._entries = deque()
+        self._lock = Lock()
+        self._refilling = False
+        self._generation = 0
+
+    def pop(self):
+        """取出下一张预选图片，池为空时返回None"""
+        try:
+            entry = self._entries.popleft()
+        except IndexError:
+            entry = None
+        if entry and entry['folder'] != CONFIG.folder_path():
+            # 其他进程修改了文件夹设置，池中的图片都是按旧设置选出的
+            self.clear()
+            entry = None
+        if len(self._entries) < self.size // 2 + 1:
+            self._schedule_refill()
+        return entry
+
+    @staticmethod
+    def send(entry):
+        """用预先准备的响应头直接返回预选图片
+
+        打开文件后只用fstat确认文件在预选之后没有被修改，修改过时返回None，由调用方按普通方式处理；
+        文件已被删除时抛出FileNotFoundError。
+        """
+        f = open(entry['path'], 'rb')
+        stat = os.fstat(f.fileno())
+        if stat.st_size != entry['info']['size'] or stat.st_mtime != entry['info']['mtime']:
+            f.close()
+            return None
+        return Response(wrap_file(request.environ, f), headers=entry['headers'], direct_passthrough=True)
+
+    def clear(self):
+        """清空图片池（文件夹设置或图片列表变化后调用）"""
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+    def _schedule_refill(self):
+        with self._lock:
+            if self._refilling or self.size <= 0:
                 return
-                
-            CURRENT_IMAGE['path'] = selected_image
-            CURRENT_IMAGE['update_time'] = start_time
-            CURRENT_IMAGE['info'] = get_file_info(selected_image)
-            
-            end_time = datetime.now()
-            duration = (end_time - start_time).total_seconds()
-            file_size = os.path.getsize(selected_image) / (1024 * 1024)
-            print(f"\n刷新完成:")
-            print(f"- 新图片: {os.path.basename(selected_image)}")
-            print(f"- 文件大小: {file_size:.1f}MB")
-            print(f"- 总用时: {duration:.2f}秒")
-            
+            self._refilling = True
+        threading.Thread(target=self._refill, daemon=True).start()
+
+    def _refill(self):
+        try:
+            generation = self._generation
+            failures = 0
+            while len(self._entries) < self.size and failures < self.size:
+                folder = CONFIG.folder_path()
+                selected = select_random_image(verbose=False)
+                if not selected:
+                    failures += 1
+                    continue
+                path, info = selected
+                entry = {
+                    'path': path,
+                    'info': info,
+                    'headers': {
+                        'Content-Type': mimetypes.guess_type(path)[0] or 'application/octet-stream',
+                        'Content-Length': str(info['size']),
+                    },
+                    'format': os.path.splitext(path)[1][1:],
+                    'folder': folder
+                }
+                with self._lock:
+                    # 填充期间图片池被清空过，丢弃按旧设置选出的图片
+                    if generation != self._generation:
+                        generation = self._generation
+                        continue
+                    self._entries.append(entry)
         except Exception as e:
-            print(f"刷新图片时发生错误: {str(e)}")
-            import traceback
-            print(traceback.format_exc())
+            logger.warning("补充预选图片失败: %s", e)
+        finally:
+            with self._lock:
+                self._refilling = False
+
+TODAY_POOL = TodayImagePool(TODAY_POOL_SIZE)
 
-# 初始化调度器
+# 初始化调度器（由负责后台任务的进程在start_background_services中启动）
 scheduler = BackgroundScheduler(daemon=True, timezone='Asia/Shanghai')
-scheduler.start()
+
+def get_job_next_run(job):
+    """获取任务的下次执行时间，调度器不在本进程运行时根据触发器计算"""
+    if job is None:
+        return None
+    next_run = getattr(job, 'next_run_time', None)
+    if next_run is None and not scheduler.running:
+        next_run = job.trigger.get_next_fire_time(None, datetime.now(scheduler.timezone))
+    return next_run
+
+def sync_schedule():
+    """其他进程保存了新的cron设置时，更新本进程调度器中的刷新任务"""
+    global cron_exp
+    new_cron = CONFIG.cron()
+    if new_cron == cron_exp:
+        return
+    try:
+        scheduler.reschedule_job('refresh_task', trigger='cron', **parse_cron(new_cron))
+        cron_exp = new_cron
+        logger.info("已同步定时刷新任务: %s", new_cron)
+    except Exception as e:
+        logger.error("同步定时刷新任务失败: %s", e)
 
 # 添加定时扫描任务（每30分钟扫描一次）
 try:
     scan_job = scheduler.add_job(
-        get_all_images, 
+        rescan_images, 
         'interval', 
         minutes=30,
-        id='scan_task',
-        args=[PHOTOS_FOLDER],
-        next_run_time=None  # 不立即执行，因为启动时已经执行过了
+        id='scan_task'
     )
-    print("已设置目录扫描任务: 每30分钟")
-    if scan_job and scan_job.next_run_time:
-        print(f"下次扫描时间: {scan_job.next_run_time}")
+    logger.info("已设置目录扫描任务: 每30分钟")
 except Exception as e:
-    print(f"设置扫描任务失败: {str(e)}")
+    logger.error("设置扫描任务失败: %s", e)
 
 # 解析当前的cron表达式（原有的刷新任务）
 try:
     cron_dict = parse_cron(cron_exp)
     job = scheduler.add_job(scheduled_refresh, 'cron', id='refresh_task', **cron_dict)
-    print(f"已设置定时刷新任务: {cron_exp}")
-    if job and job.next_run_time:
-        print(f"下次刷新时间: {job.next_run_time}")
+    logger.info("已设置定时刷新任务: %s", cron_exp)
+    if get_job_next_run(job):
+        logger.info("下次刷新时间: %s", get_job_next_run(job))
 except Exception as e:
-    print(f"设置定时刷新任务失败，使用默认值: {str(e)}")
+    logger.warning("设置定时刷新任务失败，使用默认值: %s", e)
     job = scheduler.add_job(scheduled_refresh, 'cron', id='refresh_task', minute='*/1')
-    if job and job.next_run_time:
-        print(f"已设置默认定时刷新任务，下次执行时间: {job.next_run_time}")
+    if get_job_next_run(job):
+        logger.info("已设置默认定时刷新任务，下次执行时间: %s", get_job_next_run(job))
+
+# 同步其他进程保存的cron设置
+scheduler.add_job(sync_schedule, 'interval', seconds=10, id='sync_schedule_task')
+
+# 定时清理孤立的缩略图并控制磁盘占用
+if THUMBNAIL_GC_INTERVAL > 0:
+    scheduler.add_job(collect_thumbnail_garbage, 'interval', minutes=THUMBNAIL_GC_INTERVAL, id='thumbnail_gc_task')
+    logger.info("已设置缩略图清理任务: 每%s分钟", THUMBNAIL_GC_INTERVAL)
 
 # 路由
 @app.route('/')
 def index():
     return render_template('index.html')
 
+def parse_variant_args(args):
+    """解析/image和/img/today的缩放参数
+
+    w/h为目标宽高（可以只给一个），fit为contain/cover/fill，format为jpeg/webp/avif/png或auto（按Accept头选择），
+    q为编码质量1-100。没有任何缩放参数时返回None（直接返回原图），参数无效时抛出ValueError。
+    """
+    if not any(name in args for name in ('w', 'h', 'fit', 'format', 'q')):
+        return None
+    width = int(args['w']) if args.get('w') else None
+    height = int(args['h']) if args.get('h') else None
+    for value in (width, height):
+        if value is not None and not 1 <= value <= VARIANT_MAX_DIMENSION:
+            raise ValueError(f"宽高必须在1到{VARIANT_MAX_DIMENSION}之间")
+    fit = args.get('fit', 'contain').lower()
+    if fit not in thumbnailer.VARIANT_FITS:
+        raise ValueError(f"fit必须是{'/'.join(thumbnailer.VARIANT_FITS)}之一")
+    fmt = args.get('format', '').lower() or None
+    if fmt == 'jpg':
+        fmt = 'jpeg'
+    if fmt not in (None, 'auto') and fmt not in VARIANT_FORMATS:
+        raise ValueError(f"format必须是auto/{'/'.join(VARIANT_FORMATS)}之一")
+    quality = int(args['q']) if args.get('q') else None
+    if quality is not None and not 1 <= quality <= 100:
+        raise ValueError("q必须在1到100之间")
+    return {"w": width, "h": height, "fit": fit, "format": fmt, "q": quality}
+
+def render_variant_file(original_path, variant_path, params):
+    """在变体线程池中生成图片变体，正在处理和排队的数量达到上限时抛出VariantBusyError"""
+    if not VARIANT_SLOTS.acquire(blocking=False):
+        raise VariantBusyError()
+    try:
+        stats = VARIANT_EXECUTOR.submit(
+            thumbnailer.render_variant, original_path, variant_path,
+            params["w"], params["h"], params["fit"], params["format"], params["q"]
+        ).result()
+    finally:
+        VARIANT_SLOTS.release()
+    VARIANT_CACHE.added(stats["bytes"])
+    return variant_path
+
+def send_image_variant(original_path, variant, max_age=None):
+    """返回原图按variant参数缩放、重新编码后的图片，变体缓存中没有时先生成
+
+    没有指定格式时沿用原图格式（GIF/BMP等转为JPEG）。繁忙时返回503，生成失败时返回原图。
+    """
+    fmt = variant["format"]
+    if fmt == 'auto':
+        fmt = negotiate_thumbnail_format(request.accept_mimetypes)
+    elif fmt is None:
+        fmt = thumbnailer.format_of(original_path) or 'jpeg'
+        if fmt not in VARIANT_FORMATS:
+            fmt = 'jpeg'
+    params = dict(variant, format=fmt)
+
+    stat = os.stat(original_path)
+    key = VARIANT_CACHE.key_for(IMAGE_INDEX.rel_path(original_path), get_source_version(stat), params)
+    variant_path = VARIANT_CACHE.path_for(key, fmt)
+    if os.path.exists(variant_path):
+        VARIANT_CACHE.touch(variant_path)
+    else:
+        try:
+            VARIANT_FLIGHTS.do(variant_path, render_variant_file, original_path, variant_path, params)
+        except VariantBusyError:
+            response = jsonify({"error": "图片处理繁忙，请稍后重试"})
+            response.status_code = 503
+            response.headers['Retry-After'] = '5'
+            return response
+        except Exception as e:
+            hot_logger.warning("生成图片变体失败 %s: %s", original_path, e)
+            return send_file(original_path, mimetype=mimetypes.guess_type(original_path)[0],
+                             conditional=True, max_age=max_age)
+
+    response = send_file(variant_path, mimetype=thumbnailer.FORMATS[fmt]['mimetype'],
+                         conditional=True, etag=key, max_age=max_age)
+    if variant["format"] == 'auto':
+        response.vary.add('Accept')
+    return response
+
 @app.route('/image')
 def get_image():
     try:
+        # 可选的缩放参数（w、h、fit、format、q），低带宽客户端可以只取需要的尺寸
+        try:
+            variant = parse_variant_args(request.args)
+        except ValueError as e:
+            return jsonify({"error": f"无效的图片参数: {str(e)}"}), 400
+        
         # 获取文件夹参数（从请求URL参数获取）
         folder_path = request.args.get('folder', '')
         
         # 如果传入了文件夹参数，按指定文件夹返回图片
         # 这里不再修改config文件，避免配置干扰和竞争
         if folder_path:
-            with lock:
-                # 从全局图片列表筛选符合条件的图片
-                folder_full_path = os.path.join(PHOTOS_FOLDER, folder_path)
-                folder_full_path = os.path.normpath(folder_full_path)
-                
-                filtered_images = [img for img in CACHED_IMAGES 
-                               if os.path.normpath(img).startswith(folder_full_path)]
-                
-                if not filtered_images:
-                    # 如果没有找到图片，返回错误
-                    return jsonify({"error": f"文件夹 '{folder_path}' 中没有有效图片"}), 404
-                
-                # 从筛选后的列表中随机选择一张
-                selected_image = random.choice(filtered_images)
-                
-                # 验证文件
-                if not os.path.isfile(selected_image):
-                    return jsonify({"error": f"图片文件不存在: {selected_image}"}), 404
-                
-                # 获取文件信息
-                file_info = get_file_info(selected_image)
-                
-                # 检查客户端缓存
-                if_none_match = request.headers.get('If-None-Match')
-                if if_none_match and if_none_match == file_info['etag']:
-                    return '', 304
-                
-                # 设置响应头
-                headers = {
-                    'Cache-Control': 'public, max-age=60',  # 1分钟缓存
-                    'ETag': file_info['etag'],
-                    'Last-Modified': http_date(file_info['mtime']),
-                    'Content-Type': mimetypes.guess_type(selected_image)[0],
-                    'Content-Length': str(file_info['size'])
-                }
-                
-                # 使用send_from_directory进行流式传输
-                directory = os.path.dirname(selected_image)
-                filename = os.path.basename(selected_image)
-                return send_from_directory(
-                    directory, 
-                    filename, 
-                    conditional=True,
-                    download_name=filename,
-                    as_attachment=False,
-                    mimetype=headers['Content-Type']
-                )
-        
+            # 从全局图片列表筛选符合条件的图片
+            folder_full_path = os.path.join(PHOTOS_FOLDER, folder_path)
+            filtered_images = get_images().folder_view(folder_full_path)
+            
+            if not filtered_images:
+                # 如果没有找到图片，返回错误
+                return jsonify({"error": f"文件夹 '{folder_path}' 中没有有效图片"}), 404
+            
+            # 从筛选后的列表中随机选择一张
+            selected_image = random.choice(filtered_images)
+            
+            # 验证文件
+            if not os.path.isfile(selected_image):
+                return jsonify({"error": f"图片文件不存在: {selected_image}"}), 404
+            
+            if variant:
+                return send_image_variant(selected_image, variant, max_age=60)
+            
+            # 获取文件信息
+            file_info = get_file_info(selected_image)
+            
+            # 检查客户端缓存
+            if_none_match = request.headers.get('If-None-Match')
+            if if_none_match and if_none_match == file_info['etag']:
+                return '', 304
+            
+            # 设置响应头
+            headers = {
+                'Cache-Control': 'public, max-age=60',  # 1分钟缓存
+                'ETag': file_info['etag'],
+                'Last-Modified': http_date(file_info['mtime']),
+                'Content-Type': mimetypes.guess_type(selected_image)[0],
+                'Content-Length': str(file_info['size'])
+            }
+            
+            # 使用send_from_directory进行流式传输
+            directory = os.path.dirname(selected_image)
+            filename = os.path.basename(selected_image)
+            return send_from_directory(
+                directory, 
+                filename, 
+                conditional=True,
+                etag=file_info['etag'].strip('"'),
+                max_age=60,
+                download_name=filename,
+                as_attachment=False,
+                mimetype=headers['Content-Type']
+            )
+    
         # 以下是原有逻辑：使用当前全局设置的图片
-        if not CURRENT_IMAGE.get('path'):
-            # 如果没有当前图片，尝试刷新
+        current = get_current_image()
+        if not current.get('path') or not os.path.isfile(current['path']):
+            # 如果没有当前图片或当前图片已失效，尝试刷新
             scheduled_refresh()
+            current = get_current_image()
             
         # 再次检查是否有可用图片
-        if not CURRENT_IMAGE.get('path'):
+        if not current.get('path'):
             return jsonify({"error": "没有可用的图片"}), 404
             
         # 验证文件是否存在且可访问
-        if not os.path.isfile(CURRENT_IMAGE['path']):
-            return jsonify({"error": f"图片文件不存在: {CURRENT_IMAGE['path']}"}), 404
+        if not os.path.isfile(current['path']):
+            return jsonify({"error": f"图片文件不存在: {current['path']}"}), 404
+
+        if variant:
+            return send_image_variant(current['path'], variant, max_age=60)
 
         # 获取文件信息
-        file_info = get_file_info(CURRENT_IMAGE['path'])
+        file_info = get_file_info(current['path'])
         
         # 检查客户端缓存
         if_none_match = request.headers.get('If-None-Match')
@@ -570,17 +2471,19 @@ def get_image():
             'Cache-Control': 'public, max-age=60',  # 1分钟缓存
             'ETag': file_info['etag'],
             'Last-Modified': http_date(file_info['mtime']),
-            'Content-Type': mimetypes.guess_type(CURRENT_IMAGE['path'])[0],
+            'Content-Type': mimetypes.guess_type(current['path'])[0],
             'Content-Length': str(file_info['size'])
         }
         
         # 使用send_from_directory进行流式传输
-        directory = os.path.dirname(CURRENT_IMAGE['path'])
-        filename = os.path.basename(CURRENT_IMAGE['path'])
+        directory = os.path.dirname(current['path'])
+        filename = os.path.basename(current['path'])
         return send_from_directory(
             directory, 
             filename, 
             conditional=True,
+            etag=file_info['etag'].strip('"'),
+            max_age=60,
             download_name=filename,
             as_attachment=False,
             mimetype=headers['Content-Type']
@@ -588,13 +2491,13 @@ def get_image():
         
     except Exception as e:
         error_msg = f"获取图片时发生错误: {str(e)}"
-        print(error_msg)
+        hot_logger.error(error_msg)
         return jsonify({"error": error_msg}), 500
 
 @app.route('/refresh', methods=['POST'])
 def refresh_image():
     """手动刷新图片的API端点"""
-    global LAST_REFRESH_TIME, CURRENT_IMAGE
+    global LAST_REFRESH_TIME
     
     current_time = datetime.now()
     if LAST_REFRESH_TIME and (current_time - LAST_REFRESH_TIME).total_seconds() < REFRESH_COOLDOWN:
@@ -608,37 +2511,32 @@ def refresh_image():
     
     # 如果传入了文件夹参数，从指定文件夹中随机选择一张图片
     if folder_path:
-        with lock:
-            try:
-                # 从全局图片列表筛选符合条件的图片
-                folder_full_path = os.path.join(PHOTOS_FOLDER, folder_path)
-                folder_full_path = os.path.normpath(folder_full_path)
-                
-                filtered_images = [img for img in CACHED_IMAGES 
-                               if os.path.normpath(img).startswith(folder_full_path)]
-                
-                if not filtered_images:
-                    print(f"文件夹 '{folder_path}' 中没有有效图片")
-                    return jsonify({
-                        "status": "error",
-                        "message": f"文件夹 '{folder_path}' 中没有有效图片"
-                    }), 404
-                
-                # 从筛选后的列表中随机选择一张
-                selected_image = random.choice(filtered_images)
-                
-                # 更新当前图片
-                CURRENT_IMAGE['path'] = selected_image
-                CURRENT_IMAGE['update_time'] = current_time
-                
-                LAST_REFRESH_TIME = current_time
-                print(f"已从文件夹 '{folder_path}' 刷新图片: {selected_image}")
-            except Exception as e:
-                print(f"处理文件夹参数失败: {str(e)}")
+        try:
+            # 从全局图片列表筛选符合条件的图片
+            folder_full_path = os.path.join(PHOTOS_FOLDER, folder_path)
+            filtered_images = get_images().folder_view(folder_full_path)
+            
+            if not filtered_images:
+                hot_logger.warning("文件夹 '%s' 中没有有效图片", folder_path)
                 return jsonify({
                     "status": "error",
-                    "message": f"处理文件夹参数失败: {str(e)}"
-                }), 500
+                    "message": f"文件夹 '{folder_path}' 中没有有效图片"
+                }), 404
+            
+            # 从筛选后的列表中随机选择一张
+            selected_image = random.choice(filtered_images)
+            
+            # 更新当前图片
+            set_current_image(selected_image, current_time)
+            
+            LAST_REFRESH_TIME = current_time
+            logger.debug("已从文件夹 '%s' 刷新图片: %s", folder_path, selected_image)
+        except Exception as e:
+            hot_logger.warning("处理文件夹参数失败: %s", e)
+            return jsonify({
+                "status": "error",
+                "message": f"处理文件夹参数失败: {str(e)}"
+            }), 500
     else:
         # 如果没有文件夹参数，正常刷新
         LAST_REFRESH_TIME = current_time
@@ -650,21 +2548,24 @@ def refresh_image():
 def get_schedule():
     """获取当前的cron设置和下次执行时间"""
     try:
-        job = scheduler.get_job('refresh_task')
-        next_run = job.next_run_time.strftime('%Y-%m-%d %H:%M:%S') if job and job.next_run_time else 'unknown'
-        current_image = os.path.basename(CURRENT_IMAGE['path']) if CURRENT_IMAGE.get('path') else None
-        update_time = CURRENT_IMAGE.get('update_time', None)
+        current_cron = CONFIG.cron()
+        next_run_time = CronTrigger(timezone=scheduler.timezone, **parse_cron(current_cron)).get_next_fire_time(
+            None, datetime.now(scheduler.timezone))
+        next_run = next_run_time.strftime('%Y-%m-%d %H:%M:%S') if next_run_time else 'unknown'
+        current = get_current_image()
+        current_image = os.path.basename(current['path']) if current.get('path') else None
+        update_time = current.get('update_time', None)
         update_time_str = update_time.strftime('%Y-%m-%d %H:%M:%S') if update_time else 'unknown'
         
         return jsonify({
-            "cron": cron_exp,
-            "cron_readable": translate_cron(cron_exp),
+            "cron": current_cron,
+            "cron_readable": translate_cron(current_cron),
             "next_run": next_run,
             "current_image": current_image,
             "last_update": update_time_str
         })
     except Exception as e:
-        print(f"获取调度信息失败: {str(e)}")
+        logger.error("获取调度信息失败: %s", e)
         return jsonify({
             "cron": cron_exp,
             "cron_readable": translate_cron(cron_exp),
@@ -688,19 +2589,19 @@ def save_schedule():
         # 更新调度任务
         try:
             job = scheduler.reschedule_job('refresh_task', trigger='cron', **cron_dict)
-            if job and job.next_run_time:
-                print(f"成功更新定时任务: {new_cron}")
-                print(f"下次执行时间: {job.next_run_time}")
+            next_run_time = get_job_next_run(job)
+            if next_run_time:
+                logger.info("成功更新定时任务: %s", new_cron)
+                logger.info("下次执行时间: %s", next_run_time)
             else:
                 raise Exception("无法获取下次执行时间")
         except Exception as e:
             raise Exception(f"更新定时任务失败: {str(e)}")
         
-        # 保存到配置文件
+        # 保存到配置文件（只更新cron，保留其他设置）
         try:
-            with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
-                json.dump({'cron': new_cron}, f, ensure_ascii=False, indent=2)
-            print(f"配置已保存到: {CONFIG_FILE}")
+            CONFIG.update(cron=new_cron)
+            logger.info("配置已保存到: %s", CONFIG_FILE)
         except Exception as e:
             raise Exception(f"配置文件保存失败: {str(e)}")
         
@@ -712,88 +2613,127 @@ def save_schedule():
         
         return jsonify({
             "status": "success",
-            "next_run": job.next_run_time.strftime('%Y-%m-%d %H:%M:%S') if job and job.next_run_time else 'unknown'
+            "next_run": next_run_time.strftime('%Y-%m-%d %H:%M:%S')
         })
     
     except Exception as e:
         error_msg = str(e)
-        print(f"保存调度设置失败: {error_msg}")
+        logger.error("保存调度设置失败: %s", error_msg)
         return jsonify({"error": error_msg}), 400
 
 @app.route('/img/today')
 @app.route('/img/today.<format>')
 def get_today_image(format=None):
-    """提供一个固定的图片访问地址，每次访问都会刷新图片"""
+    """提供一个固定的图片访问地址，每次访问都会刷新图片
+
+    支持与/image相同的缩放参数（w、h、fit、format、q）。
+    """
     try:
-        # 每次访问都刷新图片
-        scheduled_refresh()
+        try:
+            variant = parse_variant_args(request.args)
+        except ValueError as e:
+            return jsonify({"error": f"无效的图片参数: {str(e)}"}), 400
+        
+        # 启用预选图片池时直接取出下一张，否则每次访问都实时刷新图片
+        entry = TODAY_POOL.pop() if TODAY_POOL.size > 0 else None
+        if entry:
+            current = set_current_image(entry['path'], datetime.now(), entry['info'], defer=True)
+        else:
+            scheduled_refresh()
+            current = get_current_image()
         
         # 如果没有可用图片，返回404
-        if not CURRENT_IMAGE.get('path'):
+        if not current.get('path'):
             return jsonify({"error": "没有可用的图片"}), 404
             
-        # 验证文件是否存在且可访问
-        if not os.path.isfile(CURRENT_IMAGE['path']):
-            return jsonify({"error": f"图片文件不存在: {CURRENT_IMAGE['path']}"}), 404
-
-        # 获取文件信息
-        file_info = get_file_info(CURRENT_IMAGE['path'])
+        # 验证文件是否存在且可访问（预选图片已在后台校验过）
+        if not entry and not os.path.isfile(current['path']):
+            return jsonify({"error": f"图片文件不存在: {current['path']}"}), 404
         
         # 获取更新时间作为版本号
         version = str(int(datetime.now().timestamp() * 1000))  # 使用毫秒级时间戳
         
-        # 获取实际的文件MIME类型
-        actual_mime_type = mimetypes.guess_type(CURRENT_IMAGE['path'])[0]
-        
         # 设置响应头，强制浏览器不缓存
-        response = send_file(
-            CURRENT_IMAGE['path'],
-            mimetype=actual_mime_type,
-            conditional=True
-        )
+        try:
+            response = None
+            etag = f'W/"{version}"'  # 使用弱 ETag
+            if variant:
+                response = send_image_variant(current['path'], variant)
+                if response.status_code == 503:
+                    return response
+            elif entry:
+                response = TodayImagePool.send(entry)
+                if response is not None:
+                    # 预选图片在后台已经计算好内容ETag
+                    etag = entry['info']['etag']
+            if response is None:
+                response = send_file(
+                    current['path'],
+                    mimetype=mimetypes.guess_type(current['path'])[0],
+                    conditional=True
+                )
+        except FileNotFoundError:
+            if not entry:
+                raise
+            # 预选之后文件被删除，清空图片池后按普通方式重试
+            TODAY_POOL.clear()
+            return get_today_image(format)
         
         # 更强力的缓存控制头
         response.headers.update({
             'Cache-Control': 'no-store, no-cache, must-revalidate, post-check=0, pre-check=0, max-age=0',
             'Pragma': 'no-cache',
             'Expires': '-1',
-            'Etag': f'W/"{version}"',  # 使用弱 ETag
+            'ETag': etag,
             'Last-Modified': http_date(datetime.now().timestamp()),  # 使用当前时间
             'X-Version': version,
-            'X-Original-Format': os.path.splitext(CURRENT_IMAGE['path'])[1][1:]
+            'X-Original-Format': entry['format'] if entry else os.path.splitext(current['path'])[1][1:]
         })
         
         return response
         
     except Exception as e:
         error_msg = f"获取图片时发生错误: {str(e)}"
-        print(error_msg)
+        hot_logger.error(error_msg)
         return jsonify({"error": error_msg}), 500
 
 @app.route('/scan', methods=['POST'])
 def scan_directory():
     """扫描目录的API端点"""
-    global CACHED_IMAGES, LAST_SCAN_TIME
-    
     try:
         start_time = datetime.now()
-        print("\n开始手动扫描目录...")
+        logger.info("开始手动扫描目录...")
         
-        # 执行扫描
-        CACHED_IMAGES = get_all_images(PHOTOS_FOLDER)
-        LAST_SCAN_TIME = datetime.now()
+        # 执行扫描，full=true时忽略目录修改时间强制完整扫描
+        full = request.args.get('full', 'false') == 'true'
+        if is_background_owner():
+            total = len(rescan_images(full=full))
+        else:
+            # 扫描和写入索引只在负责后台任务的进程中进行，避免多个进程同时扫描、同时写入索引
+            result = request_scan_from_owner(full)
+            if result is None:
+                return jsonify({
+                    "status": "error",
+                    "error": "等待后台任务进程完成扫描超时"
+                }), 504
+            if result.get('error'):
+                return jsonify({
+                    "status": "error",
+                    "error": result['error']
+                }), 500
+            total = result['total']
         
-        duration = (LAST_SCAN_TIME - start_time).total_seconds()
+        duration = (datetime.now() - start_time).total_seconds()
         
         return jsonify({
             "status": "success",
-            "total_files": len(CACHED_IMAGES),
-            "valid_images": len(CACHED_IMAGES),
+            "total_files": total,
+            "valid_images": total,
             "duration": round(duration, 2)
         })
         
     except Exception as e:
-        print(f"扫描目录时发生错误: {str(e)}")
+        logger.exception("扫描目录时发生错误: %s", e)
         return jsonify({
             "status": "error",
             "error": str(e)
@@ -814,11 +2754,94 @@ def get_scan_status():
     status["is_manual_scan"] = request.args.get('manual', 'false') == 'true'
     return jsonify(status)
 
+def invalidate_sort_cache(rel_paths):
+    """使包含指定图片的文件夹的排序缓存失效"""
+    if not rel_paths:
+        return
+    for folder in SORT_CACHE.keys():
+        if not folder or any(path.startswith(folder + '/') for path in rel_paths):
+            SORT_CACHE.pop(folder)
+
+def apply_file_changes(changed_files, removed_dirs=(), added_dirs=()):
+    """把文件系统变化直接应用到索引和内存缓存，无需重新扫描整个目录
+
+    changed_files为需要重新检查的文件路径，removed_dirs为被删除或移走的目录，
+    added_dirs为新建或移入的目录（会遍历其中的图片）。
+    """
+    files = {os.path.normpath(path) for path in changed_files}
+    removed_dirs = [os.path.normpath(path) for path in removed_dirs]
+    added_dirs = [os.path.normpath(path) for path in added_dirs]
+
+    # 索引和图片列表在写锁内一起更新，避免与正在进行的扫描互相覆盖
+    with lock:
+        removed = []
+        for dir_path in removed_dirs:
+            removed.extend(IMAGE_INDEX.remove_tree(dir_path))
+        for dir_path in added_dirs:
+            for root, _, names in os.walk(dir_path):
+                if THUMBNAIL_FOLDER in root:
+                    continue
+                files.update(os.path.join(root, name) for name in names
+                             if name.lower().endswith(IMAGE_EXTENSIONS))
+
+        images = CACHED_IMAGES
+        added = []
+        updated = []
+        for path in files:
+            if IMAGE_INDEX.refresh_file(path):
+                if path in images:
+                    updated.append(path)
+                else:
+                    added.append(path)
+            elif path not in removed:
+                removed.append(path)
+
+        removed = [path for path in removed if path in images]
+        if added or removed:
+            publish_images(images.updated(added=added, removed=removed), added=added, removed=removed)
+
+    # 清理变化图片的元数据缓存和所在文件夹的排序缓存
+    touched = [IMAGE_INDEX.rel_path(path) for path in removed + added + updated]
+    for rel_path in touched:
+        IMAGE_CACHE.pop(rel_path, None)
+    invalidate_sort_cache(touched)
+    if removed:
+        TODAY_POOL.clear()
+
+    if added or removed:
+        logger.info("已应用图片变化: 新增 %s 张, 移除 %s 张, 更新 %s 张, 当前共 %s 张",
+                    len(added), len(removed), len(updated), len(CACHED_IMAGES))
+
+    # 为新增图片生成缩略图
+    if added:
+        threading.Thread(
+            target=generate_thumbnails_for_images,
+            args=(added,),
+            daemon=True
+        ).start()
+
+    # 当前图片被删除或还没有当前图片时，重新选择一张
+    current = get_current_image().get('path')
+    if (current and current in removed) or (not current and CACHED_IMAGES):
+        scheduled_refresh()
+
 class ImageFolderHandler(FileSystemEventHandler):
-    def __init__(self, refresh_callback):
-        self.refresh_callback = refresh_callback
-        self.last_refresh_time = 0
-        self.refresh_cooldown = 5  # 冷却时间（秒）
+    """监控图片目录变化，合并短时间内的事件后批量应用到缓存
+
+    每个事件都会推迟批处理debounce秒，但距第一个事件最多等待max_delay秒，
+    这样批量复制大量文件时不会每个文件都处理一次，也不会一直等不到处理。
+    """
+
+    def __init__(self, apply_callback, debounce=1.0, max_delay=5.0):
+        self.apply_callback = apply_callback
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.lock = threading.Lock()
+        self.timer = None
+        self.first_event_time = None
+        self.changed_files = set()
+        self.removed_dirs = set()
+        self.added_dirs = set()
 
     def on_created(self, event):
         self._handle_event(event)
@@ -826,40 +2849,432 @@ class ImageFolderHandler(FileSystemEventHandler):
     def on_modified(self, event):
         self._handle_event(event)
 
+    def on_deleted(self, event):
+        self._handle_event(event)
+
     def on_moved(self, event):
         self._handle_event(event)
 
     def _handle_event(self, event):
-        if event.is_directory:
+        # 忽略缩略图目录中的变化
+        if THUMBNAIL_FOLDER in event.src_path:
             return
-            
-        # 检查文件扩展名
-        if not event.src_path.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.bmp')):
-            return
-            
-        # 检查冷却时间
-        current_time = datetime.now().timestamp()
-        if current_time - self.last_refresh_time < self.refresh_cooldown:
+
+        dest_path = getattr(event, 'dest_path', None)
+        with self.lock:
+            if event.is_directory:
+                if event.event_type in ('deleted', 'moved'):
+                    self.removed_dirs.add(event.src_path)
+                if event.event_type == 'created':
+                    self.added_dirs.add(event.src_path)
+                elif event.event_type == 'moved':
+                    self.added_dirs.add(dest_path)
+                elif event.event_type != 'deleted':
+                    return
+            else:
+                # 检查文件扩展名
+                paths = [path for path in (event.src_path, dest_path)
+                         if path and path.lower().endswith(IMAGE_EXTENSIONS)]
+                if not paths:
+                    return
+                self.changed_files.update(paths)
+
+            self._schedule_flush()
+
+    def _schedule_flush(self):
+        now = time.monotonic()
+        if self.first_event_time is None:
+            self.first_event_time = now
+        if self.timer:
+            self.timer.cancel()
+        delay = min(self.debounce, max(0, self.first_event_time + self.max_delay - now))
+        self.timer = threading.Timer(delay, self._flush)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def _flush(self):
+        with self.lock:
+            changed_files, self.changed_files = self.changed_files, set()
+            removed_dirs, self.removed_dirs = self.removed_dirs, set()
+            added_dirs, self.added_dirs = self.added_dirs, set()
+            self.timer = None
+            self.first_event_time = None
+
+        if not (changed_files or removed_dirs or added_dirs):
             return
-            
-        print(f"检测到图片变化: {event.src_path}")
-        self.last_refresh_time = current_time
-        self.refresh_callback()
+
+        logger.info("检测到图片变化: %s 个文件, %s 个目录", len(changed_files), len(removed_dirs) + len(added_dirs))
+        try:
+            self.apply_callback(changed_files, removed_dirs, added_dirs)
+        except Exception as e:
+            logger.exception("应用图片变化失败: %s", e)
 
 # 新增路由: 瀑布流页面
 @app.route('/waterfall')
 def waterfall():
     return render_template('waterfall.html')
 
+def read_image_info(full_path, rel_path, indexed=None):
+    """读取单张图片的元数据，返回(元数据, 尺寸来源)
+
+    尺寸优先使用索引中的记录（文件未修改时），其次只读取文件头，都不行时才用Pillow打开。
+    内嵌预览和主色调优先使用索引中的记录，没有时从已生成的最小缩略图生成（开销很小）；
+    缩略图也没有时不在这里解码原图，由后台生成缩略图时顺便生成，之后的列表请求即可返回。
+    """
+    stat = os.stat(full_path)
+    image_info = {
+        "path": rel_path,
+        "name": os.path.basename(rel_path),
+        "created_time": stat.st_ctime,
+        "modified_time": stat.st_mtime,
+        "version": get_source_version(stat),
+        "width": None,
+        "height": None,
+        "preview": None,
+        "color": None
+    }
+
+    if indexed and indexed["mtime"] == stat.st_mtime:
+        image_info["preview"] = indexed["preview"]
+        image_info["color"] = indexed["color"]
+        if not image_info["preview"] and indexed["hash"]:
+            image_info["preview"], image_info["color"] = preview_from_store(indexed["hash"])
+
+    if indexed and indexed["width"] and indexed["mtime"] == stat.st_mtime:
+        image_info["width"] = indexed["width"]
+        image_info["height"] = indexed["height"]
+        return image_info, "index"
+
+    try:
+        size = imagemeta.probe_size(full_path)
+    except Exception:
+        size = None
+    if size:
+        image_info["width"], image_info["height"] = size
+        return image_info, "header"
+
+    try:
+        with Image.open(full_path) as img:
+            image_info["width"], image_info["height"] = img.size
+        return image_info, "pillow"
+    except Exception as e:
+        hot_logger.warning("获取图片尺寸失败 %s: %s", rel_path, e)
+        return image_info, "failed"
+
+def extract_image_info(entries, folder=''):
+    """用线程池并行读取一批图片的元数据，批量写入IMAGE_CACHE，返回{相对路径: 元数据}
+
+    entries为[(相对路径, 绝对路径), ...]，folder为这些图片所在的目录，只用于显示进度。
+    索引中已有的尺寸和预览一次性批量取出，新读取的尺寸和新生成的预览批量保存到索引。
+    进度实时更新到METADATA_STATUS。
+    """
+    global METADATA_STATUS
+    rel_folder = folder.replace('\\', '/').strip('/')
+    METADATA_STATUS.update({
+        "is_running": True,
+        "folder": rel_folder,
+        "total": len(entries),
+        "processed": 0,
+        "from_index": 0,
+        "from_header": 0,
+        "from_pillow": 0,
+        "failed": 0,
+        "previews": 0,
+        "current_file": "",
+        "start_time": datetime.now()
+    })
+    start_time = time.time()
+
+    indexed_images = IMAGE_INDEX.get_images_many(rel_path for rel_path, _ in entries)
+    results = {}
+    dimension_updates = []
+    preview_updates = []
+
+    def work(entry):
+        rel_path, full_path = entry
+        try:
+            return rel_path, read_image_info(full_path, rel_path, indexed_images.get(rel_path))
+        except OSError as e:
+            # 文件在列出之后被删除或无法访问
+            hot_logger.warning("读取图片信息失败 %s: %s", rel_path, e)
+            return rel_path, (None, "failed")
+
+    try:
+        with ThreadPoolExecutor(max_workers=METADATA_WORKERS) as executor:
+            for rel_path, (image_info, source) in executor.map(work, entries):
+                METADATA_STATUS["processed"] += 1
+                METADATA_STATUS["failed" if source == "failed" else f"from_{source}"] += 1
+                METADATA_STATUS["current_file"] = os.path.basename(rel_path)
+                if image_info is None:
+                    continue
+                results[rel_path] = image_info
+                indexed = indexed_images.get(rel_path)
+                if source in ("header", "pillow") and indexed:
+                    dimension_updates.append((rel_path, image_info["width"], image_info["height"]))
+                if image_info["preview"] and indexed and image_info["preview"] != indexed["preview"]:
+                    METADATA_STATUS["previews"] += 1
+                    preview_updates.append((rel_path, image_info["preview"], image_info["color"],
+                                            image_info["modified_time"]))
+    finally:
+        METADATA_STATUS["is_running"] = False
+        METADATA_STATUS["current_file"] = ""
+
+    IMAGE_CACHE.update(results)
+    if dimension_updates:
+        IMAGE_INDEX.update_dimensions_many(dimension_updates)
+    if preview_updates:
+        IMAGE_INDEX.set_previews_many(preview_updates)
+
+    logger.info("读取图片信息完成: %s/%s 张, 索引 %s, 文件头 %s, Pillow %s, 失败 %s, 新生成预览 %s, 用时 %.2f秒",
+                len(results), len(entries), METADATA_STATUS['from_index'], METADATA_STATUS['from_header'],
+                METADATA_STATUS['from_pillow'], METADATA_STATUS['failed'], METADATA_STATUS['previews'],
+                time.time() - start_time)
+    return results
+
+def load_folder_images(target_folder, folder_path):
+    """列出目录（含子目录）下所有图片的元数据，IMAGE_CACHE中没有的图片并行读取"""
+    entries = []
+    for root, _, files in os.walk(target_folder):
+        if THUMBNAIL_FOLDER in root:
+            continue
+
+        for f in files:
+            if f.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.bmp')):
+                full_path = os.path.join(root, f)
+                rel_path = os.path.relpath(full_path, PHOTOS_FOLDER).replace('\\', '/')
+                entries.append((rel_path, full_path))
+
+    missing = [entry for entry in entries if entry[0] not in IMAGE_CACHE]
+    if missing:
+        extract_image_info(missing, folder_path)
+
+    # 读取期间可能有文件被删除并从缓存中移除
+    images = [IMAGE_CACHE.get(rel_path) for rel_path, _ in entries]
+    return [image_info for image_info in images if image_info]
+
+class FeistelPermutation:
+    """[0, n)上由seed决定的伪随机排列，可以单独计算任意位置，不需要生成整个排列
+
+    在2^(2k) >= n的定义域上做4轮平衡Feistel变换（双射），结果超出n时继续变换（cycle walking），
+    定义域不超过4n，平均不到4次即可落回[0, n)。轮密钥由seed经blake2b得到，不依赖进程的hash()，
+    因此同一个seed在所有进程中得到相同的顺序。
+    """
+
+    ROUNDS = 4
+    MASK64 = (1 << 64) - 1
+
+    def __init__(self, n, seed):
+        self.n = n
+        self.half_bits = max(1, ((n - 1).bit_length() + 1) // 2) if n > 1 else 1
+        self.half_mask = (1 << self.half_bits) - 1
+        digest = hashlib.blake2b(str(seed).encode(), digest_size=8 * self.ROUNDS).digest()
+        self.keys = struct.unpack(f'<{self.ROUNDS}Q', digest)
+
+    def _round(self, value, key):
+        # splitmix64的混合函数
+        x = (value ^ key) & self.MASK64
+        x = ((x ^ (x >> 30)) * 0xbf58476d1ce4e5b9) & self.MASK64
+        x = ((x ^ (x >> 27)) * 0x94d049bb133111eb) & self.MASK64
+        return (x ^ (x >> 31)) & self.half_mask
+
+    def __getitem__(self, index):
+        if not 0 <= index < self.n:
+            raise IndexError("FeistelPermutation index out of range")
+        x = index
+        while True:
+            left, right = x >> self.half_bits, x & self.half_mask
+            for key in self.keys:
+                left, right = right, left ^ self._round(right, key)
+            x = (left << self.half_bits) | right
+            if x < self.n:
+                return x
+
+    def __len__(self):
+        return self.n
+
+class FolderListing:
+    """一个文件夹（含子目录）的图片列表，以及各种排序方式的结果
+
+    图片元数据只保存一份，每种排序方式第一次使用时计算一个升序的下标数组（array('I')），
+    降序时反向读取同一个数组，不需要为每种排序方向复制一份列表。
+    相同排序键按路径排序，不同进程对同一批图片得到相同的顺序。
+    随机排序在按路径排序的结果上套用FeistelPermutation，每页只计算该页的位置。
+    signature为创建时图片快照中该文件夹的图片路径，快照更新后据此判断文件夹内容是否变化；
+    version为图片路径的摘要，游标据此判断是否还是同一份列表。
+    """
+
+    SORT_KEYS = {
+        'name': lambda info: info["name"].lower(),
+        'created': lambda info: info["created_time"],
+        'modified': lambda info: info["modified_time"],
+        'path': lambda info: info["path"],
+    }
+    # 排序键在游标（JSON）中的类型，用于校验客户端传回的游标
+    SORT_KEY_TYPES = {
+        'name': (str,),
+        'created': (int, float),
+        'modified': (int, float),
+        'path': (str,),
+    }
+
+    def __init__(self, images, signature, generation):
+        self.images = images
+        self.signature = signature
+        self.generation = generation
+        self._orders = {}
+        self._lock = Lock()
+        paths = self.order('path')
+        self.version = hashlib.md5('\n'.join(images[i]["path"] for i in paths).encode('utf-8')).hexdigest()[:16]
+
+    def order(self, sort_by):
+        """获取排序方式对应的下标数组，不认识的排序方式保持目录遍历顺序"""
+        with self._lock:
+            indices = self._orders.get(sort_by)
+            if indices is None:
+                indices = list(range(len(self.images)))
+                if sort_by in self.SORT_KEYS:
+                    key = self.SORT_KEYS[sort_by]
+                    images = self.images
+                    indices.sort(key=lambda i: (key(images[i]), images[i]["path"]))
+                indices = array('I', indices)
+                self._orders[sort_by] = indices
+            return indices
+
+    def _position(self, sort_by, sort_order, seed):
+        """返回把排序后位置映射为图片下标的函数"""
+        if sort_by == 'random':
+            indices = self.order('path')
+            permutation = FeistelPermutation(len(indices), seed)
+            return lambda position: indices[permutation[position]]
+        indices = self.order(sort_by)
+        if sort_order == 'desc':
+            last = len(indices) - 1
+            return lambda position: indices[last - position]
+        return lambda position: indices[position]
+
+    def page(self, sort_by, sort_order, start, end, seed=0):
+        """返回排序后[start, end)范围内的图片，随机排序不区分升降序"""
+        position = self._position(sort_by, sort_order, seed)
+        return [self.images[position(i)] for i in range(start, min(end, len(self.images)))]
+
+    def sort_key(self, sort_by, info):
+        """游标中记录的排序位置：(排序键, 路径)"""
+        return [self.SORT_KEYS[sort_by](info), info["path"]]
+
+    def seek(self, sort_by, sort_order, last_key):
+        """在（可能已经变化的）列表中找到排在last_key之后的第一个位置，用于游标续读"""
+        key = self.SORT_KEYS[sort_by]
+        position = self._position(sort_by, sort_order, None)
+        target = tuple(last_key)
+        descending = sort_order == 'desc'
+        lo, hi = 0, len(self.images)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            info = self.images[position(mid)]
+            current = (key(info), info["path"])
+            if (current >= target) if descending else (current <= target):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def __len__(self):
+        return len(self.images)
+
+def encode_cursor(state):
+    """把分页状态编码为不透明的游标字符串"""
+    data = json.dumps(state, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+    return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor):
+    """解析游标，格式不正确时抛出ValueError
+
+    游标由客户端传回，除位置外还要校验种子和排序位置k：k为[排序键, 路径]，排序键的类型与排序方式一致。
+    """
+    try:
+        data = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        state = json.loads(data.decode('utf-8'))
+    except Exception:
+        raise ValueError("无效的游标")
+    if not isinstance(state, dict) or not isinstance(state.get('p'), int) or state['p'] < 0:
+        raise ValueError("无效的游标")
+    seed = state.get('r')
+    if seed is not None and (not isinstance(seed, int) or isinstance(seed, bool)):
+        raise ValueError("无效的游标")
+    key = state.get('k')
+    if key is not None:
+        key_types = FolderListing.SORT_KEY_TYPES.get(state.get('s'))
+        if (key_types is None or not isinstance(key, list) or len(key) != 2
+                or isinstance(key[0], bool) or not isinstance(key[0], key_types) or not isinstance(key[1], str)):
+            raise ValueError("无效的游标")
+    return state
+
+def default_shuffle_seed(folder_path):
+    """未指定seed时随机排序使用的种子，由文件夹路径决定，所有进程一致"""
+    return int(hashlib.md5(folder_path.encode('utf-8')).hexdigest()[:8], 16)
+
+def build_folder_listing(folder_key, target_folder, folder_path):
+    """读取文件夹的图片列表并放入SORT_CACHE"""
+    snapshot = get_images()
+    generation = IMAGES_GENERATION
+    signature = tuple(snapshot.folder_view(target_folder))
+    listing = FolderListing(load_folder_images(target_folder, folder_path), signature, generation)
+    SORT_CACHE.set(folder_key, listing)
+    logger.debug("已缓存图片列表: %s %s张图片", folder_key or '/', len(listing))
+    return listing
+
+def get_folder_listing(folder_path, target_folder):
+    """获取文件夹的图片列表，缓存的列表在文件夹内容变化后自动重新读取
+
+    图片快照版本号（包括其他进程发布的更新）变化时，比较快照中该文件夹的图片，
+    有新增或删除才重新读取，其他文件夹的变化不影响缓存。
+    """
+    folder_key = folder_path.replace('\\', '/').strip('/')
+    snapshot = get_images()
+    generation = IMAGES_GENERATION
+    listing = SORT_CACHE.get(folder_key)
+    if listing is not None and listing.generation != generation:
+        if tuple(snapshot.folder_view(target_folder)) == listing.signature:
+            listing.generation = generation
+        else:
+            logger.debug("文件夹内容已变化，重新读取图片列表: %s", folder_key or '/')
+            SORT_CACHE.pop(folder_key)
+            listing = None
+    if listing is None:
+        # 同一目录的并发冷启动请求只读取一次
+        listing = METADATA_FLIGHTS.do(folder_key, build_folder_listing, folder_key, target_folder, folder_path)
+    return listing
+
+METADATA_FLIGHTS = SingleFlight()
+
 # 新增路由: 返回图片列表(支持分页)
 @app.route('/list-images')
 def list_images():
+    """返回图片列表
+
+    支持两种分页方式：page/limit按页码分页；cursor为上一次响应中的nextCursor，
+    按游标继续读取时排序方式、随机种子和文件夹都以游标中记录的为准。
+    随机排序使用seed参数（不指定时由文件夹路径决定），相同seed在所有进程中顺序一致。
+    """
     try:
         page = int(request.args.get('page', 1))
         limit = int(request.args.get('limit', 20))
         folder_path = request.args.get('path', '')
         sort_by = request.args.get('sort_by', 'name')
         sort_order = request.args.get('sort_order', 'asc')
+        seed = request.args.get('seed')
+        cursor = request.args.get('cursor')
+        
+        state = None
+        if cursor:
+            try:
+                state = decode_cursor(cursor)
+                folder_path = str(state.get('f', ''))
+                sort_by = str(state.get('s', 'name'))
+                sort_order = str(state.get('o', 'asc'))
+                seed = state.get('r')
+            except ValueError as e:
+                return jsonify({"error": str(e)}), 400
         
         # 如果传入了exif排序，自动使用创建时间替代
         if sort_by == 'exif':
@@ -868,9 +3283,10 @@ def list_images():
         # 验证参数
         if page < 1: page = 1
         if limit < 1 or limit > 100: limit = 20
-        
-        # 生成缓存键
-        cache_key = f"{folder_path}:{sort_by}:{sort_order}"
+        try:
+            seed = int(seed) if seed is not None else default_shuffle_seed(folder_path)
+        except ValueError:
+            return jsonify({"error": "无效的seed"}), 400
         
         # 构建目标文件夹的完整路径
         target_folder = os.path.join(PHOTOS_FOLDER, folder_path)
@@ -879,90 +3295,50 @@ def list_images():
         if not os.path.normpath(target_folder).startswith(os.path.normpath(PHOTOS_FOLDER)):
             return jsonify({"error": "无效的路径"}), 400
             
-        # 检查是否有缓存的排序结果
-        if cache_key in SORT_CACHE:
-            all_images = SORT_CACHE[cache_key]
-            print(f"使用缓存的排序结果: {len(all_images)}张图片")
-        else:
-            # 递归获取指定文件夹下的所有图片路径
-            all_images = []
-            
-            for root, _, files in os.walk(target_folder):
-                if THUMBNAIL_FOLDER in root:
-                    continue
-                    
-                for f in files:
-                    if f.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.bmp')):
-                        full_path = os.path.join(root, f)
-                        rel_path = os.path.relpath(full_path, PHOTOS_FOLDER).replace('\\', '/')
-                        
-                        # 检查是否已缓存该图片的元数据
-                        if rel_path in IMAGE_CACHE:
-                            image_info = IMAGE_CACHE[rel_path]
-                        else:
-                            # 获取基本文件信息
-                            stat = os.stat(full_path)
-                            image_info = {
-                                "path": rel_path,
-                                "name": f,
-                                "created_time": stat.st_ctime,
-                                "modified_time": stat.st_mtime,
-                                "width": None,
-                                "height": None
-                            }
-                            
-                            # 获取图片尺寸但不再读取EXIF数据
-                            try:
-                                with Image.open(full_path) as img:
-                                    image_info["width"], image_info["height"] = img.size
-                            except Exception as e:
-                                print(f"获取图片尺寸失败 {rel_path}: {str(e)}")
-                            
-                            # 缓存图片元数据
-                            IMAGE_CACHE[rel_path] = image_info
-                        
-                        all_images.append(image_info)
-            
-            # 对图片列表排序
-            if sort_by == 'name':
-                all_images.sort(key=lambda x: x["name"].lower(), reverse=(sort_order == 'desc'))
-            elif sort_by == 'created':
-                all_images.sort(key=lambda x: x["created_time"], reverse=(sort_order == 'desc'))
-            elif sort_by == 'modified':
-                all_images.sort(key=lambda x: x["modified_time"], reverse=(sort_order == 'desc'))
-            elif sort_by == 'random':
-                # 随机排序时使用固定的随机种子，确保分页之间顺序一致
-                seed = hash(folder_path) % 10000
-                random.seed(seed)
-                random.shuffle(all_images)
-            
-            # 缓存排序结果
-            SORT_CACHE[cache_key] = all_images
-            print(f"已缓存排序结果: {len(all_images)}张图片, 排序方式: {sort_by} {sort_order}")
-        
-        # 计算分页
-        total = len(all_images)
-        total_pages = math.ceil(total / limit)
+        # 获取文件夹的图片列表（带缓存）并按排序方式取出当前页
+        listing = get_folder_listing(folder_path, target_folder)
+        total = len(listing)
         
-        start_idx = (page - 1) * limit
+        # 计算起始位置：游标对应的列表没有变化时直接使用记录的位置，
+        # 列表有变化时按最后一张图片的排序键找到续读位置（随机排序只能沿用位置）
+        if state is None:
+            start_idx = (page - 1) * limit
+        elif state.get('v') == listing.version or not state.get('k') or sort_by not in listing.SORT_KEYS:
+            start_idx = min(state['p'], total)
+        else:
+            start_idx = listing.seek(sort_by, sort_order, state['k'])
         end_idx = min(start_idx + limit, total)
         
         # 获取当前页的图片
-        current_page_images = all_images[start_idx:end_idx]
+        current_page_images = listing.page(sort_by, sort_order, start_idx, end_idx, seed=seed)
+        
+        next_cursor = None
+        if end_idx < total:
+            next_cursor = encode_cursor({
+                "f": folder_path,
+                "s": sort_by,
+                "o": sort_order,
+                "r": seed,
+                "v": listing.version,
+                "p": end_idx,
+                "k": (listing.sort_key(sort_by, current_page_images[-1])
+                      if current_page_images and sort_by in listing.SORT_KEYS else None)
+            })
         
         return jsonify({
             "images": current_page_images,
-            "page": page,
+            "page": start_idx // limit + 1,
             "limit": limit,
             "total": total,
-            "hasMore": page < total_pages,
+            "hasMore": end_idx < total,
+            "nextCursor": next_cursor,
+            "seed": seed,
             "sortBy": sort_by,
-            "sortOrder": sort_order
+            "sortOrder": sort_order,
+            "thumbnailWidths": THUMBNAIL_WIDTHS
         })
     except Exception as e:
-        print(f"获取图片列表失败: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        hot_logger.exception("获取图片列表失败: %s", e)
         return jsonify({"error": str(e)}), 500
 
 # 新增路由: 直接访问图片文件
@@ -981,9 +3357,37 @@ def get_static_image(img_path):
             
         return send_file(image_path)
     except Exception as e:
-        print(f"获取图片出错: {str(e)}")
+        hot_logger.error("获取图片出错: %s", e)
         return jsonify({"error": str(e)}), 500
 
+def generate_store_thumbnail(original_path, content_hash, width, fmt='jpeg'):
+    """按需生成单个宽度、格式的缩略图并登记到缩略图存储"""
+    thumb_path = THUMBNAIL_STORE.path_for(content_hash, width, fmt)
+    start = time.perf_counter()
+    stats = thumbnailer.generate_thumbnail_set(original_path, [(width, thumb_path)], quality=80)
+    METRICS.observe('thumbnail_generate_seconds', time.perf_counter() - start, source='request')
+    THUMBNAIL_STORE.record(content_hash, stats["files"])
+    return thumb_path
+
+def snap_thumbnail_width(width, dpr=1.0):
+    """把请求的宽度（乘以设备像素比）向上取到最近的档位，超过最大档位时使用最大档位"""
+    target = width * dpr
+    for bucket in THUMBNAIL_WIDTHS:
+        if bucket >= target:
+            return bucket
+    return THUMBNAIL_WIDTHS[-1]
+
+def negotiate_thumbnail_format(accept):
+    """按THUMBNAIL_FORMATS的顺序选择请求Accept头中明确列出的格式
+
+    不能只看通配符：浏览器的图片请求总是带有*/*，但不一定能解码AVIF/WebP。
+    """
+    offered = {value.lower() for value, quality in accept if quality > 0}
+    for fmt in THUMBNAIL_FORMATS:
+        if thumbnailer.FORMATS[fmt]['mimetype'] in offered:
+            return fmt
+    return 'jpeg'
+
 # 生成缩略图并返回
 @app.route('/img-thumbnail/<path:img_path>')
 def get_thumbnail(img_path):
@@ -998,78 +3402,65 @@ def get_thumbnail(img_path):
         if not os.path.exists(original_path) or not os.path.isfile(original_path):
             return jsonify({"error": "图片不存在"}), 404
             
-        # 计算缩略图路径 (保持目录结构)
-        rel_dir = os.path.dirname(normalized_path)
-        thumb_dir = os.path.join(THUMBNAIL_FOLDER, rel_dir)
-        os.makedirs(thumb_dir, exist_ok=True)
-        
-        # 生成缩略图文件名 (使用原文件名+尺寸)
-        width = int(request.args.get('w', 400))  # 默认宽度
-        filename = os.path.basename(normalized_path)
-        name, ext = os.path.splitext(filename)
-        thumb_name = f"{name}_w{width}{ext}"
-        thumb_path = os.path.join(thumb_dir, thumb_name)
-        
+        # 缩略图按原图内容哈希和宽度保存，相同内容的图片共用缩略图
+        # 请求的宽度（w，默认400）和设备像素比（dpr，1-3）换算后取到THUMBNAIL_WIDTHS中的档位
+        try:
+            requested_width = int(request.args.get('w', 400))
+            dpr = min(max(float(request.args.get('dpr', 1)), 1.0), 3.0)
+            if requested_width <= 0:
+                raise ValueError(requested_width)
+        except ValueError:
+            return jsonify({"error": "无效的尺寸参数"}), 400
+        width = snap_thumbnail_width(requested_width, dpr)
+        # 根据Accept头选择AVIF/WebP/JPEG，同一URL对不同浏览器返回不同格式
+        fmt = negotiate_thumbnail_format(request.accept_mimetypes)
+        src_stat = os.stat(original_path)
+        version = get_source_version(src_stat)
+        content_hash = get_content_hash(original_path, src_stat)
+        thumb_path = THUMBNAIL_STORE.path_for(content_hash, width, fmt)
+
         # 检查缩略图是否已存在
-        if not os.path.exists(thumb_path):
-            # 生成缩略图
+        if os.path.exists(thumb_path):
+            THUMBNAIL_STORE.touch(content_hash, width, fmt)
+            METRICS.inc('thumbnail_requests_total', result='hit')
+        else:
+            # 生成缩略图，JPEG质量80%，WebP/AVIF使用thumbnailer中的参数
+            # 多个请求同时访问同一张缺失的缩略图时只生成一次，其他请求等待结果
             try:
-                with Image.open(original_path) as img:
-                    # 计算新高度，保持原始比例
-                    wpercent = (width / float(img.size[0]))
-                    height = int((float(img.size[1]) * float(wpercent)))
-                    
-                    # 如果图片是RGBA模式（带透明度），转换为RGB
-                    if img.mode == 'RGBA':
-                        # 创建白色背景
-                        background = Image.new('RGB', img.size, (255, 255, 255))
-                        # 合并图片
-                        background.paste(img, mask=img.split()[3])
-                        img = background
-                    
-                    # 调整大小，使用高质量重采样
-                    img_resized = img.resize((width, height), Image.LANCZOS)
-                    
-                    # 保存为JPEG格式，质量80%
-                    img_resized.save(thumb_path, "JPEG", quality=80, optimize=True)
-                    
+                THUMBNAIL_FLIGHTS.do(thumb_path, generate_store_thumbnail, original_path, content_hash, width, fmt)
+                METRICS.inc('thumbnail_requests_total', result='miss')
             except Exception as e:
-                print(f"缩略图生成失败: {str(e)}")
+                METRICS.inc('thumbnail_requests_total', result='error')
+                hot_logger.warning("缩略图生成失败: %s", e)
                 # 如果缩略图生成失败，返回原图
                 return send_file(original_path)
                 
-        # 返回缩略图
-        return send_file(thumb_path)
+        # 返回缩略图，ETag由原图内容哈希、宽度和格式决定，If-None-Match匹配时返回304
+        response = send_file(thumb_path, mimetype=thumbnailer.FORMATS[fmt]['mimetype'], conditional=True,
+                             etag=f"{content_hash}-w{width}-{fmt}")
+        # 告诉浏览器和中间缓存响应内容随Accept头变化
+        response.vary.add('Accept')
+        if request.args.get('v') == version:
+            # URL中带有当前版本标记，内容永远不会变化
+            response.headers['Cache-Control'] = f'public, max-age={THUMBNAIL_MAX_AGE}, immutable'
+        else:
+            # 没有版本标记或版本已过期的URL，每次使用前向服务器确认
+            response.headers['Cache-Control'] = 'no-cache'
+        return response
             
     except Exception as e:
-        print(f"获取缩略图出错: {str(e)}")
+        hot_logger.error("获取缩略图出错: %s", e)
         return jsonify({"error": str(e)}), 500
 
 # 获取瀑布流布局设置
 @app.route('/get-waterfall-settings', methods=['GET'])
 def get_waterfall_settings():
     try:
-        # 读取配置文件
-        with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
-            config = json.load(f)
-        
-        # 如果没有瀑布流设置，使用默认值
-        waterfall_settings = config.get('waterfallSettings', {
-            'columnCount': 3,
-            'columnGap': 15,
-            'imageGap': 15,
-            'borderRadius': 8
-        })
-        
-        return jsonify(waterfall_settings)
+        # 没有瀑布流设置时使用默认值
+        return jsonify(CONFIG.waterfall_settings())
     except Exception as e:
-        print(f"获取瀑布流设置失败: {str(e)}")
-        return jsonify({
-            'columnCount': 3,
-            'columnGap': 15,
-            'imageGap': 15,
-            'borderRadius': 8
-        })
+        logger.error("获取瀑布流设置失败: %s", e)
+        return jsonify(ConfigStore.DEFAULT_WATERFALL_SETTINGS)
 
 # 保存瀑布流布局设置
 @app.route('/save-waterfall-settings', methods=['POST'])
@@ -1083,26 +3474,23 @@ def save_waterfall_settings():
             if field not in settings:
                 return jsonify({"error": f"缺少必要字段: {field}"}), 400
         
-        # 读取现有配置
-        with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
-            config = json.load(f)
-        
-        # 更新瀑布流设置
-        config['waterfallSettings'] = settings
-        
-        # 保存到配置文件
-        with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
-            json.dump(config, f, ensure_ascii=False, indent=2)
+        # 更新瀑布流设置并保存到配置文件
+        CONFIG.update(waterfallSettings=settings)
         
         return jsonify({"status": "success"})
     except Exception as e:
         error_msg = str(e)
-        print(f"保存瀑布流设置失败: {error_msg}")
+        logger.error("保存瀑布流设置失败: %s", error_msg)
         return jsonify({"error": error_msg}), 500
 
 # 获取文件夹结构
 @app.route('/get-folders')
 def get_folders():
+    """列出文件夹的子文件夹和图片
+
+    子文件夹的图片数量（imageCount含子目录，directCount只算直接包含的）来自图片列表快照的目录树，
+    没有图片的子文件夹也会列出（数量为0）；响应带有ETag，内容没有变化时返回304。
+    """
     try:
         # 获取当前路径参数（相对路径）
         current_path = request.args.get('path', '')
@@ -1113,37 +3501,35 @@ def get_folders():
         # 安全检查 - 确保路径在photos目录内
         if not os.path.normpath(target_path).startswith(os.path.normpath(PHOTOS_FOLDER)):
             return jsonify({"error": "无效的路径"}), 400
-            
-        # 如果路径不存在
-        if not os.path.exists(target_path) or not os.path.isdir(target_path):
-            return jsonify({"error": "目录不存在"}), 404
-            
-        # 获取当前目录下的所有子目录
-        folders = []
-        # 获取当前目录下的所有图片文件
-        images = []
         
-        for item in os.listdir(target_path):
-            item_path = os.path.join(target_path, item)
-            rel_path = os.path.join(current_path, item).replace('\\', '/')
-            
-            # 如果是目录，添加到文件夹列表
-            if os.path.isdir(item_path):
-                # 统计文件夹内的图片数量
-                image_count = 0
-                for root, _, files in os.walk(item_path):
-                    for file in files:
-                        if file.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.bmp')):
-                            image_count += 1
-                
-                folders.append({
-                    "name": item,
-                    "path": rel_path,
-                    "imageCount": image_count
-                })
-            # 如果是图片文件，添加到图片列表
-            elif item.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.bmp')):
-                images.append(rel_path)
+        tree = get_images().folder_tree(PHOTOS_FOLDER)
+        folder_key = os.path.relpath(os.path.normpath(target_path), os.path.normpath(PHOTOS_FOLDER)).replace('\\', '/')
+        if folder_key == '.':
+            folder_key = ''
+        node = tree.get(folder_key)
+        if node is None:
+            # 目录树中只有含图片的目录，不在其中时确认目录是否存在
+            if not os.path.isdir(target_path):
+                return jsonify({"error": "目录不存在"}), 404
+            node = FolderTree.EMPTY
+        
+        prefix = f"{folder_key}/" if folder_key else ""
+        # 目录树只含有图片的子目录，没有图片的子目录从文件系统读取，图片数量为0
+        try:
+            with os.scandir(target_path) as entries:
+                subdirs = {entry.name for entry in entries if entry.is_dir()}
+        except OSError:
+            subdirs = set()
+        folders = []
+        for name in sorted(subdirs.union(node.children)):
+            child = tree.get(prefix + name) or FolderTree.EMPTY
+            folders.append({
+                "name": name,
+                "path": prefix + name,
+                "imageCount": child.total,
+                "directCount": len(child.images)
+            })
+        images = [prefix + name for name in node.images]
         
         # 构建导航路径
         breadcrumbs = []
@@ -1158,23 +3544,29 @@ def get_folders():
                         "path": current.replace('\\', '/')
                     })
         
-        return jsonify({
+        response = jsonify({
             "currentPath": current_path,
             "breadcrumbs": breadcrumbs,
             "folders": folders,
-            "images": images
+            "images": images,
+            "imageCount": node.total,
+            "directCount": len(node.images)
         })
+        # 每次使用前向服务器确认，图片没有变化时返回304
+        response.headers['Cache-Control'] = 'no-cache'
+        response.add_etag()
+        return response.make_conditional(request)
         
     except Exception as e:
-        print(f"获取文件夹结构失败: {str(e)}")
+        hot_logger.error("获取文件夹结构失败: %s", e)
         return jsonify({"error": str(e)}), 500
 
 # 添加清除缓存的API
 @app.route('/clear-cache', methods=['POST'])
 def clear_cache():
-    global IMAGE_CACHE, SORT_CACHE
+    global IMAGE_CACHE
     IMAGE_CACHE = {}
-    SORT_CACHE = {}
+    SORT_CACHE.clear()
     return jsonify({"status": "success", "message": "缓存已清除"})
 
 # 保存文件夹设置
@@ -1183,39 +3575,39 @@ def save_folder_setting():
     try:
         folder_path = request.json.get('folder', '')
         
-        # 读取现有配置
-        with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
-            config = json.load(f)
+        # 更新文件夹设置并保存到配置文件
+        CONFIG.update(folderPath=folder_path)
         
-        # 更新文件夹设置
-        config['folderPath'] = folder_path
-        
-        # 保存到配置文件
-        with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
-            json.dump(config, f, ensure_ascii=False, indent=2)
+        # 预选图片是按旧的文件夹设置选出的，需要重新选择
+        TODAY_POOL.clear()
         
         return jsonify({"status": "success"})
     except Exception as e:
         error_msg = str(e)
-        print(f"保存文件夹设置失败: {error_msg}")
+        logger.error("保存文件夹设置失败: %s", error_msg)
         return jsonify({"error": error_msg}), 500
 
 # 获取当前文件夹设置
 @app.route('/get-folder-setting', methods=['GET'])
 def get_folder_setting():
     try:
-        # 读取配置文件
-        with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
-            config = json.load(f)
-        
-        # 获取文件夹路径设置
-        folder_path = config.get('folderPath', '')
-        
-        return jsonify({"folder": folder_path})
+        return jsonify({"folder": CONFIG.folder_path()})
     except Exception as e:
-        print(f"获取文件夹设置失败: {str(e)}")
+        logger.error("获取文件夹设置失败: %s", e)
         return jsonify({"folder": ""})
 
+@app.route('/metadata-status', methods=['GET'])
+def get_metadata_status():
+    """获取图片元数据读取状态"""
+    global METADATA_STATUS
+    status = METADATA_STATUS.copy()
+    if status["start_time"]:
+        duration = (datetime.now() - status["start_time"]).total_seconds()
+        status["duration"] = round(duration, 2)
+    else:
+        status["duration"] = 0
+    return jsonify(status)
+
 # 添加一个新的API端点，用于获取缩略图生成状态
 @app.route('/thumbnail-status', methods=['GET'])
 def get_thumbnail_status():
@@ -1229,23 +3621,230 @@ def get_thumbnail_status():
         status["duration"] = 0
     return jsonify(status)
 
-if __name__ == '__main__':
-    print("启动应用程序...")
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    """记录请求数、处理耗时和响应字节数，按路由模板（如/img-thumbnail/<path:img_path>）统计"""
+    start = g.get('request_start')
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    METRICS.inc('http_requests_total', route=route, method=request.method, status=response.status_code)
+    if start is not None:
+        METRICS.observe('http_request_duration_seconds', time.perf_counter() - start, route=route)
+    if response.content_length:
+        METRICS.inc('http_response_bytes_total', response.content_length, route=route)
+    return response
+
+def flush_metrics():
+    """把本进程的指标快照写入METRICS_FOLDER/<pid>.json（先写临时文件再重命名），返回快照"""
+    snapshot = METRICS.snapshot()
+    with fileutil.atomic_write(os.path.join(METRICS_FOLDER, f'{os.getpid()}.json'), 'w') as f:
+        json.dump(snapshot, f)
+    return snapshot
+
+def flush_metrics_periodically():
+    """后台线程：指标有变化时定期写入快照文件，供其他进程的/metrics读取"""
+    while True:
+        time.sleep(METRICS_FLUSH_INTERVAL)
+        if METRICS.dirty:
+            try:
+                flush_metrics()
+            except OSError as e:
+                hot_logger.warning("保存运行指标失败: %s", e)
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+def collect_metric_snapshots():
+    """本进程的最新指标、其他进程写入的快照和已退出进程的累计值
+
+    已退出进程的快照中，计数器和直方图累加到METRICS_AGGREGATE_FILE后删除快照文件，仪表直接丢弃，
+    进程退出（如gunicorn按max_requests重启worker）后合并的总数不会减少，Prometheus不会误判为计数器重置。
+    整个过程持有文件锁，多个进程同时处理/metrics时同一个已退出进程只会被累加一次。
+    Windows下只支持单进程运行（见acquire_background_lock），只返回本进程的指标。
+    """
+    if fcntl is None:
+        return [METRICS.snapshot()]
+    snapshots = [flush_metrics()]
+    with open(METRICS_LOCK_FILE, 'a') as lock_file, fileutil.file_lock(lock_file):
+        exited = []
+        exited_paths = []
+        for name in os.listdir(METRICS_FOLDER):
+            pid = name[:-len('.json')]
+            if not name.endswith('.json') or not pid.isdigit() or int(pid) == os.getpid():
+                continue
+            path = os.path.join(METRICS_FOLDER, name)
+            alive = process_alive(int(pid))
+            try:
+                with open(path) as f:
+                    snapshot = json.load(f)
+            except ValueError:
+                # 写入过程中不会出现（先写临时文件再重命名），文件损坏时无法恢复，已退出进程的直接删除
+                if not alive:
+                    exited_paths.append(path)
+                continue
+            except OSError:
+                continue
+            if alive:
+                snapshots.append(snapshot)
+            else:
+                exited.append(snapshot)
+                exited_paths.append(path)
+        try:
+            with open(METRICS_AGGREGATE_FILE) as f:
+                aggregate = json.load(f)
+        except FileNotFoundError:
+            aggregate = {}
+        except (OSError, ValueError) as e:
+            hot_logger.warning("读取已退出进程的累计指标失败: %s", e)
+            aggregate = {}
+        if exited:
+            aggregate = metrics.accumulate([aggregate] + exited)
+            with fileutil.atomic_write(METRICS_AGGREGATE_FILE, 'w') as f:
+                json.dump(aggregate, f)
+        for path in exited_paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+    snapshots.append(aggregate)
+    return snapshots
+
+@app.route('/metrics')
+def get_metrics():
+    """Prometheus文本格式的运行指标，合并了所有worker进程的数据"""
+    index_bytes = 0
+    for path in (INDEX_DB_FILE, INDEX_DB_FILE + '-wal'):
+        try:
+            index_bytes += os.path.getsize(path)
+        except OSError:
+            pass
+    extra_gauges = [
+        ('images', {}, len(get_images())),
+        ('index_db_bytes', {}, index_bytes),
+        ('thumbnail_store_bytes', {}, THUMBNAIL_STORE.total_bytes()),
+    ]
+    body = METRICS.render(collect_metric_snapshots(), extra_gauges)
+    return body, 200, {'Content-Type': metrics.CONTENT_TYPE, 'Cache-Control': 'no-store'}
+
+BACKGROUND_LOCK_HANDLE = None
+observer = None
+
+def acquire_background_lock():
+    """尝试获取后台任务锁，同一时间只有一个进程能持有，进程退出时自动释放"""
+    global BACKGROUND_LOCK_HANDLE
+    if fcntl is None:
+        return True
+    handle = open(BACKGROUND_LOCK_FILE, 'a')
+    try:
+        fcntl.flock(handle.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        handle.close()
+        return False
+    BACKGROUND_LOCK_HANDLE = handle
+    return True
+
+def is_background_owner():
+    """当前进程是否负责后台任务（Windows下只有一个进程，总是负责）"""
+    return fcntl is None or BACKGROUND_LOCK_HANDLE is not None
+
+def request_scan_from_owner(full=False):
+    """把扫描请求转交给负责后台任务的进程并等待完成
+
+    请求通过共享状态中的计数传递，同时到达的多个请求由一次扫描完成。
+    返回扫描结果（total或error），超过SCAN_REQUEST_TIMEOUT秒没有完成时返回None。
+    """
+    if full:
+        SHARED_STATE.increment('scan_full_requests')
+    number = SHARED_STATE.increment('scan_requests')
+    deadline = time.monotonic() + SCAN_REQUEST_TIMEOUT
+    while time.monotonic() < deadline:
+        result = SHARED_STATE.get('scan_result')
+        if result and result['requests'] >= number:
+            return result
+        time.sleep(0.2)
+    return None
+
+def serve_scan_requests():
+    """后台线程：在负责后台任务的进程中执行其他进程转交的扫描请求（见request_scan_from_owner）"""
+    while True:
+        time.sleep(SCAN_REQUEST_POLL_INTERVAL)
+        handled = SHARED_STATE.get('scan_result') or {'requests': 0, 'full_requests': 0}
+        requests = SHARED_STATE.get('scan_requests', 0)
+        if requests <= handled['requests']:
+            continue
+        # 先读取请求数再读取完整扫描请求数，本次扫描包含的请求中要求完整扫描的都会被计入
+        full_requests = SHARED_STATE.get('scan_full_requests', 0)
+        result = {'requests': requests, 'full_requests': full_requests}
+        try:
+            result['total'] = len(rescan_images(full=full_requests > handled['full_requests']))
+        except Exception as e:
+            logger.exception("执行转交的扫描请求时发生错误: %s", e)
+            result['error'] = str(e)
+        SHARED_STATE.update(scan_result=result)
+
+def start_background_services():
+    """启动定时任务和文件监控，并在后台增量扫描图片目录"""
+    global observer
+    scheduler.start()
+    if fcntl is not None:
+        threading.Thread(target=serve_scan_requests, daemon=True).start()
     
     # 设置文件监控
-    event_handler = ImageFolderHandler(scheduled_refresh)
+    event_handler = ImageFolderHandler(apply_file_changes)
     observer = Observer()
     observer.schedule(event_handler, PHOTOS_FOLDER, recursive=True)
     observer.start()
-    print(f"已启动文件监控（包含子文件夹）: {PHOTOS_FOLDER}")
+    logger.info("已启动文件监控（包含子文件夹）: %s", PHOTOS_FOLDER)
     
-    # 启动时扫描目录
-    print("执行初始目录扫描...")
-    CACHED_IMAGES = get_all_images(PHOTOS_FOLDER)
-    LAST_SCAN_TIME = datetime.now()
+    logger.info("后台执行目录扫描...")
+    threading.Thread(target=rescan_images, daemon=True).start()
+
+def wait_for_background_lock(interval=30):
+    """定期尝试获取后台任务锁，负责后台任务的进程退出后由本进程接替"""
+    while True:
+        time.sleep(interval)
+        if acquire_background_lock():
+            logger.info("进程 %s 接替执行后台任务", os.getpid())
+            start_background_services()
+            return
+
+def init_worker():
+    """初始化当前进程：从索引加载图片列表，并争取成为负责后台任务的进程
+
+    多进程部署（如gunicorn）时每个worker都会调用，只有拿到后台任务锁的进程会启动
+    定时任务、文件监控和目录扫描，其他进程只处理请求。
+    """
+    global CACHED_IMAGES, IMAGES_GENERATION
+    with lock:
+        IMAGES_GENERATION = SHARED_STATE.get('images_generation', 0)
+        CACHED_IMAGES = ImageSet(IMAGE_INDEX.load_images())
+    logger.info("已从索引加载 %s 张图片", len(CACHED_IMAGES))
+    if fcntl is not None:
+        threading.Thread(target=flush_metrics_periodically, daemon=True).start()
+    
+    if acquire_background_lock():
+        logger.info("进程 %s 负责执行后台任务", os.getpid())
+        start_background_services()
+    else:
+        logger.info("进程 %s 只处理请求，后台任务由其他进程执行", os.getpid())
+        threading.Thread(target=wait_for_background_lock, daemon=True).start()
+
+if __name__ == '__main__':
+    logger.info("启动应用程序...")
+    init_worker()
     
     # 设置环境变量禁用警告
     os.environ['WERKZEUG_RUN_MAIN'] = 'true'
     
-    # 启动应用
-    app.run(host='0.0.0.0', port=5000)
\ No newline at end of file
+    # 启动应用（开发和单进程使用，生产环境请使用 wsgi.py；
+    # 这种方式下缩略图进程池的每个子进程都会重新执行一次本文件的模块级代码，见get_thumbnail_executor）
+    app.run(host='0.0.0.0', port=5000)
@@ -0,0 +1,43 @@
+"""基准测试脚本的公共部分：临时图片库、应用的环境变量和导入app
+
+app在导入时读取环境变量，所以要先调用setup_library()，生成测试图片后再调用import_app()。
+"""
+import contextlib
+import os
+import sys
+import tempfile
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def setup_library(prefix, **env):
+    """创建临时的config、photos、thumbnails目录并让应用使用它们，返回临时目录
+
+    env为额外设置的环境变量（如TODAY_POOL_SIZE=0）。日志级别默认为WARNING：
+    日志由后台线程异步输出，INFO日志会夹在测试结果中间。
+    """
+    base = tempfile.mkdtemp(prefix=prefix)
+    for name in ('config', 'photos', 'thumbnails'):
+        os.makedirs(os.path.join(base, name))
+    os.environ['CONFIG_FOLDER'] = os.path.join(base, 'config')
+    os.environ['PHOTOS_FOLDER'] = os.path.join(base, 'photos')
+    os.environ['THUMBNAIL_FOLDER'] = os.path.join(base, 'thumbnails')
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    os.environ.update((name, str(value)) for name, value in env.items())
+    return base
+
+
+@contextlib.contextmanager
+def quiet():
+    """丢弃期间的控制台输出"""
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+
+def import_app():
+    """导入并返回app模块，导入时输出的配置信息被丢弃"""
+    if REPO_ROOT not in sys.path:
+        sys.path.insert(0, REPO_ROOT)
+    with quiet():
+        import app
+    return app
@@ -0,0 +1,400 @@
+"""HTTP接口负载测试
+
+生成一个合成图片库（数量、尺寸、目录深度可配置），启动应用后用多个并发客户端依次运行各个场景：
+- today / image / image_folder:      /img/today、/image、/image?folder=
+- list_<排序> / list_<排序>_deep:      /list-images的各种排序方式（name/created/modified/path/random），
+                                      第一页和最后几页
+- folders / folders_sub:             /get-folders的根目录和子目录
+- thumbnail_cold / thumbnail_warm:   /img-thumbnail，冷（缩略图不存在，按需生成）和热（直接返回）
+每个场景统计延迟（平均/p50/p95/p99/最大）、吞吐量、错误数和响应字节数，以及场景结束时进程的常驻内存，
+结果保存为JSON，之后可以用--compare比较两次结果（如修改前后两个版本）。
+
+服务方式（--mode）:
+- inprocess: Flask测试客户端，不经过网络，只反映应用本身的开销（默认）
+- http:      在127.0.0.1的随机端口启动多线程HTTP服务（werkzeug），请求经过真实的TCP连接
+--url指定已经运行的服务（如gunicorn）时，使用该服务自己的图片库，不生成测试图片，也不统计内存，
+thumbnail_cold只有在该服务的缩略图还没有生成时才是冷的。
+测试图片只在文件末尾追加了不同的字节（解码结果相同，内容哈希不同），生成很快，
+缩略图也不会因为内容相同而共用。测试时不在后台批量生成缩略图，缩略图由thumbnail_cold场景按需生成。
+
+用法:
+    python benchmarks/bench_http.py --images 2000 --depth 3 --clients 8 --requests 500 --output new.json
+    python benchmarks/bench_http.py --url http://127.0.0.1:5000 --scenarios today,list_name --output gunicorn.json
+    python benchmarks/bench_http.py --compare old.json new.json
+"""
+import argparse
+import http.client
+import json
+import math
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime
+from urllib.parse import quote, urlsplit
+
+from PIL import Image
+
+import _common
+
+SORT_MODES = ('name', 'created', 'modified', 'path', 'random')
+# 浏览器请求图片时的Accept头，/img-thumbnail据此选择AVIF/WebP/JPEG
+BROWSER_ACCEPT = 'image/avif,image/webp,image/apng,image/svg+xml,image/*,*/*;q=0.8'
+# --compare时变化超过该比例的指标标记为退步
+REGRESSION_THRESHOLD = 0.10
+
+
+def make_library(root, count, sizes, depth, per_folder, fanout):
+    """生成count张JPEG，每个最底层文件夹per_folder张，文件夹有depth层，上层每个文件夹包含fanout个子文件夹
+
+    每种尺寸只编码一次，其余图片复制字节后在末尾追加序号，使每张图片的内容哈希不同。
+    """
+    samples = []
+    for width, height in sizes:
+        noise = Image.effect_noise((width, height), 40)
+        gradient = Image.linear_gradient('L').resize((width, height))
+        path = os.path.join(root, 'sample.jpg')
+        Image.merge('RGB', (noise, gradient, noise.transpose(Image.FLIP_LEFT_RIGHT))).save(path, quality=85)
+        with open(path, 'rb') as f:
+            samples.append(f.read())
+        os.remove(path)
+
+    for i in range(count):
+        folder = i // per_folder
+        parts = [f"album{folder:04d}"]
+        for level in range(1, depth):
+            folder //= fanout
+            parts.insert(0, f"level{depth - level}-{folder:03d}")
+        folder_path = os.path.join(root, *parts)
+        os.makedirs(folder_path, exist_ok=True)
+        with open(os.path.join(folder_path, f"img{i:06d}.jpg"), 'wb') as f:
+            f.write(samples[i % len(samples)])
+            f.write(i.to_bytes(4, 'big'))
+
+
+class InProcessClient:
+    """Flask测试客户端，每个线程一个"""
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def get(self, path, headers):
+        response = self.client.get(path, headers=headers)
+        size = len(response.get_data())
+        response.close()
+        return response.status_code, size
+
+
+class HttpClient:
+    """基于http.client的客户端，每个线程一个，服务端支持时复用连接"""
+
+    def __init__(self, base_url):
+        parts = urlsplit(base_url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.prefix = parts.path.rstrip('/')
+        self.conn = None
+
+    def get(self, path, headers):
+        for attempt in range(2):
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection(self.host, self.port, timeout=120)
+            try:
+                self.conn.request('GET', self.prefix + path, headers=headers)
+                response = self.conn.getresponse()
+                size = len(response.read())
+            except (http.client.HTTPException, OSError):
+                # 服务端关闭了复用的连接，重新连接后再试一次
+                self.conn.close()
+                self.conn = None
+                if attempt:
+                    raise
+                continue
+            if response.will_close:
+                self.conn.close()
+                self.conn = None
+            return response.status, size
+
+
+def rss_mb():
+    """当前进程的常驻内存和峰值常驻内存（MB），Linux下读取/proc/self/status"""
+    current = peak = None
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    current = int(line.split()[1]) / 1024
+                elif line.startswith('VmHWM:'):
+                    peak = int(line.split()[1]) / 1024
+    except OSError:
+        # ru_maxrss在macOS下单位为字节，其他系统为KB
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peak = maxrss / 1024 / 1024 if sys.platform == 'darwin' else maxrss / 1024
+    return current, peak
+
+
+def percentile(sorted_values, fraction):
+    """最近秩法的百分位数"""
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, max(0, math.ceil(fraction * len(sorted_values)) - 1))]
+
+
+def run_scenario(make_client, urls, total, clients, headers):
+    """clients个线程共同发出total个请求，依次轮流使用urls，返回统计结果"""
+    latencies = []
+    errors = [0]
+    sizes = [0]
+    next_index = [0]
+    lock = threading.Lock()
+
+    def worker():
+        client = make_client()
+        own_latencies = []
+        own_errors = own_bytes = 0
+        while True:
+            with lock:
+                index = next_index[0]
+                next_index[0] += 1
+            if index >= total:
+                break
+            start = time.perf_counter()
+            try:
+                status, size = client.get(urls[index % len(urls)], headers)
+            except (http.client.HTTPException, OSError):
+                status, size = None, 0
+            own_latencies.append(time.perf_counter() - start)
+            own_bytes += size
+            if status is None or status >= 400:
+                own_errors += 1
+        with lock:
+            latencies.extend(own_latencies)
+            errors[0] += own_errors
+            sizes[0] += own_bytes
+
+    threads = [threading.Thread(target=worker) for _ in range(clients)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    result = {
+        "requests": len(latencies),
+        "errors": errors[0],
+        "bytes": sizes[0],
+        "seconds": round(elapsed, 3),
+        "throughput_rps": round(len(latencies) / elapsed, 1) if elapsed else None,
+    }
+    result["mean_ms"] = round(sum(latencies) / len(latencies) * 1000, 2) if latencies else None
+    for name, fraction in (("p50_ms", 0.50), ("p95_ms", 0.95), ("p99_ms", 0.99), ("max_ms", 1.0)):
+        value = percentile(latencies, fraction)
+        result[name] = round(value * 1000, 2) if value is not None else None
+    return result
+
+
+def build_scenarios(image_paths, folders, total_images, list_limit):
+    """根据图片库生成各个场景的URL列表：{场景名: (URL列表, 是否预热)}"""
+    thumb_urls = [f"/img-thumbnail/{quote(path)}?w=400" for path in image_paths]
+    deep_pages = max(1, math.ceil(total_images / list_limit))
+    scenarios = {
+        "today": (["/img/today"], True),
+        "image": (["/image"], True),
+        "image_folder": ([f"/image?folder={quote(folder)}" for folder in folders[:8]] or ["/image"], True),
+    }
+    for sort_by in SORT_MODES:
+        base = f"/list-images?sort_by={sort_by}&limit={list_limit}"
+        scenarios[f"list_{sort_by}"] = ([base], True)
+        # 最后几页：随机排序和按修改时间排序时需要定位到列表末尾
+        scenarios[f"list_{sort_by}_deep"] = (
+            [f"{base}&page={page}" for page in range(max(1, deep_pages - 4), deep_pages + 1)], True)
+    scenarios["folders"] = (["/get-folders"], True)
+    scenarios["folders_sub"] = ([f"/get-folders?path={quote(folder)}" for folder in folders[:8]] or
+                                ["/get-folders"], True)
+    # 冷缓存不能预热，每个URL只请求一次
+    scenarios["thumbnail_cold"] = (thumb_urls, False)
+    scenarios["thumbnail_warm"] = (thumb_urls, True)
+    return scenarios
+
+
+def fetch_json(client, path):
+    """用HttpClient请求JSON接口"""
+    conn = http.client.HTTPConnection(client.host, client.port, timeout=120)
+    try:
+        conn.request('GET', client.prefix + path)
+        response = conn.getresponse()
+        body = response.read()
+        if response.status != 200:
+            raise RuntimeError(f"{path} 返回 {response.status}")
+        return json.loads(body)
+    finally:
+        conn.close()
+
+
+def discover_library(client, max_images):
+    """--url模式：通过接口获取已运行服务的图片和文件夹，返回(图片路径列表, 文件夹列表, 图片总数)"""
+    folders = [folder["path"] for folder in fetch_json(client, "/get-folders")["folders"]]
+    paths = []
+    page = 1
+    while True:
+        data = fetch_json(client, f"/list-images?sort_by=path&limit=100&page={page}")
+        paths.extend(image["path"] for image in data["images"])
+        if len(paths) >= max_images or not data["hasMore"]:
+            return paths[:max_images], folders, data["total"]
+        page += 1
+
+
+def git_version():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results):
+    print(f"\n{'场景':<22}{'请求数':>8}{'失败':>6}{'请求/秒':>10}{'平均(ms)':>10}{'p50(ms)':>10}"
+          f"{'p95(ms)':>10}{'p99(ms)':>10}{'RSS(MB)':>10}")
+    for name, result in results.items():
+        rss = f"{result['rss_mb']:.0f}" if result.get('rss_mb') else '-'
+        print(f"{name:<22}{result['requests']:>8}{result['errors']:>6}{result['throughput_rps']:>10.1f}"
+              f"{result['mean_ms']:>10.2f}{result['p50_ms']:>10.2f}{result['p95_ms']:>10.2f}"
+              f"{result['p99_ms']:>10.2f}{rss:>10}")
+
+
+def compare(old_file, new_file):
+    """比较两次结果，延迟升高或吞吐量下降超过REGRESSION_THRESHOLD的标记为退步，返回退步数量"""
+    with open(old_file) as f:
+        old = json.load(f)
+    with open(new_file) as f:
+        new = json.load(f)
+    print(f"旧: {old_file} ({old['meta'].get('version')}, {old['meta'].get('mode')}, {old['meta'].get('time')})")
+    print(f"新: {new_file} ({new['meta'].get('version')}, {new['meta'].get('mode')}, {new['meta'].get('time')})")
+    print(f"\n{'场景':<22}{'指标':<16}{'旧':>12}{'新':>12}{'变化':>10}")
+    regressions = 0
+    for name, result in new['scenarios'].items():
+        before = old['scenarios'].get(name)
+        if not before:
+            continue
+        for metric in ('throughput_rps', 'p50_ms', 'p95_ms', 'p99_ms', 'rss_mb'):
+            if not before.get(metric) or result.get(metric) is None:
+                continue
+            change = result[metric] / before[metric] - 1
+            # 吞吐量越高越好，其他指标越低越好
+            worse = -change if metric == 'throughput_rps' else change
+            flag = ' !!' if worse > REGRESSION_THRESHOLD else ''
+            regressions += bool(flag)
+            print(f"{name:<22}{metric:<16}{before[metric]:>12.2f}{result[metric]:>12.2f}{change:>+9.1%}{flag}")
+    print(f"\n退步（变差超过{REGRESSION_THRESHOLD:.0%}）: {regressions} 项")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="HTTP接口负载测试")
+    parser.add_argument('--images', type=int, default=1000, help="生成的图片数量")
+    parser.add_argument('--sizes', default='1600x1200,4000x3000', help="图片尺寸，逗号分隔，轮流使用")
+    parser.add_argument('--depth', type=int, default=2, help="文件夹层数")
+    parser.add_argument('--per-folder', type=int, default=50, help="每个最底层文件夹的图片数")
+    parser.add_argument('--fanout', type=int, default=4, help="上层文件夹包含的子文件夹数")
+    parser.add_argument('--mode', choices=('inprocess', 'http'), default='inprocess', help="服务方式")
+    parser.add_argument('--url', help="测试已经运行的服务，例如 http://127.0.0.1:5000")
+    parser.add_argument('--clients', type=int, default=8, help="并发客户端数")
+    parser.add_argument('--requests', type=int, default=300, help="每个场景的请求数")
+    parser.add_argument('--warmup', type=int, default=10, help="每个场景计时前的预热请求数")
+    parser.add_argument('--list-limit', type=int, default=50, help="/list-images每页数量")
+    parser.add_argument('--scenarios', help="只运行指定的场景，逗号分隔")
+    parser.add_argument('--output', help="保存结果的JSON文件")
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help="比较两个结果文件")
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(1 if compare(*args.compare) else 0)
+
+    app_module = None
+    if args.url:
+        image_paths, folders, total_images = discover_library(HttpClient(args.url), args.requests)
+        make_client = lambda: HttpClient(args.url)  # noqa: E731
+    else:
+        sizes = [tuple(int(value) for value in size.split('x')) for size in args.sizes.split(',')]
+        base = _common.setup_library('bench-http-')
+
+        print(f"生成 {args.images} 张图片（{args.sizes}，{args.depth} 层文件夹）: {base}")
+        start = time.perf_counter()
+        make_library(os.environ['PHOTOS_FOLDER'], args.images, sizes, args.depth, args.per_folder, args.fanout)
+        print(f"生成用时 {time.perf_counter() - start:.1f}秒")
+
+        app_module = _common.import_app()
+        with _common.quiet():
+            # 缩略图由thumbnail_cold场景按需生成，不在后台批量生成，避免与测试争用CPU
+            app_module.generate_thumbnails_for_images = lambda image_paths: None
+            app_module.rescan_images()
+
+        root = os.environ['PHOTOS_FOLDER']
+        image_paths = [os.path.relpath(path, root).replace(os.sep, '/') for path in app_module.get_images()]
+        top = sorted(os.listdir(root))
+        folders = top + [f"{top[0]}/{name}" for name in sorted(os.listdir(os.path.join(root, top[0])))
+                         if os.path.isdir(os.path.join(root, top[0], name))] if top else []
+        total_images = len(image_paths)
+
+        if args.mode == 'http':
+            from werkzeug.serving import make_server
+            server = make_server('127.0.0.1', 0, app_module.app, threaded=True)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            url = f"http://127.0.0.1:{server.server_port}"
+            make_client = lambda: HttpClient(url)  # noqa: E731
+        else:
+            make_client = lambda: InProcessClient(app_module.app)  # noqa: E731
+
+    # 冷缓存场景每张图片只请求一次
+    image_paths = image_paths[:args.requests]
+    scenarios = build_scenarios(image_paths, folders, total_images, args.list_limit)
+    if args.scenarios:
+        selected = args.scenarios.split(',')
+        unknown = [name for name in selected if name not in scenarios]
+        if unknown:
+            parser.error(f"未知的场景: {', '.join(unknown)}，可选: {', '.join(scenarios)}")
+        scenarios = {name: scenarios[name] for name in selected}
+
+    headers = {'Accept': BROWSER_ACCEPT}
+    results = {}
+    for name, (urls, warmup) in scenarios.items():
+        if not urls:
+            continue
+        if name == 'thumbnail_cold' and app_module is not None:
+            # 删除已生成的缩略图，保证每个请求都需要生成（登记信息会在生成后重新写入）
+            shutil.rmtree(app_module.THUMBNAIL_STORE.objects_dir, ignore_errors=True)
+        total = len(urls) if name == 'thumbnail_cold' else args.requests
+        if warmup and args.warmup:
+            run_scenario(make_client, urls, args.warmup, min(args.clients, args.warmup), headers)
+        result = run_scenario(make_client, urls, total, args.clients, headers)
+        if app_module is not None:
+            result["rss_mb"], result["peak_rss_mb"] = rss_mb()
+        results[name] = result
+        print(f"{name}: {result['throughput_rps']} 请求/秒, p95 {result['p95_ms']}ms, 失败 {result['errors']}")
+
+    print_results(results)
+
+    if args.output:
+        meta = {
+            "time": datetime.now().isoformat(timespec='seconds'),
+            "version": git_version(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "mode": 'url' if args.url else args.mode,
+            "images": total_images,
+            "args": vars(args),
+        }
+        with open(args.output, 'w') as f:
+            json.dump({"meta": meta, "scenarios": results}, f, ensure_ascii=False, indent=2)
+        print(f"结果已保存到: {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+"""/list-images 冷缓存元数据读取基准测试
+
+生成一个包含JPEG/PNG/GIF/BMP的临时图片库，比较两种读取图片尺寸的方式：
+- pillow: 逐个文件os.stat + Image.open读取尺寸（原来的做法）
+- header: app.extract_image_info（线程池并行，只读取文件头）
+两种方式都在索引中没有尺寸的情况下运行。测试图片刚刚生成，文件内容在系统页缓存中，
+磁盘较慢时（冷页缓存、网络存储）并行读取的收益会更大。
+
+用法:
+    python benchmarks/bench_metadata.py --images 5000 --workers 8
+"""
+import argparse
+import os
+import time
+
+from PIL import Image
+
+import _common
+
+FORMATS = (('jpg', 'JPEG'), ('png', 'PNG'), ('gif', 'GIF'), ('bmp', 'BMP'))
+
+
+def make_library(root, count, width, height):
+    """生成count张图片，JPEG占大多数，其余格式轮流出现；每个子目录500张
+
+    JPEG带有约32KB的EXIF数据，接近相机照片的情况。
+    """
+    samples = {}
+    exif = Image.Exif()
+    exif[0x010e] = 'x' * 32 * 1024  # ImageDescription
+    for ext, fmt in FORMATS:
+        img = Image.linear_gradient('L').resize((width, height)).convert('RGB')
+        path = os.path.join(root, f'sample.{ext}')
+        img.save(path, fmt, **({'exif': exif.tobytes()} if fmt == 'JPEG' else {}))
+        with open(path, 'rb') as f:
+            samples[ext] = f.read()
+        os.remove(path)
+
+    for i in range(count):
+        folder = os.path.join(root, f"album{i // 500:03d}")
+        os.makedirs(folder, exist_ok=True)
+        ext = FORMATS[i % 8][0] if i % 8 < len(FORMATS) else 'jpg'
+        with open(os.path.join(folder, f"img{i:06d}.{ext}"), 'wb') as f:
+            f.write(samples[ext])
+
+
+def pillow_loop(entries):
+    """原来的做法：顺序打开每个文件读取尺寸"""
+    result = {}
+    for rel_path, full_path in entries:
+        stat = os.stat(full_path)
+        with Image.open(full_path) as img:
+            result[rel_path] = (stat.st_mtime, img.size)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="/list-images 元数据读取基准测试")
+    parser.add_argument('--images', type=int, default=5000, help="生成的图片数量")
+    parser.add_argument('--width', type=int, default=1600)
+    parser.add_argument('--height', type=int, default=1200)
+    parser.add_argument('--workers', type=int, default=8, help="读取元数据的线程数")
+    args = parser.parse_args()
+
+    base = _common.setup_library('bench-meta-', METADATA_WORKERS=args.workers)
+
+    print(f"生成 {args.images} 张 {args.width}x{args.height} 测试图片: {base}")
+    make_library(os.environ['PHOTOS_FOLDER'], args.images, args.width, args.height)
+
+    entries = []
+    for root, _, files in os.walk(os.environ['PHOTOS_FOLDER']):
+        for f in files:
+            full_path = os.path.join(root, f)
+            entries.append((os.path.relpath(full_path, os.environ['PHOTOS_FOLDER']).replace('\\', '/'), full_path))
+
+    app = _common.import_app()
+    with _common.quiet():
+        start = time.perf_counter()
+        expected = pillow_loop(entries)
+        pillow_time = time.perf_counter() - start
+
+        app.IMAGE_CACHE.clear()
+        start = time.perf_counter()
+        results = app.extract_image_info(entries)
+        header_time = time.perf_counter() - start
+
+    mismatches = sum(1 for rel_path, (_, size) in expected.items()
+                     if (results[rel_path]["width"], results[rel_path]["height"]) != size)
+
+    print(f"\n{'方式':<10}{'图片数':>10}{'用时(秒)':>12}{'图片/秒':>12}")
+    print(f"{'pillow':<10}{len(expected):>10}{pillow_time:>12.2f}{len(expected) / pillow_time:>12.0f}")
+    print(f"{'header':<10}{len(results):>10}{header_time:>12.2f}{len(results) / header_time:>12.0f}")
+    print(f"提升: {pillow_time / header_time:.2f}x, 尺寸不一致: {mismatches}")
+    print(f"尺寸来源: 文件头 {app.METADATA_STATUS['from_header']}, Pillow {app.METADATA_STATUS['from_pillow']}, "
+          f"失败 {app.METADATA_STATUS['failed']}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+"""图片目录扫描基准测试
+
+生成一个只有空文件的临时目录树（扫描只读取目录和文件的stat，不读取内容），
+分别用单线程（--workers 1，相当于原来逐个目录串行读取）和多线程运行ImageIndex.scan，
+每种方式依次测量三种情况：
+- full:        空索引上的完整扫描（首次启动）
+- unchanged:   没有任何变化时的增量扫描（定时任务的常见情况）
+- changed:     约1%的目录新增了一个文件后的增量扫描
+--latency-ms 给每次os.stat/os.scandir调用加上固定延迟，模拟NFS/SMB等网络存储的往返时间，
+本地磁盘上目录信息都在缓存中，多线程的收益主要体现在有延迟的情况下。
+
+用法:
+    python benchmarks/bench_scan.py --files 100000 --per-dir 100 --workers 8 --latency-ms 1
+"""
+import argparse
+import os
+import time
+
+import _common
+
+SETTLED = time.time() - 3600
+
+
+def make_tree(root, count, per_dir):
+    """生成count个空图片文件，每个目录per_dir个，每100个目录一组；另有少量非图片文件
+
+    目录和文件的修改时间设为一小时前，增量扫描才会跳过它们（见ImageIndex.MTIME_SETTLE_SECONDS）。
+    """
+    dirs = []
+    for i in range(count):
+        if i % per_dir == 0:
+            folder = os.path.join(root, f"group{i // per_dir // 100:03d}", f"album{i // per_dir:05d}")
+            os.makedirs(folder)
+            open(os.path.join(folder, 'notes.txt'), 'w').close()
+            dirs.append(folder)
+        ext = ('jpg', 'png', 'jpeg', 'gif')[i % 4]
+        open(os.path.join(folder, f"img{i:07d}.{ext}"), 'w').close()
+    settle(root)
+    return dirs
+
+
+def settle(root):
+    """把目录树中所有目录的修改时间设为一小时前"""
+    for folder, subdirs, _ in os.walk(root):
+        for name in subdirs:
+            os.utime(os.path.join(folder, name), (SETTLED, SETTLED))
+    os.utime(root, (SETTLED, SETTLED))
+
+
+def add_latency(seconds):
+    """给os.stat和os.scandir加上固定延迟（DirEntry.stat()不经过os.stat，不受影响）"""
+    real_stat, real_scandir = os.stat, os.scandir
+
+    def slow_stat(*args, **kwargs):
+        time.sleep(seconds)
+        return real_stat(*args, **kwargs)
+
+    def slow_scandir(*args, **kwargs):
+        time.sleep(seconds)
+        return real_scandir(*args, **kwargs)
+
+    os.stat, os.scandir = slow_stat, slow_scandir
+
+
+def run_scan(index, full):
+    """运行一次扫描，返回(用时, 扫描结果, 有效图片数)"""
+    status = {"total_files": 0, "processed_files": 0, "valid_images": 0, "skipped_files": 0, "current_file": ""}
+    start = time.perf_counter()
+    result = index.scan(status, full=full)
+    return time.perf_counter() - start, result, status["valid_images"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="图片目录扫描基准测试")
+    parser.add_argument('--files', type=int, default=100000, help="生成的文件数量")
+    parser.add_argument('--per-dir', type=int, default=100, help="每个目录的文件数量")
+    parser.add_argument('--workers', type=int, default=8, help="并行扫描的线程数")
+    parser.add_argument('--latency-ms', type=float, default=0, help="每次stat/scandir附加的延迟（毫秒）")
+    args = parser.parse_args()
+
+    base = _common.setup_library('bench-scan-')
+
+    print(f"生成 {args.files} 个文件（每个目录 {args.per_dir} 个）: {base}")
+    start = time.perf_counter()
+    dirs = make_tree(os.environ['PHOTOS_FOLDER'], args.files, args.per_dir)
+    print(f"生成用时 {time.perf_counter() - start:.1f}秒, 目录 {len(dirs)} 个")
+
+    app = _common.import_app()
+    if args.latency_ms:
+        add_latency(args.latency_ms / 1000)
+
+    modes = [('serial', 1), ('parallel', args.workers)]
+    indexes = {name: app.ImageIndex(os.path.join(base, 'config', f'{name}.db'), os.environ['PHOTOS_FOLDER'])
+               for name, _ in modes}
+    results = {}
+    for name, workers in modes:
+        app.SCAN_WORKERS = workers
+        with _common.quiet():
+            results[(name, 'full')] = run_scan(indexes[name], full=True)
+            results[(name, 'unchanged')] = run_scan(indexes[name], full=False)
+
+    # 约1%的目录各新增一个文件，两个索引都在同一次变化后重新扫描
+    for i, folder in enumerate(dirs[::100]):
+        open(os.path.join(folder, f"new{i:05d}.jpg"), 'w').close()
+    # 只有新增了文件的目录修改时间变化，与真实情况一致
+    for folder in dirs[::100]:
+        os.utime(folder, (SETTLED + 60, SETTLED + 60))
+    for name, workers in modes:
+        app.SCAN_WORKERS = workers
+        with _common.quiet():
+            results[(name, 'changed')] = run_scan(indexes[name], full=False)
+
+    print(f"\n{'方式':<10}{'情况':<12}{'用时(秒)':>10}{'文件/秒':>12}{'有效图片':>10}{'新增':>8}{'读取目录':>10}")
+    for (name, case), (elapsed, result, valid) in results.items():
+        print(f"{name:<10}{case:<12}{elapsed:>10.2f}{valid / elapsed:>12.0f}{valid:>10}"
+              f"{len(result['added']):>8}{result['changed_dirs']:>10}")
+    for case in ('full', 'unchanged', 'changed'):
+        print(f"{case} 提速: {results[('serial', case)][0] / results[('parallel', case)][0]:.2f}x")
+
+    snapshots = [sorted(index.load_images()) for index in indexes.values()]
+    print(f"两个索引内容一致: {snapshots[0] == snapshots[1]}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+"""缩略图生成基准测试：降采样解码 vs 全尺寸解码
+
+生成一批带噪点纹理的大尺寸JPEG，分别用两种方式生成200/400/800三种宽度的缩略图：
+- full:  全分辨率解码后再缩放（draft/reduce之前的做法）
+- draft: thumbnailer.generate_thumbnail_set（JPEG draft()解码 + reduce()）
+每种方式在独立子进程中单线程运行，统计每张图片的耗时（平均/p50/p95）和进程峰值内存（RSS）。
+峰值内存在Linux下读取/proc/self/status的VmHWM，其他系统用resource模块的ru_maxrss
+（Linux的ru_maxrss会继承自生成测试图片的父进程，不能反映子进程自身的峰值），不支持Windows。
+
+用法:
+    python benchmarks/bench_thumbnails.py --images 30 --width 6000 --height 4000
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import thumbnailer  # noqa: E402
+
+WIDTHS = (800, 400, 200)
+
+
+def make_corpus(root, count, width, height):
+    """生成count张带噪点的JPEG（纯色图解码太快，无法反映真实照片的开销）"""
+    os.makedirs(root, exist_ok=True)
+    for i in range(count):
+        noise = Image.effect_noise((width, height), 40 + i % 30)
+        gradient = Image.linear_gradient('L').resize((width, height))
+        img = Image.merge('RGB', (noise, gradient, noise.transpose(Image.FLIP_LEFT_RIGHT)))
+        img.save(os.path.join(root, f"img{i:04d}.jpg"), quality=90)
+
+
+def full_decode(src_path, targets, quality=85):
+    """全分辨率解码，每个宽度都从原图缩放"""
+    with Image.open(src_path) as img:
+        img.load()
+        source = thumbnailer.to_rgb(img)
+    for width, thumb_path in targets:
+        height = max(1, int(source.height * width / source.width))
+        source.resize((width, height), Image.LANCZOS).save(thumb_path, "JPEG", quality=quality, optimize=True)
+
+
+def peak_rss_mb():
+    """当前进程的峰值常驻内存（MB）"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss在macOS下单位为字节，其他系统为KB
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / 1024 / 1024 if sys.platform == 'darwin' else maxrss / 1024
+
+
+def run_mode(mode, corpus, out_dir):
+    """在当前进程中处理整个图片集，返回结果字典"""
+    generate = full_decode if mode == 'full' else thumbnailer.generate_thumbnail_set
+    os.makedirs(out_dir, exist_ok=True)
+    latencies = []
+    for filename in sorted(os.listdir(corpus)):
+        name = os.path.splitext(filename)[0]
+        targets = [(width, os.path.join(out_dir, f"{name}_w{width}.jpg")) for width in WIDTHS]
+        start = time.perf_counter()
+        generate(os.path.join(corpus, filename), targets)
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    return {
+        "images": len(latencies),
+        "mean_ms": sum(latencies) / len(latencies) * 1000,
+        "p50_ms": latencies[len(latencies) // 2] * 1000,
+        "p95_ms": latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="缩略图生成基准测试")
+    parser.add_argument('--images', type=int, default=30, help="生成的图片数量")
+    parser.add_argument('--width', type=int, default=6000)
+    parser.add_argument('--height', type=int, default=4000)
+    parser.add_argument('--mode', choices=('full', 'draft'), help=argparse.SUPPRESS)
+    parser.add_argument('--corpus', help=argparse.SUPPRESS)
+    parser.add_argument('--out', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    # 子进程：只运行一种方式并输出JSON结果
+    if args.mode:
+        print(json.dumps(run_mode(args.mode, args.corpus, args.out)))
+        return
+
+    base = tempfile.mkdtemp(prefix='bench-thumbs-')
+    corpus = os.path.join(base, 'photos')
+    print(f"生成 {args.images} 张 {args.width}x{args.height} 测试图片: {base}")
+    make_corpus(corpus, args.images, args.width, args.height)
+
+    results = {}
+    for mode in ('full', 'draft'):
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--mode', mode,
+             '--corpus', corpus, '--out', os.path.join(base, f'thumbs-{mode}')],
+            check=True, capture_output=True, text=True
+        ).stdout
+        results[mode] = json.loads(output.strip().splitlines()[-1])
+
+    print(f"\n{'方式':<10}{'平均(ms)':>12}{'p50(ms)':>12}{'p95(ms)':>12}{'峰值RSS(MB)':>14}")
+    for mode, result in results.items():
+        print(f"{mode:<10}{result['mean_ms']:>12.1f}{result['p50_ms']:>12.1f}"
+              f"{result['p95_ms']:>12.1f}{result['peak_rss_mb']:>14.1f}")
+    print(f"提速: {results['full']['mean_ms'] / results['draft']['mean_ms']:.2f}x, "
+          f"峰值内存: {results['draft']['peak_rss_mb'] / results['full']['peak_rss_mb']:.2f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""/img/today 吞吐量基准测试
+
+生成一个临时图片库，在进程内并发请求 /img/today，
+分别测量实时选图（默认方式）和启用预选图片池（TODAY_POOL_SIZE）时的每秒请求数。
+注意"实时选图"一项是当前代码在TODAY_POOL_SIZE=0时的结果，不是引入图片池之前的代码，
+与旧版本对比需要在旧版本上单独运行本脚本。
+请求像WSGI服务器一样直接调用应用（复用预先生成的environ），不经过Flask测试客户端，
+测试客户端构造请求和解析响应的开销比处理请求本身还大，会掩盖两种方式的差别。
+应用的控制台输出在测试期间会被丢弃，结果只反映请求处理本身的开销。
+
+用法:
+    python benchmarks/bench_today.py --images 500 --threads 8 --duration 5 --pool-size 32
+"""
+import argparse
+import os
+import threading
+import time
+
+from PIL import Image
+from werkzeug.test import EnvironBuilder
+
+import _common
+
+
+def make_library(root, count, width, height):
+    """生成count张纯色JPEG图片，每个子目录100张"""
+    for i in range(count):
+        folder = os.path.join(root, f"album{i // 100:03d}")
+        os.makedirs(folder, exist_ok=True)
+        color = ((i * 37) % 256, (i * 91) % 256, (i * 53) % 256)
+        Image.new('RGB', (width, height), color).save(os.path.join(folder, f"img{i:05d}.jpg"), quality=85)
+
+
+def run_load(wsgi_app, url, threads, duration):
+    """用threads个线程持续请求url，返回(总请求数, 失败数, 每秒请求数)"""
+    counts = [0] * threads
+    errors = [0] * threads
+    deadline = time.perf_counter() + duration
+    environ = EnvironBuilder(path=url).get_environ()
+
+    def worker(index):
+        status = []
+
+        def start_response(value, headers, exc_info=None):
+            status.append(value)
+
+        while time.perf_counter() < deadline:
+            status.clear()
+            body = wsgi_app(dict(environ), start_response)
+            try:
+                for _ in body:
+                    pass
+            finally:
+                if hasattr(body, 'close'):
+                    body.close()
+            if not status[0].startswith('200'):
+                errors[index] += 1
+            counts[index] += 1
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    start = time.perf_counter()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    elapsed = time.perf_counter() - start
+    total = sum(counts)
+    return total, sum(errors), total / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="/img/today 吞吐量基准测试")
+    parser.add_argument('--images', type=int, default=500, help="生成的图片数量")
+    parser.add_argument('--width', type=int, default=1600)
+    parser.add_argument('--height', type=int, default=1200)
+    parser.add_argument('--threads', type=int, default=8, help="并发客户端线程数")
+    parser.add_argument('--duration', type=float, default=5.0, help="每轮测试时长（秒）")
+    parser.add_argument('--pool-size', type=int, default=32, help="预选图片池大小")
+    args = parser.parse_args()
+
+    base = _common.setup_library('bench-today-', TODAY_POOL_SIZE=0)
+
+    print(f"生成 {args.images} 张 {args.width}x{args.height} 测试图片: {base}")
+    make_library(os.environ['PHOTOS_FOLDER'], args.images, args.width, args.height)
+
+    app = _common.import_app()
+    with _common.quiet():
+        app.rescan_images()
+        # 等待扫描后自动启动的缩略图生成完成，避免占用测试期间的CPU
+        time.sleep(0.5)
+        while app.THUMBNAIL_STATUS["is_generating"]:
+            time.sleep(0.5)
+
+        before = run_load(app.app, '/img/today', args.threads, args.duration)
+
+        app.TODAY_POOL = app.TodayImagePool(args.pool_size)
+        app.TODAY_POOL.pop()
+        time.sleep(0.5)
+        after = run_load(app.app, '/img/today', args.threads, args.duration)
+
+    print(f"\n{'模式':<16}{'请求数':>10}{'失败':>8}{'请求/秒':>12}")
+    print(f"{'实时选图(池=0)':<16}{before[0]:>10}{before[1]:>8}{before[2]:>12.1f}")
+    print(f"{'预选图片池':<16}{after[0]:>10}{after[1]:>8}{after[2]:>12.1f}")
+    print(f"提升: {after[2] / before[2]:.2f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+"""跨进程文件锁和原子写入
+
+本模块只依赖标准库，不导入app，thumbnailer在进程池的子进程中也使用它。
+"""
+import os
+import tempfile
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows下没有fcntl，只支持单进程运行
+    fcntl = None
+
+
+@contextmanager
+def file_lock(f):
+    """对已打开的文件加跨进程排他锁（flock），没有fcntl时不加锁，由调用方的进程内锁保证互斥"""
+    if fcntl:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+    try:
+        yield
+    finally:
+        if fcntl:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+@contextmanager
+def atomic_write(path, mode='wb', **kwargs):
+    """打开同目录下的临时文件用于写入，正常结束后重命名为path，出错时删除临时文件
+
+    其他进程/线程不会读到写了一半的文件。kwargs传给open()，如encoding。
+    """
+    fd, tmp_path = tempfile.mkstemp(prefix='.tmp-', dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, mode, **kwargs) as f:
+            yield f
+        # mkstemp创建的文件权限为0600，改为普通文件的权限
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
@@ -0,0 +1,18 @@
+"""gunicorn配置，启动命令: gunicorn -c gunicorn.conf.py wsgi:application
+
+可以通过环境变量调整:
+    BIND         监听地址，默认 0.0.0.0:5000
+    WEB_WORKERS  worker进程数，默认 2
+    WEB_THREADS  每个worker的线程数，默认 8
+    WEB_TIMEOUT  请求超时时间（秒），默认 120
+"""
+import os
+
+bind = os.getenv('BIND', '0.0.0.0:5000')
+workers = int(os.getenv('WEB_WORKERS', '2'))
+threads = int(os.getenv('WEB_THREADS', '8'))
+worker_class = 'gthread'
+timeout = int(os.getenv('WEB_TIMEOUT', '120'))
+
+# 每个worker自己导入应用并调用init_worker，不能在fork前预加载
+preload_app = False
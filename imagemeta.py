@@ -0,0 +1,72 @@
+"""只读取文件头获取图片尺寸
+
+支持JPEG（SOF段）、PNG（IHDR块）、GIF和BMP文件头，通常只需要读取几十到几千字节，
+不需要像Image.open那样创建解码器。无法识别时返回None，由调用方退回到Pillow。
+"""
+import struct
+
+# 带图片尺寸的JPEG SOF标记（排除DHT 0xC4、JPG 0xC8、DAC 0xCC）
+JPEG_SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+# 没有长度字段的JPEG标记：TEM和RST0-RST7
+JPEG_STANDALONE_MARKERS = frozenset(range(0xD0, 0xD8)) | {0x01}
+
+
+def _jpeg_size(f):
+    """逐个跳过JPEG段直到SOF，返回(宽, 高)"""
+    f.seek(2)
+    while True:
+        byte = f.read(1)
+        if not byte:
+            return None
+        if byte != b'\xff':
+            # 段之间不应有其他数据，文件损坏
+            return None
+        marker = f.read(1)
+        # 标记前可以有任意个0xFF填充字节
+        while marker == b'\xff':
+            marker = f.read(1)
+        if not marker:
+            return None
+        marker = marker[0]
+        if marker in JPEG_STANDALONE_MARKERS:
+            continue
+        if marker in (0xD9, 0xDA):
+            # 到达图像数据或结束标记仍未找到SOF
+            return None
+        header = f.read(2)
+        if len(header) < 2:
+            return None
+        length = struct.unpack('>H', header)[0]
+        if marker in JPEG_SOF_MARKERS:
+            data = f.read(5)
+            if len(data) < 5:
+                return None
+            height, width = struct.unpack('>xHH', data)
+            return width, height
+        f.seek(length - 2, 1)
+
+
+def probe_size(path):
+    """读取图片文件头中的尺寸，返回(宽, 高)，格式不支持或文件头损坏时返回None"""
+    with open(path, 'rb') as f:
+        head = f.read(32)
+        if head[:2] == b'\xff\xd8':
+            size = _jpeg_size(f)
+        elif head[:8] == b'\x89PNG\r\n\x1a\n' and head[12:16] == b'IHDR':
+            size = struct.unpack('>II', head[16:24])
+        elif head[:6] in (b'GIF87a', b'GIF89a'):
+            size = struct.unpack('<HH', head[6:10])
+        elif head[:2] == b'BM' and len(head) >= 26:
+            header_size = struct.unpack('<I', head[14:18])[0]
+            if header_size == 12:
+                # OS/2 BITMAPCOREHEADER
+                size = struct.unpack('<HH', head[18:22])
+            else:
+                width, height = struct.unpack('<ii', head[18:26])
+                # 高度为负数表示自上而下存储
+                size = (width, abs(height))
+        else:
+            return None
+    if not size or size[0] <= 0 or size[1] <= 0:
+        return None
+    return tuple(size)
@@ -0,0 +1,180 @@
+"""Prometheus文本格式的运行指标
+
+本模块不依赖app和第三方库，只提供计数器、直方图和仪表三种指标，以及多进程数据的合并和输出：
+每个进程在内存中累计自己的指标，通过snapshot()导出为可以JSON序列化的字典，
+merge()把各进程的快照合并（计数器和直方图相加，仪表取最后更新的值），
+accumulate()把已退出进程的计数器和直方图累加到一个快照中保存，合并后的总数不会因进程退出而减少，
+render()输出为Prometheus的文本格式（text/plain; version=0.0.4）。
+"""
+import math
+import threading
+import time
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# 默认的延迟直方图分桶（秒），覆盖从缓存命中的几毫秒到生成大图变体的数秒
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Metrics:
+    """一个进程内的指标集合，线程安全
+
+    指标需要先用counter()/histogram()/gauge()声明，之后按名称和标签记录：
+        metrics.counter('requests_total', "请求数")
+        metrics.inc('requests_total', route='/image', status='200')
+    名称会自动加上namespace前缀。
+    """
+
+    def __init__(self, namespace):
+        self.namespace = namespace
+        self._lock = threading.Lock()
+        self._meta = {}  # 名称 -> (类型, 说明, 分桶)
+        self._counters = {}  # (名称, 标签) -> 数值
+        self._histograms = {}  # (名称, 标签) -> [各分桶计数..., +Inf分桶计数, 总和]
+        self._gauges = {}  # (名称, 标签) -> (数值, 更新时间)
+        self.dirty = False
+
+    def _declare(self, kind, name, help_text, buckets=None):
+        self._meta[f"{self.namespace}_{name}"] = (kind, help_text, tuple(buckets) if buckets else None)
+
+    def counter(self, name, help_text):
+        self._declare('counter', name, help_text)
+
+    def histogram(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        self._declare('histogram', name, help_text, buckets)
+
+    def gauge(self, name, help_text):
+        self._declare('gauge', name, help_text)
+
+    def _key(self, name, labels):
+        return f"{self.namespace}_{name}", tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+            self.dirty = True
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        buckets = self._meta[key[0]][2]
+        with self._lock:
+            values = self._histograms.get(key)
+            if values is None:
+                values = self._histograms[key] = [0] * (len(buckets) + 2)
+            # 各分桶分别计数（不累加），输出时再累加为Prometheus的le累计计数
+            values[next((i for i, bound in enumerate(buckets) if value <= bound), len(buckets))] += 1
+            values[-1] += value
+            self.dirty = True
+
+    def set(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._gauges[key] = (value, time.time())
+            self.dirty = True
+
+    def snapshot(self):
+        """导出当前的指标数据，可以JSON序列化，用于写入文件和merge()"""
+        with self._lock:
+            self.dirty = False
+            return {
+                "counters": [[name, labels, value] for (name, labels), value in self._counters.items()],
+                "histograms": [[name, labels, list(values)] for (name, labels), values in self._histograms.items()],
+                "gauges": [[name, labels, value, updated] for (name, labels), (value, updated) in self._gauges.items()],
+            }
+
+    def render(self, snapshots, extra_gauges=()):
+        """合并多个进程的快照并输出为Prometheus文本格式
+
+        extra_gauges为[(名称, 标签字典, 数值), ...]，是输出时即时计算的仪表（如索引大小），不需要合并。
+        """
+        merged = merge(snapshots)
+        for name, labels, value in extra_gauges:
+            name, labels = self._key(name, labels)
+            merged["gauges"][(name, labels)] = value
+        return render(self._meta, merged)
+
+
+def merge(snapshots):
+    """合并多个进程的快照：计数器和直方图相加，仪表取最后更新的值"""
+    counters = {}
+    histograms = {}
+    gauges = {}
+    for snapshot in snapshots:
+        for name, labels, value in snapshot.get("counters", ()):
+            key = (name, tuple(map(tuple, labels)))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, values in snapshot.get("histograms", ()):
+            key = (name, tuple(map(tuple, labels)))
+            current = histograms.get(key)
+            histograms[key] = list(values) if current is None else [a + b for a, b in zip(current, values)]
+        for name, labels, value, updated in snapshot.get("gauges", ()):
+            key = (name, tuple(map(tuple, labels)))
+            if key not in gauges or updated >= gauges[key][1]:
+                gauges[key] = (value, updated)
+    return {
+        "counters": counters,
+        "histograms": histograms,
+        "gauges": {key: value for key, (value, _) in gauges.items()},
+    }
+
+
+def accumulate(snapshots):
+    """把多个快照的计数器和直方图相加，返回与Metrics.snapshot()格式相同的快照，不包含仪表
+
+    用于保存已退出进程的累计值：计数器和直方图在Prometheus中只能增加，
+    仪表只反映存活进程的当前状态，进程退出后不再保留。
+    """
+    merged = merge(snapshots)
+    return {
+        "counters": [[name, [list(pair) for pair in labels], value]
+                     for (name, labels), value in merged["counters"].items()],
+        "histograms": [[name, [list(pair) for pair in labels], values]
+                       for (name, labels), values in merged["histograms"].items()],
+        "gauges": [],
+    }
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _number(value):
+    if isinstance(value, float):
+        if math.isinf(value):
+            return '+Inf' if value > 0 else '-Inf'
+        if math.isnan(value):
+            return 'NaN'
+        return repr(value)
+    return str(value)
+
+
+def render(meta, merged):
+    """把merge()的结果按声明顺序输出为Prometheus文本格式，没有数据的指标只输出说明"""
+    lines = []
+    for name, (kind, help_text, buckets) in meta.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        if kind == 'histogram':
+            for (series, labels), values in sorted(merged["histograms"].items()):
+                if series != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(buckets + (math.inf,), values):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_labels(labels, [('le', _number(float(bound)))])} {cumulative}")
+                lines.append(f"{name}_sum{_labels(labels)} {_number(values[-1])}")
+                lines.append(f"{name}_count{_labels(labels)} {cumulative}")
+        else:
+            values = merged["counters"] if kind == 'counter' else merged["gauges"]
+            for (series, labels), value in sorted(values.items()):
+                if series == name:
+                    lines.append(f"{name}{_labels(labels)} {_number(value)}")
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,251 @@
+"""缩略图生成
+
+本模块只依赖Pillow和fileutil，不导入app，进程池的子进程按模块名导入本模块即可运行任务。
+注意spawn方式的子进程还会重新执行主模块：直接运行python app.py时app.py的模块级代码会在每个子进程中执行一次
+（gunicorn/wsgi.py启动时不会），见app.get_thumbnail_executor。
+缩略图按原图内容寻址：文件名由原图内容的MD5和宽度组成，相同内容的原图共用同一组缩略图。
+除JPEG外还可以保存为WebP和AVIF（需要Pillow支持），格式由缩略图路径的扩展名决定。
+每张原图只解码一次，然后从最大宽度开始逐级缩小，较小的缩略图从上一级结果缩放得到。
+目标尺寸远小于原图时，JPEG用draft()直接按1/2、1/4、1/8比例解码，
+其他格式在LANCZOS缩放前先用reduce()按整数倍缩小，避免全分辨率处理。
+"""
+import base64
+import hashlib
+import os
+import time
+from io import BytesIO
+from PIL import Image, ImageOps
+
+import fileutil
+
+# 降采样解码/整数倍缩小时保留的倍数余量：中间结果至少是目标尺寸的2倍，
+# 再用LANCZOS缩放到目标尺寸，画质与全尺寸解码后缩放基本一致（与Image.thumbnail的默认值相同）
+REDUCING_GAP = 2.0
+
+# 缩略图格式：扩展名、Content-Type和保存参数。JPEG的质量由调用方传入，
+# WebP/AVIF同等画质下体积更小；AVIF的speed=8编码速度与WebP相近，默认的6要慢数倍
+FORMATS = {
+    'jpeg': {'ext': '.jpg', 'mimetype': 'image/jpeg', 'params': {'format': 'JPEG', 'optimize': True}},
+    'webp': {'ext': '.webp', 'mimetype': 'image/webp', 'params': {'format': 'WEBP', 'quality': 80, 'method': 4}},
+    'avif': {'ext': '.avif', 'mimetype': 'image/avif', 'params': {'format': 'AVIF', 'quality': 60, 'speed': 8}},
+    'png': {'ext': '.png', 'mimetype': 'image/png', 'params': {'format': 'PNG', 'optimize': True}},
+}
+# 原图变体的缩放方式：contain完整放入w×h（不放大），cover铺满w×h并居中裁剪，fill拉伸到w×h
+VARIANT_FITS = ('contain', 'cover', 'fill')
+# EXIF方向为5-8时图片需要旋转90度，宽高互换
+TRANSPOSED_ORIENTATIONS = (5, 6, 7, 8)
+FORMAT_BY_EXT = {spec['ext']: name for name, spec in FORMATS.items()}
+
+# 计算内容MD5时每次读取的字节数
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# 内嵌预览图的最长边（像素）和WebP质量，生成的data URI一般只有一两百字节
+PREVIEW_SIZE = 16
+PREVIEW_QUALITY = 40
+
+
+def to_rgb(img):
+    """转换为可保存为JPEG的模式，透明部分填充白色背景"""
+    if img.mode in ('RGB', 'L'):
+        return img
+    if img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info):
+        img = img.convert('RGBA')
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        background.paste(img, mask=img.split()[3])
+        return background
+    return img.convert('RGB')
+
+
+def save_atomic(img, path, **params):
+    """先写入同目录下的临时文件再重命名，其他进程/线程不会读到写了一半的文件"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with fileutil.atomic_write(path) as f:
+        img.save(f, **params)
+
+
+def available_formats():
+    """当前Pillow能够保存的缩略图格式"""
+    Image.init()
+    return [name for name, spec in FORMATS.items() if spec['params']['format'] in Image.SAVE]
+
+
+def format_of(path):
+    """根据缩略图路径的扩展名返回格式，无法识别时返回None"""
+    return FORMAT_BY_EXT.get(os.path.splitext(path)[1].lower())
+
+
+def store_path(objects_dir, content_hash, width, fmt='jpeg'):
+    """内容寻址的缩略图路径：<objects_dir>/<哈希前两位>/<哈希>_w<宽度>.<扩展名>"""
+    return os.path.join(objects_dir, content_hash[:2], f"{content_hash}_w{width}{FORMATS[fmt]['ext']}")
+
+
+def make_preview(img, size=PREVIEW_SIZE):
+    """由已解码的RGB图片生成内嵌预览，返回(data URI, 主色调#rrggbb)
+
+    预览图是最长边size像素的WebP（Pillow不支持WebP时用JPEG），浏览器放大后自然呈模糊效果；
+    主色调取缩小后图片量化为4种颜色时占比最多的颜色。
+    """
+    preview = img.copy()
+    preview.thumbnail((size, size), Image.LANCZOS, reducing_gap=REDUCING_GAP)
+    fmt = 'webp' if 'webp' in available_formats() else 'jpeg'
+    buffer = BytesIO()
+    preview.save(buffer, format=FORMATS[fmt]['params']['format'], quality=PREVIEW_QUALITY)
+    data_uri = f"data:{FORMATS[fmt]['mimetype']};base64,{base64.b64encode(buffer.getvalue()).decode('ascii')}"
+
+    quantized = preview.convert('RGB').quantize(colors=4)
+    _, index = max(quantized.getcolors())
+    r, g, b = quantized.getpalette()[index * 3:index * 3 + 3]
+    return data_uri, f"#{r:02x}{g:02x}{b:02x}"
+
+
+def preview_from_file(path, size=PREVIEW_SIZE):
+    """读取图片文件（原图或已生成的缩略图）生成内嵌预览，返回(data URI, 主色调)
+
+    JPEG用draft()按最多1/8比例解码，开销很小。
+    """
+    with Image.open(path) as img:
+        if img.format == 'JPEG':
+            img.draft('RGB', (int(size * REDUCING_GAP), int(size * REDUCING_GAP)))
+        img.load()
+        return make_preview(to_rgb(img), size)
+
+
+def generate_thumbnail_set(src, targets, quality=85, preview_size=PREVIEW_SIZE):
+    """为一张原图生成多个宽度的缩略图
+
+    src为原图路径或文件对象，targets为[(宽度, 缩略图路径), ...]，格式由路径的扩展名决定，
+    同一宽度可以有多个格式，只缩放一次。已存在的缩略图会跳过，全部存在时不会解码原图。返回生成数量、生成的文件[(宽度, 路径, 字节数), ...]和各阶段耗时（秒）：
+    {"generated": 2, "files": [...], "decode": 0.12, "resize": 0.05, "save": 0.02, "preview": (data URI, 主色调)}
+    解码了原图时顺便由最小的缩略图生成最长边preview_size的内嵌预览（见make_preview），
+    没有解码或preview_size为0时preview为None。
+    """
+    stats = {"generated": 0, "files": [], "decode": 0.0, "resize": 0.0, "save": 0.0, "preview": None}
+    pending = sorted(((width, path) for width, path in targets if not os.path.exists(path)), reverse=True)
+    if not pending:
+        return stats
+
+    start = time.perf_counter()
+    with Image.open(src) as img:
+        # 缩略图高度按原图尺寸计算，draft()之后img.size会变小
+        orig_width, orig_height = img.size
+        largest = pending[0][0]
+        if img.format == 'JPEG' and largest * REDUCING_GAP < orig_width:
+            scale = largest * REDUCING_GAP / orig_width
+            img.draft('RGB', (int(orig_width * scale), int(orig_height * scale)))
+        img.load()
+        source = to_rgb(img)
+    stats["decode"] = time.perf_counter() - start
+
+    current = source
+    for width, thumb_path in pending:
+        if current.width != width:
+            # 保持原始比例
+            height = max(1, int(orig_height * width / orig_width))
+
+            start = time.perf_counter()
+            # 上一级缩略图足够大时从它缩放，否则（需要放大时）从原图缩放
+            base = current if current.width >= width else source
+            current = base.resize((width, height), Image.LANCZOS, reducing_gap=REDUCING_GAP)
+            stats["resize"] += time.perf_counter() - start
+
+        fmt = format_of(thumb_path) or 'jpeg'
+        params = dict(FORMATS[fmt]['params'])
+        if fmt == 'jpeg':
+            params['quality'] = quality
+        start = time.perf_counter()
+        save_atomic(current, thumb_path, **params)
+        stats["save"] += time.perf_counter() - start
+
+        stats["generated"] += 1
+        stats["files"].append((width, thumb_path, os.path.getsize(thumb_path)))
+
+    if preview_size:
+        stats["preview"] = make_preview(current, preview_size)
+    return stats
+
+
+def generate_to_store(src_path, objects_dir, widths, quality=85, formats=('jpeg',), preview_size=PREVIEW_SIZE):
+    """打开原图一次，分块计算内容MD5后从同一文件生成各个宽度、各个格式的缩略图到内容寻址存储
+
+    返回generate_thumbnail_set的结果，另外包含hash以及读取时原图的size和mtime，
+    调用方据此登记缩略图并把哈希保存到索引。不把整个原图读入内存，进程池的每个进程只占用解码所需的内存。
+    """
+    with open(src_path, 'rb') as f:
+        stat = os.fstat(f.fileno())
+        start = time.perf_counter()
+        hasher = hashlib.md5()
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            hasher.update(chunk)
+        content_hash = hasher.hexdigest()
+        read_time = time.perf_counter() - start
+
+        targets = [(width, store_path(objects_dir, content_hash, width, fmt)) for width in widths for fmt in formats]
+        f.seek(0)
+        stats = generate_thumbnail_set(f, targets, quality, preview_size)
+    stats["decode"] += read_time
+    stats.update(hash=content_hash, size=stat.st_size, mtime=stat.st_mtime)
+    return stats
+
+
+def variant_geometry(src_width, src_height, width=None, height=None, fit='contain'):
+    """计算原图变体的输出尺寸和需要的原图区域，返回((输出宽, 输出高), (left, top, right, bottom))
+
+    width/height可以只给一个，按比例计算另一个；cover和fill需要同时给出宽高，否则按contain处理。
+    """
+    box = (0, 0, src_width, src_height)
+    if width and height and fit == 'fill':
+        return (width, height), box
+    if width and height and fit == 'cover':
+        scale = max(width / src_width, height / src_height)
+        crop_width, crop_height = width / scale, height / scale
+        left, top = (src_width - crop_width) / 2, (src_height - crop_height) / 2
+        return (width, height), (left, top, left + crop_width, top + crop_height)
+    scales = [1.0]
+    if width:
+        scales.append(width / src_width)
+    if height:
+        scales.append(height / src_height)
+    scale = min(scales)
+    return (max(1, round(src_width * scale)), max(1, round(src_height * scale))), box
+
+
+def render_variant(src_path, dest_path, width=None, height=None, fit='contain', fmt='jpeg', quality=None):
+    """把原图缩放、裁剪并重新编码为指定格式，保存到dest_path，返回{"width", "height", "bytes"}
+
+    按EXIF方向旋转（输出文件不带EXIF，不旋转的话方向会错），JPEG用draft()降采样解码。
+    quality为None时使用FORMATS中的默认质量（JPEG为85）。
+    """
+    with Image.open(src_path) as img:
+        orientation = img.getexif().get(0x0112, 1)
+        if orientation in TRANSPOSED_ORIENTATIONS:
+            orig_width, orig_height = img.height, img.width
+        else:
+            orig_width, orig_height = img.size
+        size, box = variant_geometry(orig_width, orig_height, width, height, fit)
+
+        if img.format == 'JPEG':
+            # 需要的原图区域缩放到输出尺寸时的比例，按这个比例降采样解码
+            scale = max(size[0] / (box[2] - box[0]), size[1] / (box[3] - box[1])) * REDUCING_GAP
+            if scale < 1:
+                img.draft('RGB', (int(img.width * scale), int(img.height * scale)))
+        img.load()
+        img = ImageOps.exif_transpose(img)
+
+        if fmt == 'jpeg':
+            img = to_rgb(img)
+        elif img.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+            img = img.convert('RGBA' if img.mode == 'P' and 'transparency' in img.info else 'RGB')
+
+    # draft()之后图片变小，裁剪区域按实际尺寸换算
+    factor = img.width / orig_width
+    box = tuple(value * factor for value in box)
+    if size != img.size or box != (0, 0, img.width, img.height):
+        img = img.resize(size, Image.LANCZOS, box=box, reducing_gap=REDUCING_GAP)
+
+    params = dict(FORMATS[fmt]['params'])
+    if quality is not None and fmt != 'png':
+        params['quality'] = quality
+    elif fmt == 'jpeg':
+        params['quality'] = 85
+    save_atomic(img, dest_path, **params)
+    return {"width": img.width, "height": img.height, "bytes": os.path.getsize(dest_path)}
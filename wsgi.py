@@ -0,0 +1,16 @@
+"""生产环境WSGI入口
+
+gunicorn（推荐，配置见 gunicorn.conf.py）:
+    gunicorn -c gunicorn.conf.py wsgi:application
+
+uwsgi:
+    uwsgi --http :5000 --module wsgi:application --processes 2 --threads 8 --lazy-apps
+
+每个worker进程导入本模块时都会调用init_worker()：从索引加载图片列表，
+并通过文件锁保证只有一个进程运行定时任务、文件监控和目录扫描。
+不要在fork之前预加载应用（gunicorn的preload_app、uwsgi缺少--lazy-apps），否则后台线程不会被继承。
+"""
+from app import app, init_worker
+
+init_worker()
+application = app